@@ -1,53 +1,536 @@
+import unittest
+from types import SimpleNamespace
+
 from nmigen import *
-from luna.gateware.debug.ila import StreamILA, ILAFrontend
+from nmigen.lib.fifo import SyncFIFOBuffered
+from nmigen.sim import *
+from nmigen.utils import bits_for, log2_int
+from nmigen_soc import wishbone
+from luna.gateware.debug.ila import ILAFrontend
 
 from interface.ft245 import FT245Interface
-from soc.stream import ByteDownConverter
+from interface.hyperram_wishbone import HyperRAMWishboneInterface
+from soc.dma import WishboneDMAReader
+from soc.stream import BasicStream, ByteDownConverter
+from soc.wishbone import PriorityArbiter, Translator
+
+from test import *
+from test.driver.stream import StreamDriver
+from test.emulator.wishbone import RecordingWishboneEmulator
+
+
+class Pattern:
+    """ Trigger condition: the masked value matches """
+
+    def __init__(self, value, match, mask=None):
+        self.value = value
+        self.match = match
+        self.mask  = mask
+
+    def elaborate_condition(self, m):
+        value = Value.cast(self.value)
+        mask  = (1 << len(value)) - 1 if self.mask is None else self.mask
+        return (value & mask) == (self.match & mask)
+
+
+class Edge:
+    """ Trigger condition: a rising and/or falling edge of a single signal """
+
+    def __init__(self, signal, *, rising=True, falling=False):
+        self.signal  = signal
+        self.rising  = rising
+        self.falling = falling
+
+    def elaborate_condition(self, m):
+        previous = Signal.like(self.signal, name_suffix="_previous")
+        m.d.sync += previous.eq(self.signal)
+
+        condition = Const(0)
+        if self.rising:
+            condition = condition | (self.signal & ~previous)
+        if self.falling:
+            condition = condition | (~self.signal & previous)
+        return condition
+
+
+class ILATrigger(Elaboratable):
+    """ Sequential multi-condition trigger
+
+    Each stage is a Pattern, an Edge or any 1-bit expression. The trigger fires for a
+    cycle once every stage has matched, in order; the first stage re-arms it.
+    """
+
+    def __init__(self, stages):
+        if not stages:
+            raise ValueError("A trigger needs at least one stage")
+
+        self.stages = stages
+
+        self.trigger = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+
+        conditions = []
+        for stage in self.stages:
+            if hasattr(stage, "elaborate_condition"):
+                conditions.append(stage.elaborate_condition(m))
+            else:
+                conditions.append(Value.cast(stage).bool())
+
+        stage = Signal(range(len(conditions)))
+
+        with m.Switch(stage):
+            for i, condition in enumerate(conditions):
+                with m.Case(i):
+                    with m.If(condition):
+                        if i == len(conditions) - 1:
+                            m.d.comb += self.trigger.eq(1)
+                            m.d.sync += stage.eq(0)
+                        else:
+                            m.d.sync += stage.eq(i + 1)
+
+        return m
+
+
+class _ILACaptureBase(Elaboratable):
+    """ Sampling, triggering and entry building shared by the capture backends
+
+    Samples are taken every 'decimation' cycles. With 'rle' set, a run of identical
+    samples shares one entry, which carries the number of repeats (up to
+    2**run_width - 1) above the sample bits. Entries then count changes rather than
+    cycles, so quiet signals fill a much longer window.
+    """
+
+    def __init__(self, *, sample_width, sample_depth, samples_pretrigger=1, decimation=1,
+                 rle=False, run_width=8):
+        if sample_depth & (sample_depth - 1):
+            raise ValueError("Sample depth must be a power of two, not {}".format(sample_depth))
+        if not 0 <= samples_pretrigger < sample_depth:
+            raise ValueError("Pre-trigger samples must fit within the sample depth")
+
+        self.sample_width       = sample_width
+        self.sample_depth       = sample_depth
+        self.samples_pretrigger = samples_pretrigger
+        self.decimation         = decimation
+        self.rle                = rle
+        self.run_width          = run_width if rle else 0
+
+        self.entry_width        = sample_width + self.run_width
+
+        self.sample   = Signal(sample_width)
+        self.trigger  = Signal()
+
+        self.sampling = Signal()
+        self.complete = Signal()
+
+    def _elaborate_entries(self, m, *, write):
+        """ Adds decimation and entry building
+
+        'write' is called to add the statements that store the pending entry. Returns
+        the sample strobe, the pending entry, its valid flag and a 'record' function,
+        which folds the current sample into the pending entry and returns whether the
+        previous one was written.
+        """
+        strobe = Signal()
+
+        if self.decimation > 1:
+            divider = Signal(range(self.decimation))
+            m.d.sync += divider.eq(Mux(divider == self.decimation - 1, 0, divider + 1))
+            m.d.comb += strobe.eq(divider == 0)
+        else:
+            m.d.comb += strobe.eq(1)
+
+        current_sample = Signal(self.sample_width)
+        current_run    = Signal(self.run_width)
+        current_valid  = Signal()
+
+        def record(*, force_new=False):
+            written = Signal()
+
+            can_merge = Const(0)
+            if self.rle and not force_new:
+                can_merge = current_valid & (self.sample == current_sample) & ~current_run.all()
+
+            with m.If(can_merge):
+                m.d.sync += current_run.eq(current_run + 1)
+            with m.Else():
+                m.d.sync += [
+                    current_sample  .eq(self.sample),
+                    current_run     .eq(0),
+                    current_valid   .eq(1),
+                ]
+
+                with m.If(current_valid):
+                    write()
+                    m.d.comb += written.eq(1)
+
+            return written
+
+        return strobe, Cat(current_sample, current_run), current_valid, record
+
+    def _elaborate_armed(self, m, *, strobe, record):
+        """ Body of the ARMED state; returns a strobe for the sample that takes the trigger """
+        fire         = Signal()
+        trigger_seen = Signal()
+
+        with m.If(strobe):
+            with m.If(self.trigger | trigger_seen):
+                # The triggering sample always begins an entry of its own.
+                record(force_new=True)
+                m.d.comb += fire.eq(1)
+                m.d.sync += trigger_seen.eq(0)
+            with m.Else():
+                record()
+
+        # Triggers arriving between decimated samples are held for the next one.
+        with m.Elif(self.trigger):
+            m.d.sync += trigger_seen.eq(1)
+
+        return fire
+
+
+class ILACapture(_ILACaptureBase):
+    """ Triggered sample capture into block RAM, with decimation and run-length encoding
+
+    Entries are written into a ring buffer of 'sample_depth' entries, 'samples_pretrigger'
+    of which precede the trigger. Once the buffer holds the window, every entry is
+    streamed out, oldest first, and the capture re-arms.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.bytes_per_entry = (self.entry_width + 7) // 8
+
+        self.stream   = BasicStream(self.entry_width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        memory = Memory(width=self.entry_width, depth=self.sample_depth)
+        m.submodules.write_port = write_port = memory.write_port()
+        m.submodules.read_port  = read_port  = memory.read_port(transparent=False)
+
+        write_address  = Signal(range(self.sample_depth))
+        read_address   = Signal(range(self.sample_depth))
+        remaining      = Signal(range(self.sample_depth + 1))
+
+        def write():
+            m.d.comb += write_port.en.eq(1)
+            m.d.sync += write_address.eq(write_address + 1)
+
+        strobe, entry, current_valid, record = self._elaborate_entries(m, write=write)
+
+        m.d.comb += [
+            write_port.addr     .eq(write_address),
+            write_port.data     .eq(entry),
+        ]
+
+        with m.FSM():
+
+            with m.State("ARMED"):
+                with m.If(self._elaborate_armed(m, strobe=strobe, record=record)):
+                    m.d.sync += remaining.eq(self.sample_depth - self.samples_pretrigger)
+                    m.next = "CAPTURE"
+
+            with m.State("CAPTURE"):
+                m.d.comb += self.sampling.eq(1)
+
+                with m.If(remaining == 1):
+                    # The entry in progress is the last one of the window.
+                    write()
+                    m.d.sync += [
+                        read_address    .eq(write_address + 1),
+                        current_valid   .eq(0),
+                        remaining       .eq(0),
+                    ]
+                    m.next = "DUMP"
+
+                with m.Elif(strobe):
+                    with m.If(record()):
+                        m.d.sync += remaining.eq(remaining - 1)
+
+            # The remaining count is reused to count entries out.
+            with m.State("DUMP"):
+                m.d.comb += [
+                    self.complete       .eq(1),
+                    self.stream.valid   .eq(1),
+                    self.stream.first   .eq(remaining == 0),
+                    self.stream.last    .eq(remaining == self.sample_depth - 1),
+                ]
+
+                with m.If(self.stream.ready):
+                    m.d.sync += [
+                        read_address    .eq(read_address + 1),
+                        remaining       .eq(remaining + 1),
+                    ]
+
+                    with m.If(remaining == self.sample_depth - 1):
+                        m.next = "ARMED"
+
+        # Present the entry at the read address, prefetching the next one as it's taken.
+        with m.If(self.stream.valid & self.stream.ready):
+            m.d.comb += read_port.addr.eq(read_address + 1)
+        with m.Elif(self.sampling):
+            m.d.comb += read_port.addr.eq(write_address + 1)
+        with m.Else():
+            m.d.comb += read_port.addr.eq(read_address)
+
+        m.d.comb += self.stream.payload.eq(read_port.data)
+
+        return m
+
+
+class HyperRAMILACapture(_ILACaptureBase):
+    """ Triggered sample capture into a ring of 16-bit words on Wishbone, normally HyperRAM
+
+    Entries are built as in ILACapture, queued in a FIFO and written to 'bus', whose
+    address space is exactly the ring. Each entry is padded to a power-of-two number
+    of words and stored low word first. Once the window has been written, it is read
+    back, oldest first, and streamed out a word at a time.
+
+    The FIFO absorbs bursts of entries, but on average they can't arrive faster than
+    the memory accepts words; decimation and RLE keep the rate down. A window that
+    lost entries to a full FIFO is dumped with 'overflow' set.
+
+    The ring must fit within the memory's 'ram_addr_width' address bits.
+    """
+
+    def __init__(self, *, fifo_depth=256, max_outstanding=4, ram_addr_width=22, **kwargs):
+        super().__init__(**kwargs)
+
+        self.fifo_depth      = fifo_depth
+        self.max_outstanding = max_outstanding
+
+        self.words_per_entry = 1 << log2_int((self.entry_width + 15) // 16, need_pow2=False)
+        self.bytes_per_entry = 2 * self.words_per_entry
+        self.addr_width      = log2_int(self.sample_depth * self.words_per_entry)
+
+        if self.addr_width > ram_addr_width:
+            raise ValueError("A depth of {} entries of {} words needs {} address bits, but the "
+                             "memory only has {}"
+                             .format(self.sample_depth, self.words_per_entry, self.addr_width,
+                                     ram_addr_width))
+
+        self._writer_bus = wishbone.Interface(addr_width=self.addr_width, data_width=16,
+            features={"stall"})
+        self._reader     = WishboneDMAReader(addr_width=self.addr_width, data_width=16,
+            max_outstanding=max_outstanding, burst=False)
+        self._arbiter    = PriorityArbiter(addr_width=self.addr_width, data_width=16,
+            features={"stall"})
+        self._arbiter.add(self._writer_bus)
+        self._arbiter.add(self._reader.bus)
+
+        self.bus      = self._arbiter.bus
+
+        self.overflow = Signal()
+        self.stream   = BasicStream(16)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.fifo    = fifo    = SyncFIFOBuffered(width=self.entry_width, depth=self.fifo_depth)
+        m.submodules.reader  = reader  = self._reader
+        m.submodules.arbiter = arbiter = self._arbiter
+
+        word_bits    = log2_int(self.words_per_entry)
+        total_words  = self.sample_depth * self.words_per_entry
+
+        enqueue_index = Signal(range(self.sample_depth))
+        read_index    = Signal(range(self.sample_depth))
+        remaining     = Signal(range(self.sample_depth + 1))
+        words_out     = Signal(range(total_words))
+
+        def write():
+            m.d.comb += fifo.w_en.eq(1)
+            # Dropped entries aren't counted, so the ring stays in step with the FIFO.
+            with m.If(fifo.w_rdy):
+                m.d.sync += enqueue_index.eq(enqueue_index + 1)
+            with m.Else():
+                m.d.sync += self.overflow.eq(1)
+
+        strobe, entry, current_valid, record = self._elaborate_entries(m, write=write)
+
+        m.d.comb += fifo.w_data.eq(entry)
+
+        # Writer
+
+        bus          = self._writer_bus
+        write_entry  = Signal(range(self.sample_depth))
+        write_word   = Signal(word_bits)
+        pending      = Signal(range(self.max_outstanding + 1))
+        padded_entry = Signal(16 * self.words_per_entry)
+
+        did_stb = Signal()
+        did_ack = Signal()
+
+        m.d.comb += [
+            padded_entry        .eq(fifo.r_data),
+
+            bus.adr             .eq(Cat(write_word, write_entry)),
+            bus.we              .eq(1),
+            bus.sel             .eq(Repl(1, len(bus.sel))),
+            bus.stb             .eq(fifo.r_rdy & (pending < self.max_outstanding)),
+            bus.cyc             .eq(bus.stb | (pending != 0)),
+
+            did_stb             .eq(bus.cyc & bus.stb & ~bus.stall),
+            did_ack             .eq(bus.cyc & bus.ack),
+        ]
+
+        if word_bits:
+            m.d.comb += bus.dat_w.eq(padded_entry.word_select(write_word, 16))
+        else:
+            m.d.comb += bus.dat_w.eq(padded_entry)
+
+        with m.If(did_stb & ~did_ack):
+            m.d.sync += pending.eq(pending + 1)
+        with m.Elif(~did_stb & did_ack):
+            m.d.sync += pending.eq(pending - 1)
+
+        with m.If(did_stb):
+            m.d.sync += write_word.eq(write_word + 1)
+
+            with m.If(write_word == self.words_per_entry - 1):
+                m.d.comb += fifo.r_en.eq(1)
+                m.d.sync += write_entry.eq(write_entry + 1)
+
+        # Capture
+
+        with m.FSM():
+
+            with m.State("ARMED"):
+                with m.If(self._elaborate_armed(m, strobe=strobe, record=record)):
+                    m.d.sync += remaining.eq(self.sample_depth - self.samples_pretrigger)
+                    m.next = "CAPTURE"
+
+            with m.State("CAPTURE"):
+                m.d.comb += self.sampling.eq(1)
+
+                with m.If(remaining == 1):
+                    # The entry in progress is the last one of the window.
+                    write()
+                    m.d.sync += [
+                        read_index      .eq(enqueue_index + 1),
+                        current_valid   .eq(0),
+                        remaining       .eq(0),
+                    ]
+                    m.next = "DRAIN"
+
+                with m.Elif(strobe):
+                    with m.If(record()):
+                        m.d.sync += remaining.eq(remaining - 1)
+
+            # Wait for the window to reach memory before reading it back.
+            with m.State("DRAIN"):
+                m.d.comb += [
+                    reader.descriptor.address   .eq(Cat(Const(0, word_bits), read_index)),
+                    reader.descriptor.length    .eq(total_words),
+                    reader.descriptor.valid     .eq((fifo.level == 0) & (pending == 0)),
+                ]
+
+                with m.If(reader.descriptor.valid & reader.descriptor.ready):
+                    m.d.sync += words_out.eq(0)
+                    m.next = "DUMP"
+
+            with m.State("DUMP"):
+                m.d.comb += [
+                    self.complete       .eq(1),
+                    self.stream.payload .eq(reader.sink.payload),
+                    self.stream.valid   .eq(reader.sink.valid),
+                    self.stream.first   .eq(words_out == 0),
+                    self.stream.last    .eq(words_out == total_words - 1),
+                    reader.sink.ready   .eq(self.stream.ready),
+                ]
+
+                with m.If(self.stream.valid & self.stream.ready):
+                    m.d.sync += words_out.eq(words_out + 1)
+
+                    with m.If(self.stream.last):
+                        m.d.sync += self.overflow.eq(0)
+                        m.next = "ARMED"
+
+        return m
 
 
 class HomeInvaderILA(Elaboratable):
+    """ Integrated logic analyzer that streams its captures out over FT245
+
+    The ILA is triggered by the 'trigger' input, or by the stages given in 'triggers'
+    (see ILATrigger). Capture options are passed on to the capture backend.
+
+    With storage='bram', entries are held in block RAM (ILACapture), which limits the
+    depth to a few thousand. With storage='hyperram', they're written to the HyperRAM
+    (HyperRAMILACapture), allowing depths of millions of samples; the RAM then runs in
+    the ILA's domain.
+    """
 
-    def __init__(self, *, signals, sample_depth, **kwargs):
-        # Extract the domain from our keyword arguments, and then translate it to sync
-        # before we pass it back below. We'll use a DomainRenamer at the boundary to
-        # handle non-sync domains.
-        self.domain = kwargs.get('domain', 'sync')
-        kwargs['domain'] = 'sync'
+    def __init__(self, *, signals, sample_depth, domain='sync', sample_rate=60e6,
+                 samples_pretrigger=1, decimation=1, rle=False, run_width=8, triggers=None,
+                 storage='bram'):
+        self.domain  = domain
+        self.storage = storage
 
-        # Create our core integrated logic analyzer.
-        self.ila = StreamILA(
-            signals=signals,
+        capture_kwargs = dict(
+            sample_width=len(Cat(signals)),
             sample_depth=sample_depth,
-            **kwargs)
+            samples_pretrigger=samples_pretrigger,
+            decimation=decimation,
+            rle=rle,
+            run_width=run_width)
 
-        # Copy some core parameters from our inner ILA.
-        self.signals          = signals
-        self.sample_width     = self.ila.sample_width
-        self.sample_depth     = self.ila.sample_depth
-        self.sample_rate      = self.ila.sample_rate
-        self.sample_period    = self.ila.sample_period
-        self.bits_per_sample  = self.ila.bits_per_sample
-        self.bytes_per_sample = self.ila.bytes_per_sample
+        if storage == 'bram':
+            self.capture = ILACapture(**capture_kwargs)
+        elif storage == 'hyperram':
+            self.capture = HyperRAMILACapture(**capture_kwargs)
+        else:
+            raise ValueError("Unknown ILA storage {!r}".format(storage))
 
-        # Expose our ILA's trigger and status ports directly.
-        self.trigger  = self.ila.trigger
-        self.sampling = self.ila.sampling
-        self.complete = self.ila.complete
+        self.triggers = ILATrigger(triggers) if triggers else None
+
+        self.signals            = signals
+        self.sample_width       = self.capture.sample_width
+        self.sample_depth       = sample_depth
+        self.sample_rate        = sample_rate / decimation
+        self.sample_period      = 1 / self.sample_rate
+        self.rle                = rle
+        self.run_width          = self.capture.run_width
+        self.bits_per_sample    = 2 ** bits_for(self.capture.entry_width - 1)
+        self.bytes_per_sample   = self.capture.bytes_per_entry
+
+        self.trigger  = Signal()
+        self.sampling = self.capture.sampling
+        self.complete = self.capture.complete
 
 
     def elaborate(self, platform):
         m  = Module()
 
-        m.submodules.ila   = ila   = self.ila
-        m.submodules.iface = iface = FT245Interface()
-        m.submodules.dc    = dc    = ByteDownConverter(byte_width=self.bytes_per_sample)
+        m.submodules.capture = capture = self.capture
+        m.submodules.iface   = iface   = FT245Interface()
+        m.submodules.dc      = dc      = ByteDownConverter(byte_width=(len(capture.stream.payload) + 7) // 8)
+
+        if self.storage == 'hyperram':
+            m.submodules.ram        = ram        = HyperRAMWishboneInterface(bus=platform.request('ram'))
+            m.submodules.translator = translator = Translator(sub_bus=ram.bus, base_addr=0,
+                                                              addr_width=capture.addr_width,
+                                                              features={"stall"})
+            m.d.comb += capture.bus.connect(translator.bus)
+
+        trigger = self.trigger
+        if self.triggers is not None:
+            m.submodules.triggers = self.triggers
+            trigger = trigger | self.triggers.trigger
 
         usb_fifo = platform.request('usb_fifo')
 
         m.d.comb += [
-            dc.source.payload   .eq(ila.stream.payload),
-            dc.source.valid     .eq(ila.stream.valid),
-            ila.stream.ready    .eq(dc.source.ready),
+            capture.sample      .eq(Cat(self.signals)),
+            capture.trigger     .eq(trigger),
+
+            dc.source.payload   .eq(capture.stream.payload),
+            dc.source.valid     .eq(capture.stream.valid),
+            capture.stream.ready.eq(dc.source.ready),
 
             dc.sink             .connect(iface.tx),
             iface.bus           .connect(usb_fifo),
@@ -59,6 +542,68 @@ class HomeInvaderILA(Elaboratable):
 
         return m
 
+class ILASampleDecoder:
+    """ Unpacks raw ILA captures into an integer array per signal, using NumPy
+
+    Entries are decoded all at once rather than sample by sample. Run-length encoded
+    entries are left compressed: each carries the cycle on which it begins and the
+    number of cycles it covers, and 'expand' repeats them out if needed.
+    """
+
+    def __init__(self, ila):
+        self.names            = [signal.name for signal in ila.signals]
+        self.widths           = [len(signal) for signal in ila.signals]
+        self.sample_width     = ila.sample_width
+        self.run_width        = ila.run_width
+        self.bytes_per_sample = ila.bytes_per_sample
+
+    def decode(self, data):
+        """ Returns the (cycles, runs, values) arrays of a capture; 'values' maps names to arrays """
+        import numpy as np
+
+        raw = np.frombuffer(data, dtype=np.uint8)
+        raw = raw[:len(raw) - len(raw) % self.bytes_per_sample]
+        bits = np.unpackbits(raw.reshape(-1, self.bytes_per_sample), axis=1, bitorder='little')
+
+        values   = {}
+        position = 0
+        for name, width in zip(self.names, self.widths):
+            values[name] = self._pack(bits[:, position:position + width])
+            position += width
+
+        if self.run_width:
+            run_bits = bits[:, self.sample_width:self.sample_width + self.run_width]
+            runs = self._pack(run_bits).astype(np.int64) + 1
+        else:
+            runs = np.ones(len(bits), dtype=np.int64)
+
+        cycles = np.cumsum(runs) - runs
+        return cycles, runs, values
+
+    @staticmethod
+    def expand(runs, values):
+        """ Repeats each entry's values once for every cycle of its run """
+        import numpy as np
+        return {name: np.repeat(array, runs) for name, array in values.items()}
+
+    @staticmethod
+    def _pack(bits):
+        """ Converts rows of little-endian bits into integers """
+        import numpy as np
+
+        width = bits.shape[1]
+        if width <= 64:
+            padded = np.zeros((len(bits), 64), dtype=np.uint8)
+            padded[:, :width] = bits
+            return np.packbits(padded, axis=1, bitorder='little').view('<u8').ravel()
+
+        # Wider than a machine word; build Python integers, a word at a time.
+        result = np.zeros(len(bits), dtype=object)
+        for offset in range(0, width, 64):
+            result += ILASampleDecoder._pack(bits[:, offset:offset + 64]).astype(object) << offset
+        return result
+
+
 class HomeInvaderILAFrontend(ILAFrontend):
     """ UART-based ILA transport.
     Parameters
@@ -75,29 +620,407 @@ class HomeInvaderILAFrontend(ILAFrontend):
         self._port = pyftdi.serialext.serial_for_url('ftdi://ftdi:2232h:FT5RTNBA/1', baudrate=3000000)
         self._port.reset_input_buffer()
 
+        self.decoder = ILASampleDecoder(ila)
+
+        self.cycles  = None
+        self.runs    = None
+        self.values  = None
+
         super().__init__(ila)
 
 
-    def _split_samples(self, all_samples):
-        """ Returns an iterator that iterates over each sample in the raw binary of samples. """
-        from apollo_fpga.support.bits import bits
+    def _read_samples(self):
+        """ Reads the raw bytes of a capture. """
 
         sample_width_bytes = self.ila.bytes_per_sample
+        total_to_read      = self.ila.sample_depth * sample_width_bytes
 
-        # Iterate over each sample, and yield its value as a bits object.
-        for i in range(0, len(all_samples), sample_width_bytes):
-            raw_sample    = all_samples[i:i + sample_width_bytes]
-            sample_length = len(Cat(self.ila.signals))
+        return self._port.read(total_to_read)
 
-            yield bits.from_bytes(raw_sample, length=sample_length, byteorder='little')
 
+    def refresh(self):
+        """ Reads a capture and decodes it into per-signal arrays. """
+        self.cycles, self.runs, self.values = self.decoder.decode(self._read_samples())
 
-    def _read_samples(self):
-        """ Reads a set of ILA samples, and returns them. """
 
-        sample_width_bytes = self.ila.bytes_per_sample
-        total_to_read      = self.ila.sample_depth * sample_width_bytes
+    def enumerate_samples(self):
+        """ Yields a (timestamp, {name: bits}) pair for every sampled cycle. """
+        from apollo_fpga.support.bits import bits
+
+        if self.values is None:
+            self.refresh()
+
+        expanded = self.decoder.expand(self.runs, self.values)
+        widths   = dict(zip(self.decoder.names, self.decoder.widths))
+
+        for cycle in range(int(self.runs.sum())):
+            sample = {name: bits.from_int(int(array[cycle]), length=widths[name])
+                      for name, array in expanded.items()}
+            yield cycle * self.ila.sample_period, sample
+
+
+    def emit_vcd(self, filename, *, gtkw_filename=None, add_clock=True):
+        """ Writes the capture to a VCD file, recording only the changes of each signal. """
+        import numpy as np
+
+        if self.values is None:
+            self.refresh()
+
+        names     = self.decoder.names
+        widths    = self.decoder.widths
+        arrays    = [self.values[name] for name in names]
+        period_ps = self.ila.sample_period * 1e12
+
+        # Gather an event for every value change, as (time, signal, entry) rows.
+        times, signals, entries = [], [], []
+        for index, array in enumerate(arrays):
+            changed = np.ones(len(array), dtype=bool)
+            changed[1:] = array[1:] != array[:-1]
+            changed_entries = np.flatnonzero(changed)
+
+            times.append(np.rint(self.cycles[changed_entries] * period_ps).astype(np.int64))
+            signals.append(np.full(len(changed_entries), index))
+            entries.append(changed_entries)
+
+        # The clock is an extra signal whose 'entry' is its level.
+        if add_clock:
+            edges = np.arange(2 * int(self.runs.sum()))
+            times.append(np.rint(edges * period_ps / 2).astype(np.int64))
+            signals.append(np.full(len(edges), -1))
+            entries.append((edges + 1) % 2)
+
+        times   = np.concatenate(times)
+        order   = np.argsort(times, kind='stable')
+        times   = times[order]
+        signals = np.concatenate(signals)[order]
+        entries = np.concatenate(entries)[order]
+
+        identifiers = [self._vcd_identifier(i) for i in range(len(names) + 1)]
+
+        with open(filename, 'w') as f:
+            f.write("$timescale 1 ps $end\n$scope module ila $end\n")
+            for name, width, identifier in zip(names, widths, identifiers):
+                f.write(f"$var wire {width} {identifier} {name} $end\n")
+            if add_clock:
+                f.write(f"$var wire 1 {identifiers[-1]} ila_clock $end\n")
+            f.write("$upscope $end\n$enddefinitions $end\n")
+
+            last_time = None
+            for time, signal, entry in zip(times.tolist(), signals.tolist(), entries.tolist()):
+                if time != last_time:
+                    f.write(f"#{time}\n")
+                    last_time = time
+
+                if signal < 0:
+                    f.write(f"{entry}{identifiers[-1]}\n")
+                else:
+                    f.write(f"b{int(arrays[signal][entry]):b} {identifiers[signal]}\n")
+
+        if gtkw_filename:
+            with open(gtkw_filename, 'w') as f:
+                f.write(f'[dumpfile] "{filename}"\n[treeopen] ila.\n')
+                if add_clock:
+                    f.write("ila.ila_clock\n")
+                for name, width in zip(names, widths):
+                    f.write(f"ila.{name}[{width - 1}:0]\n" if width > 1 else f"ila.{name}\n")
+
+
+    def emit_fst(self, filename, *, add_clock=True):
+        """ Writes the capture to an FST file, converting through vcd2fst. """
+        import os
+        import subprocess
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            vcd_filename = os.path.join(tempdir, 'ila.vcd')
+            self.emit_vcd(vcd_filename, add_clock=add_clock)
+            subprocess.run(['vcd2fst', vcd_filename, filename], check=True)
+
+
+    @staticmethod
+    def _vcd_identifier(index):
+        """ Returns the short printable identifier of the given VCD variable. """
+        identifier = ''
+        while True:
+            identifier += chr(33 + index % 94)
+            index //= 94
+            if not index:
+                return identifier
+
+
+class ILATriggerTest(MultiProcessTestCase):
+
+    def test_sequence(self):
+        value = Signal(8)
+        strobe = Signal()
+
+        dut = ILATrigger([Pattern(value, 0x40, mask=0xF0), Edge(strobe)])
+
+        def process():
+            # The edge alone doesn't fire the trigger...
+            yield strobe.eq(1)
+            yield
+            yield Settle()
+            self.assertEqual((yield dut.trigger), 0)
+            yield strobe.eq(0)
+
+            # ... but it does after the pattern has matched.
+            yield value.eq(0x4C)
+            yield
+            yield value.eq(0)
+            yield
+            yield strobe.eq(1)
+            yield Settle()
+            self.assertEqual((yield dut.trigger), 1)
+            yield
+            yield Settle()
+            self.assertEqual((yield dut.trigger), 0)
+
+        with self.simulate(dut, traces=[value, strobe, dut.trigger]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(process)
+
+
+class ILACaptureTest(MultiProcessTestCase):
+
+    def test_rle(self):
+        dut = ILACapture(sample_width=8, sample_depth=8, samples_pretrigger=2, rle=True, run_width=4)
+
+        stream_driver = StreamDriver(dut.stream)
+
+        def sample_process():
+            # Each value is held for three cycles.
+            for cycle in range(200):
+                yield dut.sample.eq(cycle // 3)
+                yield dut.trigger.eq(cycle == 30)
+                yield
+
+        def stream_process():
+            yield from stream_driver.begin()
+            entries = yield from stream_driver.consume(8)
+
+            samples = [entry & 0xFF for entry in entries]
+            runs    = [entry >> 8 for entry in entries]
+
+            # The triggering sample begins the third entry, and every entry after it
+            # covers a complete run of three cycles (except the final one, cut short).
+            self.assertEqual(samples[2:], list(range(10, 16)))
+            self.assertEqual(runs[2:-1], [2] * 5)
+
+        with self.simulate(dut, traces=[dut.sample, dut.trigger, dut.stream]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(sample_process)
+            sim.add_sync_process(stream_process)
+
+
+class HyperRAMILACaptureTest(MultiProcessTestCase):
+
+    def test_decimated(self):
+        dut = HyperRAMILACapture(sample_width=8, sample_depth=16, samples_pretrigger=4,
+                                 decimation=4, fifo_depth=8)
+
+        sub_emulator = RecordingWishboneEmulator(dut.bus, memory=True, delay=2, max_outstanding=2)
+        stream_driver = StreamDriver(dut.stream)
+
+        def sample_process():
+            for cycle in range(400):
+                yield dut.sample.eq(cycle)
+                yield dut.trigger.eq(cycle == 101)
+                yield
+
+        def stream_process():
+            yield from stream_driver.begin()
+
+            while not (yield dut.complete):
+                yield
+            self.assertEqual((yield dut.overflow), 0)
+
+            entries = yield from stream_driver.consume(16)
+
+            # Samples are four cycles apart, and the fifth was the first after the trigger.
+            self.assertEqual([b - a for a, b in zip(entries, entries[1:])], [4] * 15)
+            self.assertIn(entries[4], range(101, 106))
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[dut.sample, dut.trigger, dut.stream]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(sample_process)
+            sim.add_sync_process(stream_process)
+            sim.add_sync_process(sub_process)
+
+    def test_multiword_entries(self):
+        dut = HyperRAMILACapture(sample_width=24, sample_depth=16, samples_pretrigger=4,
+                                 decimation=4, fifo_depth=8)
+        self.assertEqual(dut.words_per_entry, 2)
+
+        sub_emulator = RecordingWishboneEmulator(dut.bus, memory=True, delay=2, max_outstanding=2)
+        stream_driver = StreamDriver(dut.stream)
+
+        def sample_process():
+            for cycle in range(400):
+                yield dut.sample.eq(0xA50000 | cycle)
+                yield dut.trigger.eq(cycle == 101)
+                yield
+
+        def stream_process():
+            yield from stream_driver.begin()
+
+            while not (yield dut.complete):
+                yield
+            self.assertEqual((yield dut.overflow), 0)
+
+            words = yield from stream_driver.consume(32)
+
+            # Each entry is stored, and streamed, low word first.
+            entries = [low | (high << 16) for low, high in zip(words[0::2], words[1::2])]
+            self.assertTrue(all(entry >> 16 == 0xA5 for entry in entries))
+            self.assertEqual([b - a for a, b in zip(entries, entries[1:])], [4] * 15)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[dut.sample, dut.trigger, dut.stream]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(sample_process)
+            sim.add_sync_process(stream_process)
+            sim.add_sync_process(sub_process)
+
+    def test_overflow(self):
+        dut = HyperRAMILACapture(sample_width=8, sample_depth=16, samples_pretrigger=4,
+                                 fifo_depth=4)
+
+        # The memory takes a word every several cycles, while entries arrive every cycle.
+        sub_emulator = RecordingWishboneEmulator(dut.bus, memory=True, delay=8, max_outstanding=1)
+        stream_driver = StreamDriver(dut.stream)
+
+        def sample_process():
+            for cycle in range(400):
+                yield dut.sample.eq(cycle)
+                yield dut.trigger.eq(cycle == 101)
+                yield
+
+        def stream_process():
+            yield from stream_driver.begin()
+
+            while not (yield dut.complete):
+                yield
+            self.assertEqual((yield dut.overflow), 1)
+
+            yield from stream_driver.consume(16)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[dut.sample, dut.trigger, dut.stream]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(sample_process)
+            sim.add_sync_process(stream_process)
+            sim.add_sync_process(sub_process)
+
+    def test_too_deep(self):
+        with self.assertRaises(ValueError):
+            HyperRAMILACapture(sample_width=24, sample_depth=2**22)
+
+        HyperRAMILACapture(sample_width=16, sample_depth=2**22)
+
+
+def _ila_layout(signals, *, run_width=0, sample_period=1e-9):
+    """ Stands in for a HomeInvaderILA, describing only the layout of its entries """
+    sample_width = sum(len(signal) for signal in signals)
+    return SimpleNamespace(
+        signals=signals,
+        sample_width=sample_width,
+        run_width=run_width,
+        bytes_per_sample=(sample_width + run_width + 7) // 8,
+        sample_period=sample_period)
+
+
+class ILASampleDecoderTest(unittest.TestCase):
+
+    def test_decode(self):
+        decoder = ILASampleDecoder(_ila_layout([Signal(4, name="a"), Signal(8, name="b")]))
+
+        # 'b' straddles the byte boundary; the trailing partial entry is ignored.
+        entries = [0x3 | (0xA5 << 4), 0xF | (0x01 << 4)]
+        data = b''.join(entry.to_bytes(2, 'little') for entry in entries) + b'\xFF'
+
+        cycles, runs, values = decoder.decode(data)
+
+        self.assertEqual(list(cycles),      [0, 1])
+        self.assertEqual(list(runs),        [1, 1])
+        self.assertEqual(list(values['a']), [0x3, 0xF])
+        self.assertEqual(list(values['b']), [0xA5, 0x01])
+
+    def test_wide(self):
+        decoder = ILASampleDecoder(_ila_layout([Signal(72, name="a"), Signal(8, name="b")]))
+
+        a = 0x89_1234_5678_9ABC_DEF0
+        data = (a | (0x7F << 72)).to_bytes(10, 'little')
+
+        _, _, values = decoder.decode(data)
+
+        self.assertEqual(int(values['a'][0]), a)
+        self.assertEqual(int(values['b'][0]), 0x7F)
+
+    def _rle_capture(self):
+        decoder = ILASampleDecoder(_ila_layout([Signal(4, name="a")], run_width=4))
+
+        # Each entry holds its value, then the length of its run less one.
+        entries = [(0x1, 3), (0x2, 1), (0x5, 16)]
+        data = bytes(value | ((run - 1) << 4) for value, run in entries)
+
+        return decoder, decoder.decode(data)
+
+    def test_rle(self):
+        decoder, (cycles, runs, values) = self._rle_capture()
+
+        self.assertEqual(list(cycles),      [0, 3, 4])
+        self.assertEqual(list(runs),        [3, 1, 16])
+        self.assertEqual(list(values['a']), [0x1, 0x2, 0x5])
+
+        expanded = decoder.expand(runs, values)
+        self.assertEqual(list(expanded['a']), [0x1] * 3 + [0x2] + [0x5] * 16)
+
+    def _emit_vcd(self, **kwargs):
+        import os
+        import tempfile
+
+        decoder, (cycles, runs, values) = self._rle_capture()
+
+        # The frontend's port is only needed to read a capture, which is supplied here.
+        frontend = HomeInvaderILAFrontend.__new__(HomeInvaderILAFrontend)
+        frontend.ila     = _ila_layout([Signal(4, name="a")], run_width=4, sample_period=1e-9)
+        frontend.decoder = decoder
+        frontend.cycles, frontend.runs, frontend.values = cycles, runs, values
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, 'ila.vcd')
+            frontend.emit_vcd(filename, **kwargs)
+
+            with open(filename) as f:
+                lines = f.read().splitlines()
+
+        return lines[lines.index("$enddefinitions $end") + 1:], lines
+
+    def test_emit_vcd(self):
+        changes, lines = self._emit_vcd(add_clock=False)
+
+        self.assertIn("$var wire 4 ! a $end", lines)
+
+        # Only the changes are written, each at the cycle on which its run begins.
+        self.assertEqual(changes, ["#0", "b1 !", "#3000", "b10 !", "#4000", "b101 !"])
+
+    def test_emit_vcd_clock(self):
+        changes, lines = self._emit_vcd()
+
+        self.assertIn('$var wire 1 " ila_clock $end', lines)
 
-        # Fetch all of our samples from the given device.
-        all_samples = self._port.read(total_to_read)
-        return list(self._split_samples(all_samples))
+        # The clock rises at the start of each of the 20 cycles, and falls halfway through.
+        self.assertEqual(changes[:5], ["#0", "b1 !", '1"', "#500", '0"'])
+        self.assertEqual(sum(line.endswith('"') for line in changes), 40)
+        self.assertEqual(changes[-2:], ["#19500", '0"'])
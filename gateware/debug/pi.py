@@ -0,0 +1,364 @@
+import unittest
+
+from nmigen import *
+from nmigen.sim import *
+
+from n64.burst import BurstBus
+from soc.stream import BasicStream, StreamFIFO
+
+from test import *
+from test.driver.stream import StreamDriver
+
+
+class PITransactionSniffer(Elaboratable):
+    """ Emits a record for every PI burst seen on a BurstBus
+
+    The bus is only observed. Each record holds, LSB first: the 16-bit SYNC marker,
+    the 30-bit word address at which the burst began, its late_block and late_read
+    flags, the number of words read (16 bits), the number of records dropped just
+    before it (16 bits) and the cycle on which the burst began (32 bits). The marker
+    lets a reader that joins the stream mid-record find the record boundaries.
+
+    Records queue in a FIFO on their way out; while it's full, they're dropped and
+    counted instead, so a slow link never stalls the PI.
+    """
+
+    RECORD_BYTES = 14
+    SYNC         = 0xA55A
+
+    def __init__(self, *, depth=16):
+        self.depth = depth
+
+        self.bus        = BurstBus()
+        self.late_block = Signal()
+        self.late_read  = Signal()
+
+        self.stream     = BasicStream(8 * self.RECORD_BYTES)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.fifo = fifo = StreamFIFO(width=8 * self.RECORD_BYTES, depth=self.depth)
+
+        timestamp       = Signal(32)
+        active          = Signal()
+        base            = Signal(30)
+        count           = Signal(16)
+        started         = Signal(32)
+        dropped         = Signal(16)
+        late_block      = Signal()
+        late_read       = Signal()
+        late_block_seen = Signal()
+
+        did_load = Signal()
+        did_op   = Signal()
+
+        m.d.comb += [
+            did_load            .eq(self.bus.load & ~self.bus.blk_stall),
+            did_op              .eq(self.bus.cyc & self.bus.stb & ~self.bus.stall),
+
+            fifo.source.payload .eq(Cat(Const(self.SYNC, 16), base, late_block, late_read,
+                                        count, dropped, started)),
+            fifo.sink           .connect(self.stream),
+        ]
+
+        m.d.sync += timestamp.eq(timestamp + 1)
+
+        # A late block is flagged while the block is still waiting to begin.
+        with m.If(self.late_block):
+            m.d.sync += late_block_seen.eq(1)
+
+        with m.If(did_load):
+            m.d.sync += [
+                active          .eq(1),
+                base            .eq(self.bus.base),
+                count           .eq(0),
+                started         .eq(timestamp),
+                late_block      .eq(late_block_seen),
+                late_read       .eq(0),
+                late_block_seen .eq(0),
+            ]
+
+        with m.Elif(active):
+            with m.If(did_op & ~count.all()):
+                m.d.sync += count.eq(count + 1)
+
+            with m.If(self.late_read):
+                m.d.sync += late_read.eq(1)
+
+            with m.If(~self.bus.blk):
+                m.d.comb += fifo.source.valid.eq(1)
+                m.d.sync += active.eq(0)
+
+                with m.If(fifo.source.ready):
+                    m.d.sync += dropped.eq(0)
+                with m.Elif(~dropped.all()):
+                    m.d.sync += dropped.eq(dropped + 1)
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.late_block,
+            self.late_read,
+            self.stream,
+        ]
+
+
+class PISnifferDecoder:
+    """ Decodes the record stream of a PITransactionSniffer on the host
+
+    'clock_frequency' is that of the sniffer's domain, used to convert timestamps into
+    seconds. Timestamps wrap every 2**32 cycles; bursts are assumed to be closer
+    together than that.
+
+    Data may be passed in chunks of any size; a partial record is held over to the
+    next call. Records are located by their SYNC markers. Until two consecutive markers
+    are found, and again after any record whose marker is wrong, bytes are skipped
+    (and counted in 'skipped') one at a time.
+    """
+
+    def __init__(self, *, clock_frequency=80e6):
+        import numpy as np
+
+        self.clock_frequency = clock_frequency
+
+        self._dtype = np.dtype([
+            ('sync',        '<u2'),
+            ('address',     '<u4'),
+            ('count',       '<u2'),
+            ('dropped',     '<u2'),
+            ('timestamp',   '<u4'),
+        ])
+
+        self._sync = PITransactionSniffer.SYNC.to_bytes(2, 'little')
+
+        self._pending        = b''
+        self._synced         = False
+        self._last_timestamp = None
+        self._epoch          = 0
+
+        self.skipped = 0
+
+    def _align(self, data):
+        """ Returns the records in 'data' that follow their markers, holding over the rest """
+        import numpy as np
+
+        record_bytes = self._dtype.itemsize
+        chunks = []
+
+        offset = 0
+        while len(data) - offset >= record_bytes:
+            if not self._synced:
+                start = data.find(self._sync, offset)
+                if start < 0:
+                    # Keep a byte that could begin a marker split across calls.
+                    start = max(offset, len(data) - 1)
+                self.skipped += start - offset
+                offset = start
+
+                # Wait for the following record's marker to confirm the boundary.
+                following = data[offset + record_bytes:offset + record_bytes + len(self._sync)]
+                if len(following) < len(self._sync):
+                    break
+                if following != self._sync:
+                    self.skipped += 1
+                    offset += 1
+                    continue
+
+                self._synced = True
+
+            raw = np.frombuffer(data, dtype=self._dtype, offset=offset,
+                                count=(len(data) - offset) // record_bytes)
+
+            bad = np.flatnonzero(raw['sync'] != PITransactionSniffer.SYNC)
+            good = bad[0] if len(bad) else len(raw)
+
+            chunks.append(raw[:good])
+            offset += good * record_bytes
+
+            if len(bad):
+                self._synced = False
+
+        self._pending = data[offset:]
+        return np.concatenate(chunks) if chunks else np.empty(0, dtype=self._dtype)
+
+    def decode(self, data):
+        """ Returns a structured array of the records in 'data', with unwrapped timestamps """
+        import numpy as np
+
+        raw = self._align(self._pending + bytes(data))
+
+        records = np.empty(len(raw), dtype=[
+            ('address',     '<u4'),
+            ('count',       '<u2'),
+            ('dropped',     '<u2'),
+            ('late_block',  '?'),
+            ('late_read',   '?'),
+            ('cycle',       '<u8'),
+        ])
+
+        # The record holds a word address; report byte addresses.
+        records['address']    = (raw['address'] & 0x3FFFFFFF) << 2
+        records['late_block'] = (raw['address'] >> 30) & 1
+        records['late_read']  = (raw['address'] >> 31) & 1
+        records['count']      = raw['count']
+        records['dropped']    = raw['dropped']
+
+        # Unwrap timestamps, carrying the epoch across calls.
+        timestamps = raw['timestamp'].astype(np.uint64)
+        previous = np.empty_like(timestamps)
+        if len(timestamps):
+            previous[0]  = timestamps[0] if self._last_timestamp is None else self._last_timestamp
+            previous[1:] = timestamps[:-1]
+
+            epochs = self._epoch + np.cumsum(timestamps < previous, dtype=np.uint64)
+            records['cycle'] = (epochs << np.uint64(32)) + timestamps
+
+            self._last_timestamp = timestamps[-1]
+            self._epoch          = int(epochs[-1])
+
+        return records
+
+    def format_log(self, records):
+        """ Yields one line of text for every record """
+        for record in records:
+            flags = ''.join(flag for flag, is_set in (('B', record['late_block']),
+                                                      ('R', record['late_read'])) if is_set)
+            dropped = f" ({record['dropped']} dropped)" if record['dropped'] else ''
+
+            yield (f"{record['cycle'] / self.clock_frequency:14.9f}  "
+                   f"{record['address']:08X}  {record['count']:5} words  {flags:2}{dropped}")
+
+    @staticmethod
+    def heatmap(records, *, bucket_size=0x1000):
+        """ Returns (bucket addresses, words read) for every bucket that was accessed """
+        import numpy as np
+
+        buckets = records['address'] // bucket_size
+        addresses, inverse = np.unique(buckets, return_inverse=True)
+        words = np.bincount(inverse, weights=records['count'], minlength=len(addresses))
+
+        return addresses * bucket_size, words.astype(np.uint64)
+
+
+class PITransactionSnifferTest(MultiProcessTestCase):
+
+    def test_burst(self):
+        dut = PITransactionSniffer()
+
+        stream_driver = StreamDriver(dut.stream)
+
+        def bus_process():
+            bus = dut.bus
+
+            # The block is late to begin...
+            yield bus.blk.eq(1)
+            yield bus.load.eq(1)
+            yield bus.blk_stall.eq(1)
+            yield dut.late_block.eq(1)
+            yield
+            yield dut.late_block.eq(0)
+            yield bus.blk_stall.eq(0)
+            yield bus.base.eq(0x04000100)
+            yield
+            yield bus.load.eq(0)
+
+            # ... then reads three words.
+            for _ in range(3):
+                yield bus.cyc.eq(1)
+                yield bus.stb.eq(1)
+                yield
+                yield bus.stb.eq(0)
+                yield
+                yield bus.cyc.eq(0)
+                yield
+
+            yield bus.blk.eq(0)
+            yield
+
+        def stream_process():
+            yield from stream_driver.begin()
+            records = yield from stream_driver.consume(1)
+
+            record = records[0]
+            self.assertEqual(record & 0xFFFF, PITransactionSniffer.SYNC)
+            self.assertEqual((record >> 16) & 0x3FFFFFFF, 0x04000100)
+            self.assertEqual((record >> 46) & 0b11, 0b01)
+            self.assertEqual((record >> 48) & 0xFFFF, 3)
+            self.assertEqual((record >> 64) & 0xFFFF, 0)
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(bus_process)
+            sim.add_sync_process(stream_process)
+
+
+def _pack_record(address, count, timestamp, *, late_block=0, late_read=0, dropped=0):
+    import struct
+
+    return struct.pack('<HLHHL', PITransactionSniffer.SYNC,
+                       (address >> 2) | (late_block << 30) | (late_read << 31),
+                       count, dropped, timestamp)
+
+
+class PISnifferDecoderTest(unittest.TestCase):
+
+    def test_decode(self):
+        decoder = PISnifferDecoder()
+
+        records = decoder.decode(_pack_record(0x10001000, 3, 100, late_read=1) +
+                                 _pack_record(0x10002000, 1, 200, late_block=1, dropped=5))
+
+        self.assertEqual(list(records['address']),    [0x10001000, 0x10002000])
+        self.assertEqual(list(records['count']),      [3, 1])
+        self.assertEqual(list(records['dropped']),    [0, 5])
+        self.assertEqual(list(records['late_block']), [False, True])
+        self.assertEqual(list(records['late_read']),  [True, False])
+        self.assertEqual(decoder.skipped, 0)
+
+    def test_unwrap(self):
+        decoder = PISnifferDecoder()
+
+        first  = decoder.decode(_pack_record(0x10000000, 1, 0xFFFFFFF0) +
+                                _pack_record(0x10000000, 1, 0x00000010))
+        second = decoder.decode(_pack_record(0x10000000, 1, 0x00000020) +
+                                _pack_record(0x10000000, 1, 0x00000008))
+
+        # Each wrap, within a call or across calls, moves on an epoch.
+        self.assertEqual(list(first['cycle']),  [0xFFFFFFF0, 2**32 + 0x10])
+        self.assertEqual(list(second['cycle']), [2**32 + 0x20, 2**33 + 0x08])
+
+    def test_resync(self):
+        decoder = PISnifferDecoder()
+
+        data = b''.join(_pack_record(0x10000000 + 4 * i, i, i) for i in range(4))
+
+        # Join the stream partway into the first record, then split the rest unevenly.
+        records = [decoder.decode(data[5:20]), decoder.decode(data[20:33]), decoder.decode(data[33:])]
+
+        self.assertEqual([len(r) for r in records], [0, 1, 2])
+        self.assertEqual([int(r['count']) for chunk in records for r in chunk], [1, 2, 3])
+        self.assertEqual(decoder.skipped, 9)
+
+        # A corrupted record is skipped, and decoding picks up at the next marker.
+        corrupt = bytearray(_pack_record(0x10000000, 7, 10))
+        corrupt[0] ^= 0xFF
+        records = decoder.decode(bytes(corrupt) + _pack_record(0x10000000, 8, 20) +
+                                 _pack_record(0x10000000, 9, 30))
+
+        self.assertEqual(list(records['count']), [8, 9])
+        self.assertEqual(decoder.skipped, 9 + PITransactionSniffer.RECORD_BYTES)
+
+    def test_heatmap(self):
+        decoder = PISnifferDecoder()
+
+        records = decoder.decode(_pack_record(0x10001000, 3, 0) +
+                                 _pack_record(0x10001800, 4, 1) +
+                                 _pack_record(0x10005000, 5, 2))
+
+        addresses, words = decoder.heatmap(records, bucket_size=0x1000)
+
+        self.assertEqual(list(addresses), [0x10001000, 0x10005000])
+        self.assertEqual(list(words),     [7, 5])
@@ -1,3 +1,5 @@
+import unittest
+
 from nmigen import *
 
 from interface.ft245 import FT245Interface
@@ -32,18 +34,383 @@ class FT245Streamer(Elaboratable):
 
         return m
 
+FT245_URL = 'ftdi://ftdi:2232h:FT5RTNBA/1'
+
+
+def open_ft245_port(*, timeout=None):
+    import pyftdi.serialext
+
+    port = pyftdi.serialext.serial_for_url(FT245_URL, baudrate=3000000, timeout=timeout)
+    port.reset_input_buffer()
+    return port
+
+
+class RingBuffer:
+    """ Fixed-size byte ring between one producer and one consumer thread
+
+    Writers block while the ring is full, so memory stays bounded and a slow
+    consumer throttles the link instead of losing data. 'high_water' records the
+    fullest the ring has been.
+    """
+
+    def __init__(self, size):
+        import threading
+
+        self.size       = size
+        self.high_water = 0
+
+        self._buffer    = bytearray(size)
+        self._view      = memoryview(self._buffer)
+        self._head      = 0
+        self._tail      = 0
+        self._closed    = False
+        self._condition = threading.Condition()
+
+    def write(self, data):
+        data = memoryview(data)
+
+        while len(data):
+            with self._condition:
+                while self._head - self._tail == self.size and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+
+                start = self._head % self.size
+                count = min(len(data), self.size - (self._head - self._tail), self.size - start)
+
+                self._view[start:start + count] = data[:count]
+                self._head += count
+                self.high_water = max(self.high_water, self._head - self._tail)
+
+                self._condition.notify_all()
+
+            data = data[count:]
+
+    def peek(self, max_size):
+        """ Waits for data; returns a view of up to 'max_size' contiguous bytes, empty once closed """
+        with self._condition:
+            while self._head == self._tail and not self._closed:
+                self._condition.wait()
+
+            start = self._tail % self.size
+            count = min(self._head - self._tail, self.size - start, max_size)
+            return self._view[start:start + count]
+
+    def consume(self, count):
+        """ Releases 'count' bytes returned by peek """
+        with self._condition:
+            self._tail += count
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+
+
+class CaptureFileWriter:
+    """ Appends to a binary capture file through a memory map, a segment at a time """
+
+    def __init__(self, filename, *, segment_size=64 << 20):
+        import mmap
+
+        if segment_size % mmap.ALLOCATIONGRANULARITY:
+            raise ValueError("Segment size must be a multiple of {}".format(mmap.ALLOCATIONGRANULARITY))
+
+        self.segment_size = segment_size
+        self.length       = 0
+
+        self._file        = open(filename, 'w+b')
+        self._map         = None
+        self._map_offset  = -segment_size
+
+    def write(self, data):
+        data = memoryview(data)
+
+        while len(data):
+            position = self.length - self._map_offset
+            if self._map is None or position == self.segment_size:
+                self._next_segment()
+                position = 0
+
+            count = min(len(data), self.segment_size - position)
+            self._map[position:position + count] = data[:count]
+
+            self.length += count
+            data = data[count:]
+
+    def _next_segment(self):
+        import mmap
+
+        if self._map is not None:
+            self._map.close()
+
+        self._map_offset += self.segment_size
+        self._file.truncate(self._map_offset + self.segment_size)
+        self._map = mmap.mmap(self._file.fileno(), self.segment_size, offset=self._map_offset)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+        self._file.truncate(self.length)
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FT245Recorder:
+    """ Records an FT245 link to a binary capture file at full rate, with bounded memory
+
+    One thread reads the port in large chunks into a RingBuffer; another drains the
+    ring into a CaptureFileWriter. Nothing is decoded while recording; open the file
+    with FT245Capture afterwards. If either thread fails, the ring is closed so that
+    the other can't block on it, and the error is raised once both have stopped.
+    """
+
+    def __init__(self, port=None, *, buffer_size=64 << 20, chunk_size=1 << 16):
+        self.port        = port if port is not None else open_ft245_port(timeout=0.05)
+        self.buffer_size = buffer_size
+        self.chunk_size  = chunk_size
+
+    def record(self, filename, *, duration=None):
+        """ Records until 'duration' seconds have passed, or until interrupted; returns the byte count """
+        import threading
+        import time
+
+        ring   = RingBuffer(self.buffer_size)
+        stop   = threading.Event()
+        errors = []
+
+        def read_port():
+            try:
+                while not stop.is_set():
+                    data = self.port.read(self.chunk_size)
+                    if data:
+                        ring.write(data)
+            except Exception as error:
+                errors.append(error)
+            finally:
+                ring.close()
+
+        def write_file(writer):
+            try:
+                while True:
+                    view = ring.peek(self.chunk_size)
+                    if not len(view):
+                        return
+                    writer.write(view)
+                    ring.consume(len(view))
+            except Exception as error:
+                errors.append(error)
+                # The reader may be blocked on a full ring.
+                ring.close()
+
+        with CaptureFileWriter(filename) as writer:
+            reader_thread = threading.Thread(target=read_port, daemon=True)
+            writer_thread = threading.Thread(target=write_file, args=(writer,), daemon=True)
+
+            reader_thread.start()
+            writer_thread.start()
+
+            start_time = time.time()
+
+            try:
+                while not errors and (duration is None or time.time() - start_time < duration):
+                    time.sleep(0.5)
+                    rate = writer.length / max(time.time() - start_time, 1e-6) / 1e6
+                    print(f"\r{writer.length:>14} bytes ({rate:.2f} MB/s, "
+                          f"ring peak {ring.high_water >> 10} KiB)", end='', flush=True)
+            except KeyboardInterrupt:
+                pass
+
+            print()
+
+            stop.set()
+            reader_thread.join()
+            writer_thread.join()
+
+            if errors:
+                raise errors[0]
+
+            return writer.length
+
+
+class FT245Capture:
+    """ A recorded capture file, memory-mapped as an array of 'byte_width'-byte payloads
+
+    Payloads start 'offset' bytes into the file, for captures that began mid-payload.
+    """
+
+    def __init__(self, filename, byte_width, *, offset=0):
+        import numpy as np
+
+        self.byte_width = byte_width
+
+        try:
+            raw = np.memmap(filename, dtype=np.uint8, mode='r')
+        except ValueError:
+            # Empty files can't be mapped.
+            raw = np.zeros(0, dtype=np.uint8)
+
+        raw = raw[offset:]
+        self.payloads = raw[:len(raw) - len(raw) % byte_width].reshape(-1, byte_width)
+
+    def __len__(self):
+        return len(self.payloads)
+
+    def hex_lines(self, *, start=0, stop=None):
+        """ Yields each payload as hex, most significant byte first """
+        for payload in self.payloads[start:stop]:
+            yield bytes(payload[::-1]).hex(' ')
+
+
 class FT245Reader():
 
     def __init__(self, byte_width):
         self.byte_width = byte_width
 
-        import pyftdi.serialext
+        self._port = open_ft245_port(timeout=0.05)
+
+    def run(self, filename='capture.bin', *, duration=None):
+        print("Recording serial data (interrupt to stop)...")
+        FT245Recorder(self._port).record(filename, duration=duration)
+
+        for line in FT245Capture(filename, self.byte_width).hex_lines():
+            print(line)
+
+
+class RingBufferTest(unittest.TestCase):
+
+    def test_threads(self):
+        import threading
+
+        ring = RingBuffer(64)
+        data = bytes(i % 251 for i in range(5000))
+        received = bytearray()
+
+        def produce():
+            # Uneven chunks, larger than the ring at times, so writes wrap and block.
+            for offset in range(0, len(data), 97):
+                ring.write(data[offset:offset + 97])
+            ring.close()
+
+        def consume():
+            while True:
+                view = ring.peek(10)
+                if not len(view):
+                    return
+                received.extend(view)
+                ring.consume(len(view))
+
+        threads = [threading.Thread(target=produce), threading.Thread(target=consume)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout=10)
+
+        self.assertFalse(any(thread.is_alive() for thread in threads))
+        self.assertEqual(bytes(received), data)
+        self.assertEqual(ring.high_water, 64)
+
+    def test_close(self):
+        import threading
+
+        ring = RingBuffer(4)
+
+        # A writer blocked on the full ring returns once it's closed...
+        writer = threading.Thread(target=ring.write, args=(bytes(8),))
+        writer.start()
+        writer.join(timeout=0.2)
+        self.assertTrue(writer.is_alive())
+
+        ring.close()
+        writer.join(timeout=10)
+        self.assertFalse(writer.is_alive())
+
+        # ... and readers get the rest of the data, then nothing.
+        self.assertEqual(len(ring.peek(8)), 4)
+        ring.consume(4)
+        self.assertEqual(len(ring.peek(8)), 0)
+
+
+class CaptureFileWriterTest(unittest.TestCase):
+
+    def test_segments(self):
+        import mmap
+        import os
+        import tempfile
+
+        segment_size = mmap.ALLOCATIONGRANULARITY
+        data = os.urandom(2 * segment_size + segment_size // 2)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, 'capture.bin')
+
+            # Chunks that don't divide the segment size, so some straddle two segments.
+            with CaptureFileWriter(filename, segment_size=segment_size) as writer:
+                for offset in range(0, len(data), 1000):
+                    writer.write(data[offset:offset + 1000])
+                self.assertEqual(writer.length, len(data))
+
+            # The final segment is truncated to what was written.
+            with open(filename, 'rb') as f:
+                self.assertEqual(f.read(), data)
+
+    def test_segment_size(self):
+        import mmap
+
+        with self.assertRaises(ValueError):
+            CaptureFileWriter('unused.bin', segment_size=mmap.ALLOCATIONGRANULARITY + 1)
+
+
+class _FailingPort:
+
+    def read(self, size):
+        raise IOError("Device disconnected")
+
+
+class FT245RecorderTest(unittest.TestCase):
+
+    def test_port_error(self):
+        import os
+        import tempfile
+        import time
+
+        recorder = FT245Recorder(_FailingPort(), buffer_size=1 << 12, chunk_size=1 << 10)
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            start_time = time.time()
+
+            with self.assertRaises(IOError):
+                recorder.record(os.path.join(tempdir, 'capture.bin'), duration=30)
+
+            # The error ends the recording, rather than leaving it to run out.
+            self.assertLess(time.time() - start_time, 5)
+
+
+class FT245CaptureTest(unittest.TestCase):
+
+    def test_offset(self):
+        import os
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as tempdir:
+            filename = os.path.join(tempdir, 'capture.bin')
+            with open(filename, 'wb') as f:
+                f.write(bytes(range(11)))
+
+            capture = FT245Capture(filename, 4, offset=1)
 
-        self._port = pyftdi.serialext.serial_for_url('ftdi://ftdi:2232h:FT5RTNBA/1', baudrate=3000000)
-        self._port.reset_input_buffer()
+            # The leading byte is skipped, and the trailing partial payload dropped.
+            self.assertEqual(len(capture), 2)
+            self.assertEqual(capture.payloads.tolist(), [[1, 2, 3, 4], [5, 6, 7, 8]])
+            self.assertEqual(list(capture.hex_lines()), ["04 03 02 01", "08 07 06 05"])
 
-    def run(self):
-        print("Listening for serial data...")
-        while True:
-            payload = self._port.read(self.byte_width)
-            print(bytes(reversed(payload)).hex(' '))
+            del capture
@@ -1,10 +1,14 @@
 import struct
+import unittest
+import zlib
+from concurrent.futures import Future
 
 from nmigen import *
 from nmigen.sim import *
 from nmigen_soc import wishbone
 
 from interface.ft245 import FT245Interface
+from soc.crc import CRC32
 from soc.stream import BasicStream
 
 from test import MultiProcessTestCase
@@ -13,6 +17,32 @@ from test.emulator.wishbone import WishboneEmulator
 
 
 class StreamWishboneCommander(Elaboratable):
+    """ Performs Wishbone operations on command from a byte stream
+
+    Addresses, lengths and data are 32-bit big-endian words, and every command is
+    answered with a final 0xDD byte.
+
+        0x10 READ           address                 -> data
+        0x11 WRITE          address, data
+        0x12 BLOCK_READ     address, length         -> data * length
+        0x13 BLOCK_WRITE    address, length, data * length
+        0x14 FILL           address, length, data
+        0x15 COMPARE        address, length, data   -> number of mismatching words
+        0x16 CHECKSUM       address, length         -> CRC-32
+
+    Block commands operate on 'length' words at incrementing addresses. The checksum
+    is the zlib CRC-32 of the block's words, taken as big-endian bytes.
+    """
+
+    READ        = 0x10
+    WRITE       = 0x11
+    BLOCK_READ  = 0x12
+    BLOCK_WRITE = 0x13
+    FILL        = 0x14
+    COMPARE     = 0x15
+    CHECKSUM    = 0x16
+
+    ACK         = 0xDD
 
     def __init__(self):
         self.bus = wishbone.Interface(addr_width=32, data_width=32, features={"stall"})
@@ -23,10 +53,20 @@ class StreamWishboneCommander(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
-        count = Signal(8, reset=0)      # FIXME: Size this more appropriately later!
+        m.submodules.crc = crc = CRC32(width=32)
+
+        count = Signal(2)
 
         address = Signal(32)
+        length = Signal(32)
+        mismatches = Signal(32)
+
         perform_write = Signal()
+        block = Signal()
+        repeat = Signal()
+        compare = Signal()
+        checksum = Signal()
+        reporting = Signal()
 
         read_data = Signal(32)
         write_data = Signal(32)
@@ -39,8 +79,27 @@ class StreamWishboneCommander(Elaboratable):
             self.bus.adr            .eq(address),
             self.bus.we             .eq(perform_write),
             self.bus.dat_w          .eq(write_data),
+
+            # The first byte of each word is its most significant.
+            crc.data                .eq(Cat(self.bus.dat_r[24:32], self.bus.dat_r[16:24],
+                                            self.bus.dat_r[8:16], self.bus.dat_r[0:8])),
         ]
 
+        def begin(*, write, is_block=0, is_repeat=0, is_compare=0, is_checksum=0):
+            m.next = "ADDRESS"
+            m.d.comb += crc.clear.eq(1)
+            m.d.sync += [
+                count           .eq(3),
+                perform_write   .eq(write),
+                block           .eq(is_block),
+                repeat          .eq(is_repeat),
+                compare         .eq(is_compare),
+                checksum        .eq(is_checksum),
+                reporting       .eq(0),
+                length          .eq(1),
+                mismatches      .eq(0),
+            ]
+
         with m.FSM():
 
             with m.State("IDLE"):
@@ -48,22 +107,25 @@ class StreamWishboneCommander(Elaboratable):
 
                 with m.If(self.source.valid):
 
-                    with m.If(self.source.payload == 0x10):
-                        m.next = "ADDRESS"
-                        m.d.sync += [
-                            count           .eq(3),
-                            perform_write   .eq(0),
-                        ]
-                    with m.Elif(self.source.payload == 0x11):
-                        m.next = "ADDRESS"
-                        m.d.sync += [
-                            count           .eq(3),
-                            perform_write   .eq(1),
-                        ]
-                    with m.Else():
-                        # Invalid command
-                        # FIXME: Do something else?
-                        m.next = "IDLE"
+                    with m.Switch(self.source.payload):
+                        with m.Case(self.READ):
+                            begin(write=0)
+                        with m.Case(self.WRITE):
+                            begin(write=1)
+                        with m.Case(self.BLOCK_READ):
+                            begin(write=0, is_block=1)
+                        with m.Case(self.BLOCK_WRITE):
+                            begin(write=1, is_block=1)
+                        with m.Case(self.FILL):
+                            begin(write=1, is_block=1, is_repeat=1)
+                        with m.Case(self.COMPARE):
+                            begin(write=0, is_block=1, is_repeat=1, is_compare=1)
+                        with m.Case(self.CHECKSUM):
+                            begin(write=0, is_block=1, is_checksum=1)
+                        with m.Default():
+                            # Invalid command
+                            # FIXME: Do something else?
+                            m.next = "IDLE"
 
             with m.State("ADDRESS"):
                 m.d.comb += self.source.ready.eq(1)
@@ -73,15 +135,38 @@ class StreamWishboneCommander(Elaboratable):
                     m.d.sync += [
                         address[8:]      .eq(address[:-8]),
                         address[:8]      .eq(self.source.payload),
+                        count            .eq(count - 1),
                     ]
 
-                    with m.If(count > 0):
-                        m.d.sync += count.eq(count - 1)
-                    with m.Else():
+                    with m.If(count == 0):
 
-                        with m.If(perform_write):
+                        with m.If(block):
+                            m.next = "LENGTH"
+                        with m.Elif(perform_write):
+                            m.next = "WRITE_DATA"
+                        with m.Else():
+                            m.next = "OP_BEGIN"
+
+            with m.State("LENGTH"):
+                m.d.comb += self.source.ready.eq(1)
+
+                with m.If(self.source.valid):
+
+                    m.d.sync += [
+                        length[8:]       .eq(length[:-8]),
+                        length[:8]       .eq(self.source.payload),
+                        count            .eq(count - 1),
+                    ]
+
+                    with m.If(count == 0):
+
+                        # Commands with a pattern always take it, even for an empty block.
+                        with m.If(repeat):
+                            m.next = "WRITE_DATA"
+                        with m.Elif(Cat(self.source.payload, length[:24]) == 0):
+                            m.next = "FINISH"
+                        with m.Elif(perform_write):
                             m.next = "WRITE_DATA"
-                            m.d.sync += count.eq(3)
                         with m.Else():
                             m.next = "OP_BEGIN"
 
@@ -93,12 +178,14 @@ class StreamWishboneCommander(Elaboratable):
                     m.d.sync += [
                         write_data[8:]      .eq(write_data[:-8]),
                         write_data[:8]      .eq(self.source.payload),
+                        count               .eq(count - 1),
                     ]
 
-                    with m.If(count > 0):
-                        m.d.sync += count.eq(count - 1)
-                    with m.Else():
-                        m.next = "OP_BEGIN"
+                    with m.If(count == 0):
+                        with m.If(length == 0):
+                            m.next = "FINISH"
+                        with m.Else():
+                            m.next = "OP_BEGIN"
 
             with m.State("OP_BEGIN"):
                 m.d.comb += self.bus.cyc      .eq(1)
@@ -113,7 +200,14 @@ class StreamWishboneCommander(Elaboratable):
                 with m.If(self.bus.ack):
 
                     with m.If(perform_write):
-                        m.next = "ACK"
+                        m.next = "NEXT"
+                    with m.Elif(compare):
+                        m.next = "NEXT"
+                        with m.If(self.bus.dat_r != write_data):
+                            m.d.sync += mismatches.eq(mismatches + 1)
+                    with m.Elif(checksum):
+                        m.next = "NEXT"
+                        m.d.comb += crc.valid.eq(1)
                     with m.Else():
                         m.next = "READ_DATA"
                         m.d.sync += [
@@ -121,7 +215,7 @@ class StreamWishboneCommander(Elaboratable):
                             read_data       .eq(self.bus.dat_r)
                         ]
 
-            with m.State("READ_DATA"):                
+            with m.State("READ_DATA"):
                 m.d.comb += [
                     self.sink.payload       .eq(read_data[-8:]),
                     self.sink.valid         .eq(1),
@@ -132,16 +226,50 @@ class StreamWishboneCommander(Elaboratable):
                     m.d.sync += [
                         read_data[8:]     .eq(read_data[:-8]),
                         read_data[:8]     .eq(0),
-                    ]                    
+                        count             .eq(count - 1),
+                    ]
 
-                    with m.If(count > 0):
-                        m.d.sync += count.eq(count - 1)
-                    with m.Else():
-                        m.next = "ACK"
+                    with m.If(count == 0):
+                        with m.If(reporting):
+                            m.next = "ACK"
+                        with m.Else():
+                            m.next = "NEXT"
+
+            with m.State("NEXT"):
+                m.d.sync += [
+                    address         .eq(address + 1),
+                    length          .eq(length - 1),
+                ]
+
+                with m.If(length == 1):
+                    m.next = "FINISH"
+                with m.Elif(perform_write & ~repeat):
+                    m.next = "WRITE_DATA"
+                    m.d.sync += count.eq(3)
+                with m.Else():
+                    m.next = "OP_BEGIN"
+
+            with m.State("FINISH"):
+                with m.If(compare):
+                    m.next = "READ_DATA"
+                    m.d.sync += [
+                        count           .eq(3),
+                        read_data       .eq(mismatches),
+                        reporting       .eq(1),
+                    ]
+                with m.Elif(checksum):
+                    m.next = "READ_DATA"
+                    m.d.sync += [
+                        count           .eq(3),
+                        read_data       .eq(crc.crc),
+                        reporting       .eq(1),
+                    ]
+                with m.Else():
+                    m.next = "ACK"
 
             with m.State("ACK"):
                 m.d.comb += [
-                    self.sink.payload       .eq(0xDD),
+                    self.sink.payload       .eq(self.ACK),
                     self.sink.valid         .eq(1),
                 ]
 
@@ -188,6 +316,104 @@ class FT245WishboneCommander(Elaboratable):
         return m
 
 
+class WishboneRemoteBatch:
+    """ Queues commander operations, to send them in as few transfers as possible
+
+    Each operation returns a Future, which is resolved when the batch executes. Queued
+    commands are written in chunks, each followed by reading back its responses in bulk.
+    A chunk's responses are kept within 'response_budget' bytes, which must fit in the
+    buffering between the commander and the host (the FT2232H's 4 KiB transmit buffer):
+    otherwise the commander would stall on its responses while the host is still
+    writing commands, and neither side could proceed. Block reads resolve to numpy
+    arrays. Used as a context manager, the batch executes on exit.
+    """
+
+    def __init__(self, port, *, response_budget=4096):
+        self._port = port
+        self.response_budget = response_budget
+
+        self._queued = []
+
+    def read(self, address):
+        return self._queue(struct.pack('>BL', StreamWishboneCommander.READ, address), 4,
+            lambda data: struct.unpack('>L', data)[0])
+
+    def write(self, address, data):
+        return self._queue(struct.pack('>BLL', StreamWishboneCommander.WRITE, address, data), 0)
+
+    def read_block(self, address, count):
+        import numpy as np
+
+        return self._queue(struct.pack('>BLL', StreamWishboneCommander.BLOCK_READ, address, count), 4 * count,
+            lambda data: np.frombuffer(data, dtype='>u4').astype(np.uint32))
+
+    def write_block(self, address, data):
+        import numpy as np
+
+        words = np.asarray(data, dtype='>u4')
+        return self._queue(struct.pack('>BLL', StreamWishboneCommander.BLOCK_WRITE, address, len(words)) + words.tobytes(), 0)
+
+    def fill(self, address, count, data):
+        return self._queue(struct.pack('>BLLL', StreamWishboneCommander.FILL, address, count, data), 0)
+
+    def compare(self, address, count, data):
+        return self._queue(struct.pack('>BLLL', StreamWishboneCommander.COMPARE, address, count, data), 4,
+            lambda data: struct.unpack('>L', data)[0])
+
+    def checksum(self, address, count):
+        return self._queue(struct.pack('>BLL', StreamWishboneCommander.CHECKSUM, address, count), 4,
+            lambda data: struct.unpack('>L', data)[0])
+
+    def execute(self):
+        queued, self._queued = self._queued, []
+
+        chunk, expected = [], 0
+        for entry in queued:
+            # Every response is a payload of known length, followed by its acknowledgement.
+            length = entry[1] + 1
+
+            # A response larger than the budget goes alone; the host is reading it back
+            # by the time it fills the buffer.
+            if chunk and expected + length > self.response_budget:
+                self._execute_chunk(chunk, expected)
+                chunk, expected = [], 0
+
+            chunk.append(entry)
+            expected += length
+
+        if chunk:
+            self._execute_chunk(chunk, expected)
+
+    def _execute_chunk(self, chunk, expected):
+        self._port.write(b''.join(command for command, _, _, _ in chunk))
+        raw = self._port.read(expected)
+
+        offset = 0
+        for _, length, parse, future in chunk:
+            payload = raw[offset:offset + length]
+            ack = raw[offset + length] if offset + length < len(raw) else None
+            offset += length + 1
+
+            if ack != StreamWishboneCommander.ACK:
+                future.set_exception(IOError("Got bad response! {}".format(
+                    "(none)" if ack is None else "0x{:02X}".format(ack))))
+            else:
+                future.set_result(parse(payload) if parse else None)
+
+    def _queue(self, command, length, parse=None):
+        future = Future()
+        self._queued.append((command, length, parse, future))
+
+        return future
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+
+
 class FT245WishboneRemote:
 
     def __init__(self):
@@ -196,6 +422,9 @@ class FT245WishboneRemote:
         self._port = pyftdi.serialext.serial_for_url('ftdi://ftdi:2232h:FT5RTNBA/1', baudrate=3000000)
         self._port.reset_input_buffer()    
 
+    def batch(self):
+        return WishboneRemoteBatch(self._port)
+
     def read(self, address):
         self._port.write(struct.pack('>B', 0x10))
         self._port.write(struct.pack('>L', address))
@@ -220,6 +449,50 @@ class FT245WishboneRemote:
         if ack != 0xDD:
             print(f"Got bad response! 0x{ack:02X}")     
 
+    def read_block(self, address, count):
+        self._port.write(struct.pack('>BLL', StreamWishboneCommander.BLOCK_READ, address, count))
+
+        data = list(struct.unpack(f'>{count}L', self._port.read(4 * count)))
+        self._check_ack()
+
+        return data
+
+    def write_block(self, address, data):
+        self._port.write(struct.pack('>BLL', StreamWishboneCommander.BLOCK_WRITE, address, len(data)))
+        self._port.write(struct.pack(f'>{len(data)}L', *data))
+
+        self._check_ack()
+
+    def fill(self, address, count, data):
+        self._port.write(struct.pack('>BLLL', StreamWishboneCommander.FILL, address, count, data))
+
+        self._check_ack()
+
+    def compare(self, address, count, data):
+        self._port.write(struct.pack('>BLLL', StreamWishboneCommander.COMPARE, address, count, data))
+
+        mismatches = struct.unpack('>L', self._port.read(4))[0]
+        self._check_ack()
+
+        return mismatches
+
+    def checksum(self, address, count):
+        self._port.write(struct.pack('>BLL', StreamWishboneCommander.CHECKSUM, address, count))
+
+        crc = struct.unpack('>L', self._port.read(4))[0]
+        self._check_ack()
+
+        return crc
+
+    def _check_ack(self):
+        response = self._port.read(1)
+        ack = response[0] if response else None
+
+        # Fail as WishboneRemoteBatch does, rather than returning bad data.
+        if ack != StreamWishboneCommander.ACK:
+            raise IOError("Got bad response! {}".format(
+                "(none)" if ack is None else "0x{:02X}".format(ack)))
+
 
 class StreamWishboneCommanderTest(MultiProcessTestCase):
 
@@ -264,3 +537,160 @@ class StreamWishboneCommanderTest(MultiProcessTestCase):
             sim.add_sync_process(bus_process)
             sim.add_sync_process(source_process)
             sim.add_sync_process(sink_process)
+
+    def test_block(self):
+        dut = StreamWishboneCommander()
+
+        bus_emulator = WishboneEmulator(dut.bus, initial=0x100, delay=1, max_outstanding=1)
+        source_driver = StreamDriver(dut.source)
+        sink_driver = StreamDriver(dut.sink)
+
+        def bus_process():
+            yield Passive()
+            yield from bus_emulator.emulate()
+
+        def source_process():
+            yield from source_driver.begin()
+
+            # Block read of three words
+            yield from source_driver.produce(struct.pack('>BLL', 0x12, 0x1000, 3))
+
+            # Block write of two words
+            yield from source_driver.produce(struct.pack('>BLLLL', 0x13, 0x2000, 2, 0xAAAA5555, 0x5555AAAA))
+
+            # Compare four words, only the first of which (0x103) matches
+            yield from source_driver.produce(struct.pack('>BLLL', 0x15, 0x3000, 4, 0x103))
+
+            # Checksum of two words
+            yield from source_driver.produce(struct.pack('>BLL', 0x16, 0x4000, 2))
+
+        def sink_process():
+            yield from sink_driver.begin()
+
+            results = yield from sink_driver.consume(13)
+            self.assertEqual(bytes(results), struct.pack('>LLLB', 0x100, 0x101, 0x102, 0xDD))
+
+            results = yield from sink_driver.consume(1)
+            self.assertEqual(results, [0xDD])
+
+            results = yield from sink_driver.consume(5)
+            self.assertEqual(bytes(results), struct.pack('>LB', 3, 0xDD))
+
+            results = yield from sink_driver.consume(5)
+            expected = zlib.crc32(struct.pack('>LL', 0x107, 0x108))
+            self.assertEqual(bytes(results), struct.pack('>LB', expected, 0xDD))
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(bus_process)
+            sim.add_sync_process(source_process)
+            sim.add_sync_process(sink_process)
+
+
+class _EchoingPort:
+    """ Answers commander reads with their addresses, as a stand-in for the FT245 link
+
+    Tracks the most response bytes that were ever left waiting for the host to read.
+    """
+
+    def __init__(self):
+        self._pending = bytearray()
+        self.max_pending = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.writes += 1
+
+        offset = 0
+        while offset < len(data):
+            command = data[offset]
+
+            if command == StreamWishboneCommander.READ:
+                address, = struct.unpack_from('>L', data, offset + 1)
+                self._pending += struct.pack('>L', address)
+                offset += 5
+            elif command == StreamWishboneCommander.WRITE:
+                offset += 9
+            elif command == StreamWishboneCommander.BLOCK_READ:
+                address, count = struct.unpack_from('>LL', data, offset + 1)
+                self._pending += struct.pack(f'>{count}L', *range(address, address + count))
+                offset += 9
+            else:
+                raise ValueError("Unsupported command 0x{:02X}".format(command))
+
+            self._pending.append(StreamWishboneCommander.ACK)
+
+        self.max_pending = max(self.max_pending, len(self._pending))
+
+    def read(self, size):
+        data, self._pending = bytes(self._pending[:size]), self._pending[size:]
+        return data
+
+
+class WishboneRemoteBatchTest(unittest.TestCase):
+
+    def test_chunked(self):
+        port = _EchoingPort()
+
+        with WishboneRemoteBatch(port) as batch:
+            results = [batch.read(address) for address in range(10000)]
+            writes  = [batch.write(address, 0) for address in range(100)]
+
+        self.assertEqual([result.result() for result in results], list(range(10000)))
+        self.assertTrue(all(write.result() is None for write in writes))
+
+        # No more responses were queued up than the link can buffer.
+        self.assertLessEqual(port.max_pending, 4096)
+        self.assertGreater(port.writes, 1)
+
+    def test_large_block(self):
+        port = _EchoingPort()
+
+        with WishboneRemoteBatch(port) as batch:
+            before = batch.read(0x10)
+            block  = batch.read_block(0x1000, 2048)
+            after  = batch.read(0x20)
+
+        self.assertEqual(before.result(), 0x10)
+        self.assertEqual(list(block.result()), list(range(0x1000, 0x1000 + 2048)))
+        self.assertEqual(after.result(), 0x20)
+
+        # The oversized block is sent on its own.
+        self.assertEqual(port.writes, 3)
+
+
+class _ReplyPort:
+    """ Ignores everything written to it, and answers reads from a fixed response. """
+
+    def __init__(self, response):
+        self._pending = bytearray(response)
+
+    def write(self, data):
+        pass
+
+    def read(self, size):
+        data, self._pending = bytes(self._pending[:size]), self._pending[size:]
+        return data
+
+
+class FT245WishboneRemoteTest(unittest.TestCase):
+
+    @staticmethod
+    def _remote(response):
+        remote = FT245WishboneRemote.__new__(FT245WishboneRemote)
+        remote._port = _ReplyPort(response)
+        return remote
+
+    def test_checksum(self):
+        remote = self._remote(struct.pack('>LB', 0x12345678, StreamWishboneCommander.ACK))
+        self.assertEqual(remote.checksum(0, 16), 0x12345678)
+
+    def test_bad_ack(self):
+        remote = self._remote(struct.pack('>LB', 0x12345678, 0x00))
+        with self.assertRaises(IOError):
+            remote.checksum(0, 16)
+
+    def test_missing_ack(self):
+        remote = self._remote(struct.pack('>L', 0))
+        with self.assertRaises(IOError):
+            remote.compare(0, 16, 0)
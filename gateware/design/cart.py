@@ -1,11 +1,10 @@
 from nmigen import *
 from nmigen.build import *
-from nmigen_soc import wishbone
 
 from n64.cic import CIC
 from n64.pi import PIWishboneInitiator
 from interface.qspi_flash import QSPIFlashWishboneInterface
-from soc.wishbone import DownConverter, Translator
+from soc.wishbone import DownConverter, FlatDecoder
 from utils.cli import main_runner
 
 
@@ -20,24 +19,20 @@ class Top(Elaboratable):
         m.submodules.cic        = self.cic = cic       = DomainRenamer("cic")(CIC())
         
         m.submodules.initiator       = self.initiator       = initiator       = PIWishboneInitiator();
-        m.submodules.flash_interface = self.flash_interface = flash_interface = QSPIFlashWishboneInterface()
+        m.submodules.flash_interface = self.flash_interface = flash_interface = QSPIFlashWishboneInterface(probe_sfdp=True)
         m.submodules.flash_connector = self.flash_connector = flash_connector = platform.flash_connector()
 
-        translator = Translator(sub_bus=flash_interface.bus,
-                                base_addr=0x800000,
-                                addr_width=24,
-                                features={"stall"})
-
-        down_converter = DownConverter(sub_bus=translator.bus,
+        down_converter = DownConverter(sub_bus=flash_interface.bus,
                                        addr_width=22,
                                        data_width=32,
                                        granularity=8,
                                        features={"stall"})
 
-        decoder = wishbone.Decoder(addr_width=32, data_width=32, granularity=8, features={"stall"})
-        decoder.add(down_converter.bus, addr=0x10000000)
+        # The ROM image lives in the upper 8 MiB of the flash. The 16 MiB window wraps around,
+        # so accesses above 8 MiB of the ROM reach the lower half of the flash.
+        decoder = FlatDecoder(addr_width=32, data_width=32, granularity=8, features={"stall"})
+        decoder.add(down_converter.bus, addr=0x10000000, size=0x1000000, base_addr=0x200000)
 
-        m.submodules.translator = translator
         m.submodules.down_converter = down_converter
         m.submodules.decoder = decoder
 
@@ -62,6 +62,20 @@ def run_remote():
 
     print(f"{total_time:.2f} seconds ({rate:.2f} ops/sec)")
 
+    # The same reads again, queued up and sent as a single batch.
+    start_time = time.time()
+
+    with remote.batch() as batch:
+        results = [batch.read(0x22) for i in range(count)]
+
+    assert all(result.result() == 0x22 + 0x45 for result in results)
+
+    end_time = time.time()
+    total_time = end_time - start_time
+    rate = count / total_time
+
+    print(f"{total_time:.2f} seconds ({rate:.2f} ops/sec, batched)")
+
 if __name__ == "__main__":
     main_runner(Top())
     run_remote()
@@ -0,0 +1,267 @@
+import argparse
+import sys
+import time
+import zlib
+
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc.memory import MemoryMap
+from nmigen_soc.wishbone import Interface
+
+from debug.wishbone import FT245WishboneCommander, FT245WishboneRemote
+from interface.hyperram_wishbone import HyperRAMWishboneInterface
+from interface.qspi_flash import QSPIFlashWishboneInterface
+from soc.wishbone import DownConverter, FlatDecoder
+from utils.cli import main_runner
+
+from test import *
+from test.driver.wishbone import WishboneInitiator
+from test.emulator.wishbone import RecordingWishboneEmulator
+
+
+# Word addresses of the memories, as seen by the commander.
+HYPERRAM_BASE   = 0x00000000
+FLASH_BASE      = 0x04000000
+
+# The ROM image lives in the upper 8 MiB of the flash.
+FLASH_ROM_BASE  = FLASH_BASE + (0x800000 // 4)
+
+CHUNK_WORDS     = 0x4000
+
+
+class MemoryDecoder(Elaboratable):
+    """ Maps the HyperRAM and flash buses at HYPERRAM_BASE and FLASH_BASE of a 32-bit bus
+
+    Both memories are byte-addressed behind byte-granular converters, so the subordinate
+    buses must have a granularity of 8.
+    """
+
+    def __init__(self, *, ram_bus, flash_bus):
+        self.ram_converter   = DownConverter(sub_bus=ram_bus,
+                                             addr_width=21,
+                                             data_width=32,
+                                             granularity=8,
+                                             features={"stall"})
+        self.flash_converter = DownConverter(sub_bus=flash_bus,
+                                             addr_width=22,
+                                             data_width=32,
+                                             granularity=8,
+                                             features={"stall"})
+
+        # The decoder's windows are placed at byte addresses.
+        self.decoder = FlatDecoder(addr_width=32, data_width=32, granularity=8, features={"stall"})
+        self.decoder.add(self.ram_converter.bus,   addr=4 * HYPERRAM_BASE)
+        self.decoder.add(self.flash_converter.bus, addr=4 * FLASH_BASE)
+
+        self.bus = self.decoder.bus
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.ram_converter   = self.ram_converter
+        m.submodules.flash_converter = self.flash_converter
+        m.submodules.decoder         = self.decoder
+
+        return m
+
+
+class Top(Elaboratable):
+    """ Exposes the HyperRAM (read/write) and flash (read only) to the FT245 commander """
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.car                               = platform.clock_domain_generator()
+        m.submodules.comm            = comm            = FT245WishboneCommander()
+        m.submodules.flash_connector = flash_connector = platform.flash_connector()
+
+        m.submodules.ram_interface   = ram_interface   = HyperRAMWishboneInterface(bus=platform.request('ram'),
+                                                                                   granularity=8)
+        m.submodules.flash_interface = flash_interface = QSPIFlashWishboneInterface()
+
+        m.submodules.memory          = memory          = MemoryDecoder(ram_bus=ram_interface.bus,
+                                                                       flash_bus=flash_interface.bus)
+
+        m.d.comb += [
+            comm.bus                .connect(memory.bus),
+            flash_interface.qspi    .connect(flash_connector.qspi),
+        ]
+
+        return m
+
+
+def to_z64(data):
+    """ Converts a ROM image in any of the common byte orders to big-endian (.z64) """
+    data = bytearray(data)
+    magic = bytes(data[0:4])
+
+    if magic == b'\x80\x37\x12\x40':
+        pass
+    elif magic == b'\x37\x80\x40\x12':
+        # .v64 images have each 16-bit half-word byte-swapped.
+        data[0::2], data[1::2] = data[1::2], data[0::2]
+    elif magic == b'\x40\x12\x37\x80':
+        # .n64 images are little-endian 32-bit words.
+        data[0::4], data[1::4], data[2::4], data[3::4] = data[3::4], data[2::4], data[1::4], data[0::4]
+    else:
+        raise ValueError(f"Unrecognized ROM header {magic.hex()}")
+
+    return bytes(data)
+
+
+def from_z64(data, byteorder):
+    """ Converts a big-endian image to 'z64', 'v64' or 'n64' byte order """
+    data = bytearray(data)
+
+    if byteorder == 'v64':
+        data[0::2], data[1::2] = data[1::2], data[0::2]
+    elif byteorder == 'n64':
+        data[0::4], data[1::4], data[2::4], data[3::4] = data[3::4], data[2::4], data[1::4], data[0::4]
+    elif byteorder != 'z64':
+        raise ValueError(f"Unknown byte order {byteorder!r}")
+
+    return bytes(data)
+
+
+def print_progress(done, total, start_time):
+    elapsed = max(time.time() - start_time, 1e-6)
+    rate = done / elapsed / 1e6
+    print(f"\r{done:>10} / {total} bytes ({100 * done // total:3}%, {rate:.2f} MB/s)", end='', flush=True)
+
+
+def upload(remote, data, address=HYPERRAM_BASE):
+    """ Writes a ROM image to memory in chunks, then verifies it by CRC """
+    import numpy as np
+
+    data = to_z64(data)
+    data += b'\x00' * (-len(data) % 4)
+    words = np.frombuffer(data, dtype='>u4')
+
+    start_time = time.time()
+
+    for offset in range(0, len(words), CHUNK_WORDS):
+        chunk = words[offset:offset + CHUNK_WORDS]
+        with remote.batch() as batch:
+            batch.write_block(address + offset, chunk)
+        print_progress(4 * (offset + len(chunk)), len(data), start_time)
+
+    print()
+
+    expected = zlib.crc32(data)
+    actual = remote.checksum(address, len(words))
+
+    if actual != expected:
+        raise IOError(f"CRC mismatch: wrote {expected:08X}, read back {actual:08X}")
+
+    print(f"Verified CRC {actual:08X}")
+
+
+def download(remote, length, address=FLASH_ROM_BASE, byteorder='z64'):
+    """ Reads 'length' bytes of memory, verifying them by CRC """
+    count = (length + 3) // 4
+    chunks = []
+
+    start_time = time.time()
+
+    for offset in range(0, count, CHUNK_WORDS):
+        with remote.batch() as batch:
+            chunk = batch.read_block(address + offset, min(CHUNK_WORDS, count - offset))
+        chunks.append(chunk.result().astype('>u4').tobytes())
+        print_progress(4 * offset + len(chunks[-1]), 4 * count, start_time)
+
+    print()
+
+    data = b''.join(chunks)
+
+    expected = remote.checksum(address, count)
+    if zlib.crc32(data) != expected:
+        raise IOError(f"CRC mismatch: read {zlib.crc32(data):08X}, memory has {expected:08X}")
+
+    return from_z64(data[:length], byteorder)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Transfers N64 ROM images to and from the cart over FT245.")
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    subparsers.add_parser('build', help="build and program the gateware")
+
+    upload_parser = subparsers.add_parser('upload', help="upload a .z64/.v64/.n64 image into HyperRAM")
+    upload_parser.add_argument('rom')
+
+    download_parser = subparsers.add_parser('download', help="download an image from flash or HyperRAM")
+    download_parser.add_argument('rom')
+    download_parser.add_argument('--length', type=lambda x: int(x, 0), default=0x800000)
+    download_parser.add_argument('--source', choices=('flash', 'hyperram'), default='flash')
+    download_parser.add_argument('--byteorder', choices=('z64', 'v64', 'n64'), default='z64')
+
+    args = parser.parse_args()
+
+    if args.command == 'build':
+        main_runner(Top())
+        return
+
+    remote = FT245WishboneRemote()
+
+    if args.command == 'upload':
+        with open(args.rom, 'rb') as f:
+            upload(remote, f.read())
+
+    elif args.command == 'download':
+        address = FLASH_ROM_BASE if args.source == 'flash' else HYPERRAM_BASE
+        data = download(remote, args.length, address=address, byteorder=args.byteorder)
+
+        with open(args.rom, 'wb') as f:
+            f.write(data)
+
+
+class MemoryDecoderTest(MultiProcessTestCase):
+
+    def test_decode(self):
+        # Buses shaped like those of the HyperRAM and flash interfaces.
+        ram_bus = Interface(addr_width=22, data_width=16, granularity=8, features={"stall"})
+        ram_bus.memory_map = MemoryMap(addr_width=23, data_width=8)
+        ram_bus.memory_map.add_resource(object(), size=2**23)
+
+        flash_bus = Interface(addr_width=24, data_width=8, features={"stall"})
+        flash_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+        flash_bus.memory_map.add_resource(object(), size=2**24)
+
+        dut = MemoryDecoder(ram_bus=ram_bus, flash_bus=flash_bus)
+
+        ram_emulator   = RecordingWishboneEmulator(ram_bus,   delay=1, max_outstanding=1)
+        flash_emulator = RecordingWishboneEmulator(flash_bus, delay=1, max_outstanding=1)
+        intr_driver    = WishboneInitiator(dut.bus)
+
+        def intr_process():
+            yield from intr_driver.begin()
+
+            # Two halfwords from the HyperRAM, most significant first.
+            result = yield from intr_driver.read_once(HYPERRAM_BASE + 5)
+            self.assertEqual(result, 0x00000001)
+            self.assertEqual(ram_emulator.addresses, [10, 11])
+
+            # Four bytes from the flash, including the ROM image.
+            result = yield from intr_driver.read_once(FLASH_BASE + 3)
+            self.assertEqual(result, 0x00010203)
+
+            yield from intr_driver.read_once(FLASH_ROM_BASE)
+            self.assertEqual(flash_emulator.addresses, [12, 13, 14, 15, 0x800000, 0x800001, 0x800002, 0x800003])
+
+        def ram_process():
+            yield Passive()
+            yield from ram_emulator.emulate()
+
+        def flash_process():
+            yield Passive()
+            yield from flash_emulator.emulate()
+
+        with self.simulate(dut, traces=[dut.bus, ram_bus, flash_bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(ram_process)
+            sim.add_sync_process(flash_process)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
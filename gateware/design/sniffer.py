@@ -0,0 +1,98 @@
+import argparse
+import sys
+import time
+
+from nmigen import *
+
+from debug.pi import PITransactionSniffer, PISnifferDecoder
+from debug.serial import FT245Streamer
+from design import cart
+from utils.cli import main_runner
+
+
+class Top(cart.Top):
+    """ The cart design, streaming a record of every PI burst over FT245 """
+
+    def elaborate(self, platform):
+        m = super().elaborate(platform)
+
+        m.submodules.sniffer  = sniffer  = PITransactionSniffer()
+        m.submodules.streamer = streamer = FT245Streamer(byte_width=PITransactionSniffer.RECORD_BYTES)
+
+        m.d.comb += [
+            sniffer.bus         .eq(self.initiator.monitor),
+            sniffer.late_block  .eq(self.initiator.late_block),
+            sniffer.late_read   .eq(self.initiator.late_read),
+
+            sniffer.stream      .connect(streamer.stream),
+        ]
+
+        return m
+
+
+def record(port, decoder, duration, log_file):
+    """ Reads records until 'duration' seconds have passed (or forever), logging them """
+    import numpy as np
+
+    chunk_bytes = 4096 * PITransactionSniffer.RECORD_BYTES
+
+    batches = []
+    end_time = time.time() + duration if duration else None
+
+    try:
+        while end_time is None or time.time() < end_time:
+            # The decoder finds record boundaries itself, and holds over partial records.
+            records = decoder.decode(port.read(chunk_bytes))
+
+            for line in decoder.format_log(records):
+                log_file.write(line + '\n')
+            batches.append(records)
+
+    except KeyboardInterrupt:
+        pass
+
+    return np.concatenate(batches) if batches else decoder.decode(b'')
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Logs and profiles the PI accesses of a running game.")
+    parser.add_argument('--build', action='store_true', help="build and program the gateware first")
+    parser.add_argument('--duration', type=float, default=0, help="seconds to record (default: until interrupted)")
+    parser.add_argument('--log', default='pi.log', help="file to write the transaction log to")
+    parser.add_argument('--bucket', type=lambda x: int(x, 0), default=0x1000, help="heatmap bucket size in bytes")
+    parser.add_argument('--top', type=int, default=32, help="number of heatmap buckets to print")
+    parser.add_argument('--clock', type=float, default=80e6, help="sniffer clock frequency in Hz")
+
+    args = parser.parse_args()
+
+    if args.build:
+        main_runner(Top())
+
+    import pyftdi.serialext
+
+    port = pyftdi.serialext.serial_for_url('ftdi://ftdi:2232h:FT5RTNBA/1', baudrate=3000000)
+    port.reset_input_buffer()
+
+    decoder = PISnifferDecoder(clock_frequency=args.clock)
+
+    with open(args.log, 'w') as log_file:
+        records = record(port, decoder, args.duration, log_file)
+
+    dropped = int(records['dropped'].sum())
+    late_blocks = int(records['late_block'].sum())
+    late_reads = int(records['late_read'].sum())
+
+    print(f"{len(records)} bursts, {int(records['count'].sum())} words "
+          f"({dropped} dropped, {late_blocks} late blocks, {late_reads} late reads, "
+          f"{decoder.skipped} bytes skipped)")
+
+    addresses, words = decoder.heatmap(records, bucket_size=args.bucket)
+    total = max(int(words.sum()), 1)
+
+    for index in words.argsort()[::-1][:args.top]:
+        share = int(words[index]) / total
+        print(f"{int(addresses[index]):08X}  {int(words[index]):>10} words  {100 * share:5.1f}%  {'#' * round(50 * share)}")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,6 +1,8 @@
+import struct
+
 from nmigen import *
-import pyftdi.serialext
 
+from debug.serial import FT245Capture, FT245Recorder
 from interface.ft245 import FT245Interface
 from soc.stream import ByteDownConverter
 from utils.cli import main_runner
@@ -60,13 +62,21 @@ class Top(Elaboratable):
         return m
 
 
-def read_serial():
-    port = pyftdi.serialext.serial_for_url('ftdi://ftdi:2232h:FT5RTNBA/1', baudrate=3000000)
-    port.reset_input_buffer()
+def read_serial(filename='uart.bin'):
+    FT245Recorder().record(filename)
+
+    # The recording may begin partway into a word; align to the first intact one.
+    with open(filename, 'rb') as f:
+        start = f.read(4096).find(struct.pack('<L', 0xCAFEBABE))
+
+    if start < 0:
+        print("No intact words at the start of the capture")
+        return
 
-    while True:
-        b = port.read()
-        print(b)
+    # The design sends a constant word; check that every one arrived intact.
+    capture = FT245Capture(filename, 4, offset=start % 4)
+    payloads = capture.payloads.view('<u4').ravel()
+    print(f"{len(payloads)} words, {int((payloads != 0xCAFEBABE).sum())} corrupt")
 
 if __name__ == "__main__":
     main_runner(Top())
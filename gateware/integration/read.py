@@ -2,12 +2,11 @@ import unittest
 
 from nmigen import *
 from nmigen.sim import *
-from nmigen_soc import wishbone
 
 from interface.qspi_flash import QSPIBus, QSPIFlashWishboneInterface
 from n64.ad16 import AD16
 from n64.pi import PIWishboneInitiator
-from soc.wishbone import DownConverter, Translator
+from soc.wishbone import DownConverter, FlatDecoder
 from test.driver.ad16 import PIInitiator
 from test.emulator.qspi_flash import QSPIFlashEmulator
 
@@ -22,12 +21,7 @@ class DUT(Elaboratable):
 
         self.flash_interface = QSPIFlashWishboneInterface()
 
-        self.translator = Translator(sub_bus=self.flash_interface.bus,
-                                        base_addr=0x800000,
-                                        addr_width=24,
-                                        features={"stall"})
-
-        self.down_converter = DownConverter(sub_bus=self.translator.bus,
+        self.down_converter = DownConverter(sub_bus=self.flash_interface.bus,
                                         addr_width=22,
                                         data_width=32,
                                         granularity=8,
@@ -38,13 +32,12 @@ class DUT(Elaboratable):
 
         initiator = PIWishboneInitiator()
         
-        decoder = wishbone.Decoder(addr_width=32, data_width=32, granularity=8, features={"stall"})
-        decoder.add(self.down_converter.bus, addr=0x10000000)
+        decoder = FlatDecoder(addr_width=32, data_width=32, granularity=8, features={"stall"})
+        decoder.add(self.down_converter.bus, addr=0x10000000, size=0x1000000, base_addr=0x200000)
 
         m.submodules.initiator       = initiator
         m.submodules.decoder         = decoder
         m.submodules.flash_interface = self.flash_interface
-        m.submodules.translator      = self.translator
         m.submodules.down_converter  = self.down_converter
 
         m.d.comb += [
@@ -73,7 +66,6 @@ class DUT(Elaboratable):
             self.qspi.d.oe,
 
             self.down_converter.bus,
-            self.translator.bus,
             self.flash_interface.bus,
         ]
 
@@ -83,15 +75,8 @@ class N64ReadTest(MultiProcessTestCase):
     def test_read(self):
         dut = DUT()
 
-        with open("../roms/sm64.z64", "rb") as f:
-            rom_bytes = list(f.read())
-
-        flash_bytes = []
-        flash_bytes += [0xFF] * 2**23
         # The ROM segment begins at offset 0x800000
-        flash_bytes += rom_bytes
-
-        flash = QSPIFlashEmulator(dut.qspi, flash_bytes)
+        flash = QSPIFlashEmulator.from_file(dut.qspi, "../roms/sm64.z64", offset=0x800000)
         pi = PIInitiator(dut.ad16)
 
         def flash_process():
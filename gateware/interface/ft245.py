@@ -1,11 +1,13 @@
 from nmigen import *
 from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
 from nmigen.lib.cdc import FFSynchronizer
-from nmigen.lib.fifo import SyncFIFO
+from nmigen.lib.fifo import AsyncFIFO, SyncFIFO
+from nmigen.sim import *
 
 from soc.stream import BasicStream
 
 from test import *
+from test.driver.stream import StreamDriver
 
 
 class FT245Bus(Record):
@@ -22,19 +24,47 @@ class FT245Bus(Record):
             ('wr',  1, DIR_FANOUT)
         ])
 
+class FT245SyncBus(Record):
+    def __init__(self):
+        super().__init__([
+            ('d', [
+                ('i',  8, DIR_FANIN),
+                ('o',  8, DIR_FANOUT),
+                ('oe', 1, DIR_FANOUT),
+            ]),
+            ('rxf',    1, DIR_FANIN),
+            ('txe',    1, DIR_FANIN),
+            ('rd',     1, DIR_FANOUT),
+            ('wr',     1, DIR_FANOUT),
+            ('clkout', 1, DIR_FANIN),
+            ('oe',     1, DIR_FANOUT),
+        ])
+
 class FT245Interface(Elaboratable):
+    """ FT2232H asynchronous 245 FIFO interface
+
+    When both directions have bytes ready, they take turns in runs of up to
+    'burst_length' bytes, so that neither can starve the other. 'rx_count' and
+    'tx_count' count the bytes transferred in each direction.
+    """
+
     WR_SETUP_CYCLES = 3
     WR_PULSE_CYCLES = 7
     RD_PULSE_CYCLES = 8
     RD_WAIT_CYCLES  = 5
 
-    def __init__(self):     
+    def __init__(self, *, rx_depth=64, tx_depth=64, burst_length=16):
+        self.burst_length = burst_length
+
         self.bus = FT245Bus()
         self.rx = BasicStream(8)
         self.tx = BasicStream(8)
 
-        self._rx_fifo = SyncFIFO(width=8, depth=1)
-        self._tx_fifo = SyncFIFO(width=8, depth=1)
+        self.rx_count = Signal(32)
+        self.tx_count = Signal(32)
+
+        self._rx_fifo = SyncFIFO(width=8, depth=rx_depth)
+        self._tx_fifo = SyncFIFO(width=8, depth=tx_depth)
 
     def elaborate(self, platform):
         m = Module()
@@ -61,6 +91,24 @@ class FT245Interface(Elaboratable):
             self._tx_fifo.r_en.eq(0)
         ]
 
+        # The direction of the current run, and its length so far.
+        writing = Signal()
+        run     = Signal(range(self.burst_length + 1))
+
+        want_read  = Signal()
+        want_write = Signal()
+        do_read    = Signal()
+
+        m.d.comb += [
+            want_read           .eq(self._rx_fifo.w_rdy & ~rxf),
+            want_write          .eq(self._tx_fifo.r_rdy & ~txe),
+
+            # When both directions are ready, the current run continues until it's complete.
+            do_read             .eq(want_read & (~want_write |
+                                                 Mux(writing, run == self.burst_length,
+                                                              run != self.burst_length))),
+        ]
+
         with m.If(count > 0):
             m.d.sync += count.eq(count - 1)
         with m.Else():
@@ -75,22 +123,27 @@ class FT245Interface(Elaboratable):
                         wr                      .eq(1),
                     ]
 
-                    with m.If(self._rx_fifo.w_rdy & ~rxf):
+                    with m.If(do_read):
 
                         m.next = "READ"
                         m.d.sync += [
                             count               .eq(self.RD_PULSE_CYCLES - 1),
-                            rd                  .eq(0),         
+                            rd                  .eq(0),
+                            writing             .eq(0),
+                            run                 .eq(Mux(writing, 1, self._next_run(run))),
                         ]
 
-                    with m.Elif(self._tx_fifo.r_rdy & ~txe):
+                    with m.Elif(want_write):
 
                         m.next = "WRITE"
                         m.d.sync += [
-                            count               .eq(self.RD_PULSE_CYCLES - 1),
+                            count               .eq(self.WR_SETUP_CYCLES - 1),
                             self._tx_fifo.r_en  .eq(1),
                             self.bus.d.o        .eq(self._tx_fifo.r_data),
-                            self.bus.d.oe       .eq(1)
+                            self.bus.d.oe       .eq(1),
+                            self.tx_count       .eq(self.tx_count + 1),
+                            writing             .eq(1),
+                            run                 .eq(Mux(writing, self._next_run(run), 1)),
                         ]
 
                 with m.State("READ"):
@@ -100,8 +153,8 @@ class FT245Interface(Elaboratable):
                         count                   .eq(self.RD_WAIT_CYCLES - 1),
                         self._rx_fifo.w_data    .eq(din),
                         self._rx_fifo.w_en      .eq(1),
-                        rd                      .eq(1),                     
-                        
+                        rd                      .eq(1),
+                        self.rx_count           .eq(self.rx_count + 1),
                     ]
 
                 with m.State("WRITE"):
@@ -129,6 +182,10 @@ class FT245Interface(Elaboratable):
 
         return m
 
+    def _next_run(self, run):
+        # Runs saturate; a complete run only continues while the other direction is idle.
+        return Mux(run == self.burst_length, run, run + 1)
+
 class FT245InterfaceTest(ModuleTestCase):
     FRAGMENT_UNDER_TEST = FT245Interface
 
@@ -179,6 +236,7 @@ class FT245InterfaceTest(ModuleTestCase):
 
         self.assertEqual((yield self.dut.rx.payload), 0xA9)
         self.assertEqual((yield self.dut.rx.valid),   1)
+        self.assertEqual((yield self.dut.rx_count),   1)
 
         yield self.dut.rx.ready.eq(1)
         yield
@@ -209,3 +267,153 @@ class FT245InterfaceTest(ModuleTestCase):
         yield from self.wait_until( self.dut.bus.wr, timeout=20)
 
         self.assertEqual((yield self.dut.bus.d.oe), 0)
+
+
+class FT245SyncInterface(Elaboratable):
+    """ FT2232H synchronous 245 FIFO interface
+
+    The FT2232H transfers a byte on every rising edge of its 60 MHz CLKOUT for which
+    RXF# and RD# (reads) or TXE# and WR# (writes) are both low. The bus side of this
+    interface runs in 'domain', which the design must clock from 'bus.clkout'; the rx
+    and tx streams are in the sync domain, and asynchronous FIFOs cross between them.
+
+    RD# and WR# are only asserted while the respective FIFO has room (or data), so every
+    transfer the FT2232H makes is captured. When the chip reports its buffer empty (or
+    full), the interface turns the bus around to serve the other direction.
+
+    The channel must be put in synchronous FIFO mode by the host (bit mode 0x40).
+    """
+
+    def __init__(self, *, domain="usb", rx_depth=512, tx_depth=512):
+        self.domain = domain
+
+        self.bus = FT245SyncBus()
+        self.rx = BasicStream(8)
+        self.tx = BasicStream(8)
+
+        self._rx_fifo = AsyncFIFO(width=8, depth=rx_depth, w_domain=domain, r_domain="sync")
+        self._tx_fifo = AsyncFIFO(width=8, depth=tx_depth, w_domain="sync", r_domain=domain)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.rx_fifo = rx_fifo = self._rx_fifo
+        m.submodules.tx_fifo = tx_fifo = self._tx_fifo
+
+        rd = Signal()
+        wr = Signal()
+        oe = Signal()
+
+        with m.FSM(domain=self.domain):
+
+            with m.State("IDLE"):
+                with m.If(~self.bus.rxf & rx_fifo.w_rdy):
+                    m.next = "READ_TURNAROUND"
+                with m.Elif(~self.bus.txe & tx_fifo.r_rdy):
+                    m.next = "WRITE"
+
+            # The FT2232H starts driving the data bus a cycle after OE# falls.
+            with m.State("READ_TURNAROUND"):
+                m.d.comb += oe.eq(1)
+                m.next = "READ"
+
+            with m.State("READ"):
+                m.d.comb += [
+                    oe                  .eq(1),
+                    rd                  .eq(rx_fifo.w_rdy),
+
+                    rx_fifo.w_data      .eq(self.bus.d.i),
+                    rx_fifo.w_en        .eq(rx_fifo.w_rdy & ~self.bus.rxf),
+                ]
+
+                with m.If(self.bus.rxf | ~rx_fifo.w_rdy):
+                    m.next = "IDLE"
+
+            with m.State("WRITE"):
+                m.d.comb += [
+                    self.bus.d.oe       .eq(1),
+                    self.bus.d.o        .eq(tx_fifo.r_data),
+                    wr                  .eq(tx_fifo.r_rdy),
+
+                    tx_fifo.r_en        .eq(tx_fifo.r_rdy & ~self.bus.txe),
+                ]
+
+                # Give pending reads a turn once the chip's transmit buffer fills.
+                with m.If(self.bus.txe | ~tx_fifo.r_rdy):
+                    m.next = "IDLE"
+
+        m.d.comb += [
+            self.bus.rd             .eq(~rd),
+            self.bus.wr             .eq(~wr),
+            self.bus.oe             .eq(~oe),
+
+            self.rx.payload         .eq(rx_fifo.r_data),
+            self.rx.valid           .eq(rx_fifo.r_rdy),
+            rx_fifo.r_en            .eq(self.rx.ready),
+
+            tx_fifo.w_data          .eq(self.tx.payload),
+            tx_fifo.w_en            .eq(self.tx.valid),
+            self.tx.ready           .eq(tx_fifo.w_rdy),
+        ]
+
+        return m
+
+
+class FT245SyncInterfaceTest(MultiProcessTestCase):
+
+    def test_loopback(self):
+        dut = FT245SyncInterface(rx_depth=8, tx_depth=8)
+
+        m = Module()
+        m.domains.usb = ClockDomain()
+        m.submodules.dut = dut
+
+        host_data = list(range(0x10, 0x10 + 24))
+        device_data = list(range(0x80, 0x80 + 24))
+        received = []
+
+        rx_driver = StreamDriver(dut.rx)
+        tx_driver = StreamDriver(dut.tx)
+
+        def chip_process():
+            yield Passive()
+
+            pending = list(host_data)
+
+            while True:
+                yield dut.bus.rxf.eq(0 if pending else 1)
+                yield dut.bus.txe.eq(0)
+                yield dut.bus.d.i.eq(pending[0] if pending else 0)
+                yield Settle()
+
+                if not (yield dut.bus.rd):
+                    self.assertEqual((yield dut.bus.oe), 0)
+                    if pending:
+                        pending.pop(0)
+
+                if not (yield dut.bus.wr):
+                    self.assertEqual((yield dut.bus.oe), 1)
+                    self.assertEqual((yield dut.bus.d.oe), 1)
+                    received.append((yield dut.bus.d.o))
+
+                yield
+
+        def rx_process():
+            yield from rx_driver.begin()
+            results = yield from rx_driver.consume(len(host_data))
+            self.assertEqual(results, host_data)
+
+        def tx_process():
+            yield from tx_driver.begin()
+            yield from tx_driver.produce(device_data)
+
+            for _ in range(50):
+                yield
+            self.assertEqual(received, device_data)
+
+        with self.simulate(m, traces=[dut.bus, dut.rx, dut.tx]) as sim:
+            sim.add_clock(1.0 / 80e6, domain='sync')
+            sim.add_clock(1.0 / 60e6, domain='usb')
+            sim.add_sync_process(chip_process, domain='usb')
+            sim.add_sync_process(rx_process)
+            sim.add_sync_process(tx_process)
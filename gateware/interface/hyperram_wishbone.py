@@ -0,0 +1,187 @@
+from nmigen import *
+from nmigen.hdl.rec import Record
+from nmigen.sim import *
+from nmigen.utils import log2_int
+from nmigen_soc import wishbone
+from nmigen_soc.memory import MemoryMap
+
+from interface.hyperram import HyperRAMInterface
+
+from test import *
+from test.driver.wishbone import WishboneInitiator
+
+
+class HyperRAMWishboneInterface(Elaboratable):
+    """ Wishbone slave for a HyperRAMInterface
+
+    Every transfer is a separate single-word HyperRAM transaction. With a 'granularity'
+    of 8, the memory map is byte-addressed so that the bus can sit behind byte-granular
+    converters and decoders, but byte selects are ignored: writes always store a full
+    16-bit word.
+    """
+
+    def __init__(self, *, bus, addr_width=22, granularity=16, **kwargs):
+        self.ram = HyperRAMInterface(bus=bus, **kwargs)
+
+        self.bus = wishbone.Interface(addr_width=addr_width, data_width=16,
+                                      granularity=granularity, features={"stall"})
+
+        map_addr_width = addr_width + log2_int(16 // granularity)
+        self.bus.memory_map = MemoryMap(addr_width=map_addr_width, data_width=granularity)
+        self.bus.memory_map.add_resource(self, size=2**map_addr_width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.ram = ram = self.ram
+
+        is_write   = Signal()
+        write_data = Signal(16)
+
+        m.d.comb += [
+            ram.address             .eq(self.bus.adr),
+            ram.perform_write       .eq(self.bus.we),
+            ram.write_data          .eq(write_data),
+            ram.final_word          .eq(1),
+
+            self.bus.dat_r          .eq(ram.read_data),
+        ]
+
+        with m.FSM():
+
+            with m.State("IDLE"):
+                m.d.comb += self.bus.stall.eq(~ram.idle)
+
+                with m.If(self.bus.cyc & self.bus.stb & ram.idle):
+                    m.d.comb += ram.start_transfer.eq(1)
+                    m.d.sync += [
+                        is_write    .eq(self.bus.we),
+                        write_data  .eq(self.bus.dat_w),
+                    ]
+                    m.next = "BUSY"
+
+            with m.State("BUSY"):
+                m.d.comb += self.bus.stall.eq(1)
+
+                # Reads complete with their data; writes once the RAM returns to idle.
+                with m.If(is_write & ram.idle):
+                    m.d.comb += self.bus.ack.eq(self.bus.cyc)
+                    m.next = "IDLE"
+                with m.Elif(~is_write & ram.new_data_ready):
+                    m.d.comb += self.bus.ack.eq(self.bus.cyc)
+                    m.next = "IDLE"
+
+        return m
+
+
+class _HyperRAMModel:
+    """ Minimal HyperRAM, which records each transaction and answers reads with 'read_data' """
+
+    def __init__(self, bus, read_data):
+        self.bus = bus
+        self.read_data = read_data
+
+        self.transactions = []
+
+    def emulate(self):
+        bus = self.bus
+
+        while True:
+            while not (yield bus.cs):
+                yield
+
+            # Six command bytes, then (for writes) two data bytes after the latency period.
+            command = yield from self._shift_out(6)
+            is_read = bool(command[0] & 0x80)
+            address = ((command[0] & 0x1F) << 27) | (command[1] << 19) | \
+                      (command[2] << 11) | (command[3] << 3) | (command[5] & 0x7)
+
+            if is_read:
+                for _ in range(2 * HyperRAMInterface.HIGH_LATENCY_EDGES):
+                    yield
+
+                # Each edge of RWDS presents a byte, most significant first.
+                for rwds, byte in ((1, self.read_data >> 8), (0, self.read_data & 0xFF)):
+                    yield bus.dq.i.eq(byte)
+                    yield bus.rwds.i.eq(rwds)
+                    yield
+
+                data = self.read_data
+            else:
+                msb, lsb = yield from self._shift_out(2)
+                data = (msb << 8) | lsb
+
+            self.transactions.append((is_read, address, data))
+
+            while (yield bus.cs):
+                yield
+
+    def _shift_out(self, count):
+        result = []
+        while len(result) < count:
+            yield
+            if (yield self.bus.dq.oe):
+                result.append((yield self.bus.dq.o))
+        return result
+
+
+class HyperRAMWishboneInterfaceTest(MultiProcessTestCase):
+
+    def _ram_signals(self):
+        return Record([
+            ("clk",   1),
+            ("clkN",  1),
+            ("dq",   [("i",  8), ("o",  8), ("oe", 1)]),
+            ("rwds", [("i",  1), ("o",  1), ("oe", 1)]),
+            ("cs",    1),
+            ("reset", 1)
+        ])
+
+    def test_read_write(self):
+        ram_signals = self._ram_signals()
+        dut = HyperRAMWishboneInterface(bus=ram_signals)
+
+        model       = _HyperRAMModel(ram_signals, read_data=0xCAFE)
+        intr_driver = WishboneInitiator(dut.bus)
+
+        def intr_process():
+            yield from intr_driver.begin()
+
+            result = yield from intr_driver.read_once(0x012345)
+            self.assertEqual(result, 0xCAFE)
+
+            # Write a word, waiting for its acknowledgement.
+            yield dut.bus.cyc.eq(1)
+            yield dut.bus.stb.eq(1)
+            yield dut.bus.we.eq(1)
+            yield dut.bus.adr.eq(0x000042)
+            yield dut.bus.dat_w.eq(0xBEEF)
+            yield
+            yield dut.bus.stb.eq(0)
+            while not (yield dut.bus.ack):
+                yield
+            yield dut.bus.cyc.eq(0)
+            yield dut.bus.we.eq(0)
+            yield
+
+            self.assertEqual(model.transactions, [
+                (True,  0x012345, 0xCAFE),
+                (False, 0x000042, 0xBEEF),
+            ])
+
+        def ram_process():
+            yield Passive()
+            yield from model.emulate()
+
+        with self.simulate(dut, traces=[dut.bus, ram_signals]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(ram_process)
+
+    def test_byte_granularity(self):
+        dut = HyperRAMWishboneInterface(bus=self._ram_signals(), granularity=8)
+
+        # Byte-addressed: twice as many units as the bus has words.
+        self.assertEqual(dut.bus.memory_map.addr_width, 23)
+        self.assertEqual(dut.bus.memory_map.data_width, 8)
+        self.assertEqual(len(dut.bus.sel), 2)
@@ -1,60 +1,102 @@
 from nmigen import *
 from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
+from nmigen.sim import *
 from nmigen.utils import log2_int
 
 from nmigen_soc import wishbone
 from nmigen_soc.memory import MemoryMap
 
+from lambdasoc.periph.base import Peripheral
+
 from test import *
+from test.driver.wishbone import WishboneInitiator
+from test.emulator.qspi_flash import QSPIFlashEmulator
 
 
 class QSPIBus(Record):
-    def __init__(self):
+    def __init__(self, chips=1):
+        # Multiple chips share SCK and CS#, with four data lines each (chip 0 in the lowest lanes)
         super().__init__([
             ('sck',  1, DIR_FANOUT),
             ('cs_n', 1, DIR_FANOUT),
             ('d', [
-                ('i',  4, DIR_FANIN),
-                ('o',  4, DIR_FANOUT),
-                ('oe', 4, DIR_FANOUT),
+                ('i',  4 * chips, DIR_FANIN),
+                ('o',  4 * chips, DIR_FANOUT),
+                ('oe', 4 * chips, DIR_FANOUT),
             ]),            
         ])
 
 
+def _spi_nibbles(value):
+    """ Spreads each bit of a byte onto DQ0 of its own nibble, MSB first, for single-line output. """
+    return Cat(*[Cat(value[i], C(0, 3)) for i in range(8)])
+
+
 class QSPIFlashInterface(Elaboratable):
 
     # You can change the data width of the interface by adjusting the lines marked with "data width"
 
-    def __init__(self):
-        self.qspi = QSPIBus()
+    # With two chips, consecutive bytes are striped nibble-wise across the devices in lockstep:
+    # chip 0 holds the high nibble and chip 1 the low nibble, so a full byte arrives every clock.
+
+    SFDP_COMMAND        = 0x5A
+    SFDP_DUMMY_CYCLES   = 8
+    SFDP_SIGNATURE      = 0x50444653
+
+    # Bytes read from the start of the Basic Flash Parameter Table (through DWORD 3)
+    BFPT_READ_LENGTH    = 10
+
+    # Clocks of mode bits that the controller always sends after the address
+    MODE_CYCLES         = 2
+
+    def __init__(self, *, chips=1, probe_sfdp=False):
+        if chips not in (1, 2):
+            raise ValueError("Chip count must be 1 or 2, not {!r}".format(chips))
+
+        self.chips = chips
+        self.probe_sfdp = probe_sfdp
+
+        self.qspi = QSPIBus(chips)
 
         self.start      = Signal()
-        self.address    = Signal(24)
+        self.address    = Signal(24 + log2_int(chips))
 
         self.idle       = Signal()
         self.valid      = Signal()
         self.data       = Signal(8)                                     # Data width
 
+        # Quad read parameters (discovered via SFDP when probing is enabled)
+        self.read_command = Signal(8, reset=0xEB)
+        self.dummy_cycles = Signal(5, reset=4)
+        self.sfdp_valid   = Signal()
+
         self._in_shift  = Signal(32)
         self._out_shift = Signal(32)
-        self._counter   = Signal(3)
+        self._counter   = Signal(5)
 
     def elaborate(self, platform):
         m = Module()
 
         cs = Signal()
 
+        lane_width  = 4 * self.chips
+        data_cycles = 8 // lane_width                                   # Data width
+
+        # Chip 0 supplies the most significant nibble
+        lanes_in = Cat(*[self.qspi.d.i[4 * c:4 * c + 4] for c in reversed(range(self.chips))])
+
         m.d.sync += [
-            self._in_shift[4:]      .eq(self._in_shift[:4]),            # Data width (see _out_shift)
+            self._in_shift[lane_width:] .eq(self._in_shift[:lane_width]),   # Data width (see _out_shift)
             self._out_shift[4:]     .eq(self._out_shift[:28]),
-            self._in_shift[0:4]     .eq(self.qspi.d.i),
+            self._in_shift[0:lane_width].eq(lanes_in),
             self._out_shift[0:4]    .eq(0),
 
             self.valid              .eq(0),
         ]
 
+        # Commands and addresses are driven identically onto every chip
         m.d.comb += [
-            self.qspi.d.o           .eq(self._out_shift[28:32]),
+            self.qspi.d.o           .eq(Repl(self._out_shift[28:32], self.chips)),
             self.data               .eq(self._in_shift),
 
             self.qspi.cs_n          .eq(~cs),
@@ -66,7 +108,20 @@ class QSPIFlashInterface(Elaboratable):
                 self._counter       .eq(self._counter - 1)
             ]
 
-        current_address     = Signal(24)
+        current_address     = Signal.like(self.address)
+        flash_address       = Signal(24)
+        dummy_cycles        = Signal(6)
+
+        m.d.comb += flash_address.eq(current_address[log2_int(self.chips):])
+
+        if self.chips > 1:
+            # Reads that start on an odd byte discard the first clock of data
+            m.d.comb += dummy_cycles.eq(self.dummy_cycles + current_address[0])
+        else:
+            m.d.comb += dummy_cycles.eq(self.dummy_cycles)
+
+        if self.probe_sfdp:
+            sfdp = self._elaborate_sfdp(m)
 
         with m.FSM():
 
@@ -76,7 +131,10 @@ class QSPIFlashInterface(Elaboratable):
 
             with m.State("STARTUP"):
                 with m.If(self._counter == 0):
-                    m.next = "IDLE"
+                    m.next = "SFDP_START" if self.probe_sfdp else "IDLE"
+
+            if self.probe_sfdp:
+                self._elaborate_sfdp_states(m, cs, sfdp)
 
             with m.State("IDLE"):
                 m.d.comb += self.idle           .eq(1)
@@ -91,8 +149,8 @@ class QSPIFlashInterface(Elaboratable):
                 m.next = "COMMAND"                    
                 m.d.sync += [
                     self._counter               .eq(7),
-                    self._out_shift             .eq(0x11101011),
-                    self.qspi.d.oe              .eq(0x1),
+                    self._out_shift             .eq(_spi_nibbles(self.read_command)),
+                    self.qspi.d.oe              .eq(self._lanes(0x1)),
 
                     cs                          .eq(1),
                     self.qspi.sck               .eq(1),
@@ -103,24 +161,27 @@ class QSPIFlashInterface(Elaboratable):
                     m.next = "ADDRESS"
                     m.d.sync += [                 
                         self._counter           .eq(7),
-                        self._out_shift[8:32]   .eq(current_address),
+                        self._out_shift[8:32]   .eq(flash_address),
                         self._out_shift[0:8]    .eq(0xF0),
-                        self.qspi.d.oe          .eq(0xF),
+                        self.qspi.d.oe          .eq(self._lanes(0xF)),
                     ]
 
             with m.State("ADDRESS"):
                 with m.If(self._counter == 0):
-                    m.next = "DUMMY"
-                    m.d.sync += [
-                        self._counter           .eq(3), 
-                        self.qspi.d.oe          .eq(0x0),
-                    ]
+                    m.d.sync += self.qspi.d.oe  .eq(0x0)
+
+                    with m.If(dummy_cycles == 0):
+                        m.next = "DATA"
+                        m.d.sync += self._counter.eq(data_cycles - 1)   # Data width
+                    with m.Else():
+                        m.next = "DUMMY"
+                        m.d.sync += self._counter.eq(dummy_cycles - 1)
 
             with m.State("DUMMY"):
                 with m.If(self._counter == 0):
                     m.next = "DATA"
                     m.d.sync += [
-                        self._counter           .eq(1),                 # Data width
+                        self._counter           .eq(data_cycles - 1),   # Data width
                     ]   
 
             with m.State("DATA"):
@@ -142,7 +203,7 @@ class QSPIFlashInterface(Elaboratable):
                     with m.If(self.address == current_address + 1):
                         m.next = "DATA"
                         m.d.sync += [
-                            self._counter       .eq(1),                 # Data width
+                            self._counter       .eq(data_cycles - 1),   # Data width
                             self.qspi.sck       .eq(1),
                         ]
                     with m.Else():
@@ -158,30 +219,292 @@ class QSPIFlashInterface(Elaboratable):
 
         return m
 
+    def _lanes(self, value):
+        """ Replicates a per-chip output enable pattern across every chip. """
+        return sum(value << (4 * c) for c in range(self.chips))
+
+    def _elaborate_sfdp(self, m):
+        """ Creates the datapath that parses SFDP bytes as they are shifted in on DQ1. """
+
+        sfdp = Record([
+            ('address',     24),
+            ('remaining',   range(16)),
+            ('index',       range(16)),
+            ('table',       1),
+            ('strobe',      1),
+            ('shift',       8),
+            ('signature',   32),
+            ('pointer',     24),
+            ('supported',   1),
+            ('wait',        5),
+            ('mode',        3),
+        ])
+
+        # Single-line reads return data on DQ1 (MISO), MSB first. With several chips, the
+        # parameters are taken from chip 0 and assumed to match the others.
+        m.d.sync += [
+            sfdp.shift              .eq(Cat(self.qspi.d.i[1], sfdp.shift[:7])),
+            sfdp.strobe             .eq(0),
+        ]
+
+        # A byte strobe is registered alongside the final bit, just as with 'valid' above
+        with m.If(sfdp.strobe):
+            m.d.sync += sfdp.index  .eq(sfdp.index + 1)
+
+            with m.If(~sfdp.table):
+                with m.Switch(sfdp.index):
+                    for i in range(4):
+                        with m.Case(i):
+                            m.d.sync += sfdp.signature.word_select(i, 8).eq(sfdp.shift)
+                    for i in range(3):
+                        with m.Case(0x0C + i):
+                            m.d.sync += sfdp.pointer.word_select(i, 8).eq(sfdp.shift)
+
+            with m.Else():
+                with m.Switch(sfdp.index):
+                    # DWORD 1, bit 21: supports 1-4-4 fast read
+                    with m.Case(2):
+                        m.d.sync += sfdp.supported.eq(sfdp.shift[5])
+                    # DWORD 3, bits 0-7: 1-4-4 wait states and mode clocks
+                    with m.Case(8):
+                        m.d.sync += [
+                            sfdp.wait   .eq(sfdp.shift[0:5]),
+                            sfdp.mode   .eq(sfdp.shift[5:8]),
+                        ]
+                    # DWORD 3, bits 8-15: 1-4-4 fast read instruction
+                    with m.Case(9):
+                        m.d.sync += self.read_command.eq(sfdp.shift)
+
+        return sfdp
+
+    def _elaborate_sfdp_states(self, m, cs, sfdp):
+        """ Adds the FSM states that read the SFDP header and the Basic Flash Parameter Table. """
+
+        # Mode clocks are sent by the ADDRESS state, so they count against the wait states.
+        total_wait = Signal(6)
+        m.d.comb += total_wait.eq(sfdp.wait + sfdp.mode)
+
+        with m.State("SFDP_START"):
+            m.next = "SFDP_COMMAND"
+            m.d.sync += [
+                self._counter               .eq(7),
+                self._out_shift             .eq(_spi_nibbles(C(self.SFDP_COMMAND, 8))),
+                self.qspi.d.oe              .eq(self._lanes(0x1)),
+
+                sfdp.index                  .eq(0),
+
+                cs                          .eq(1),
+                self.qspi.sck               .eq(1),
+            ]
+
+            with m.If(~sfdp.table):
+                m.d.sync += [
+                    sfdp.address            .eq(0),
+                    sfdp.remaining          .eq(0x0F),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    sfdp.address            .eq(sfdp.pointer),
+                    sfdp.remaining          .eq(self.BFPT_READ_LENGTH - 1),
+                ]
+
+        with m.State("SFDP_COMMAND"):
+            with m.If(self._counter == 0):
+                m.next = "SFDP_ADDRESS"
+                m.d.sync += [
+                    self._counter           .eq(7),
+                    self._out_shift         .eq(_spi_nibbles(sfdp.address[16:24])),
+                    sfdp.address            .eq(sfdp.address << 8),
+                    sfdp.index              .eq(2),
+                ]
+
+        # Shift out the three address bytes, one bit per clock. The byte index doubles as a
+        # count of the address bytes that remain, and is cleared again before any data arrives.
+        with m.State("SFDP_ADDRESS"):
+            with m.If(self._counter == 0):
+                m.d.sync += self._counter   .eq(7)
+
+                with m.If(sfdp.index == 0):
+                    m.next = "SFDP_DUMMY"
+                    m.d.sync += [
+                        self._counter       .eq(self.SFDP_DUMMY_CYCLES - 1),
+                        self.qspi.d.oe      .eq(0x0),
+                    ]
+                with m.Else():
+                    m.d.sync += [
+                        self._out_shift     .eq(_spi_nibbles(sfdp.address[16:24])),
+                        sfdp.address        .eq(sfdp.address << 8),
+                        sfdp.index          .eq(sfdp.index - 1),
+                    ]
+
+        with m.State("SFDP_DUMMY"):
+            with m.If(self._counter == 0):
+                m.next = "SFDP_DATA"
+                m.d.sync += self._counter   .eq(7)
+
+        with m.State("SFDP_DATA"):
+            with m.If(self._counter == 0):
+                m.d.sync += [
+                    self._counter           .eq(7),
+                    sfdp.strobe             .eq(1),
+                    sfdp.remaining          .eq(sfdp.remaining - 1),
+                ]
+
+                with m.If(sfdp.remaining == 0):
+                    m.next = "SFDP_END"
+                    m.d.sync += [
+                        cs                  .eq(0),
+                        self.qspi.sck       .eq(0),
+                    ]
+
+        # Wait out the deselect time (and the final byte strobe) before continuing.
+        with m.State("SFDP_END"):
+            with m.If(self._counter == 0):
+
+                with m.If(~sfdp.table & (sfdp.signature == self.SFDP_SIGNATURE)):
+                    m.next = "SFDP_START"
+                    m.d.sync += sfdp.table  .eq(1)
+
+                with m.Else():
+                    m.next = "IDLE"
+
+                    # Only trust the table if the part reports 1-4-4 reads; otherwise keep the defaults.
+                    with m.If(sfdp.table & sfdp.supported):
+                        m.d.sync += [
+                            self.sfdp_valid     .eq(1),
+                            self.dummy_cycles   .eq(Mux(total_wait > self.MODE_CYCLES,
+                                                        total_wait - self.MODE_CYCLES, 0)),
+                        ]
+                    with m.Else():
+                        m.d.sync += self.read_command.eq(self.read_command.reset)
+
 
 class QSPIFlashWishboneInterface(Elaboratable):
+    """ Wishbone slave for a QSPIFlashInterface
+
+    Every state of the flash interface ends when its cycle counter expires, and none of them
+    waits on the flash, so a read always completes within a bounded number of clocks. What can
+    go wrong is on the bus side, and both cases are counted:
+
+    - The flash is read-only. Writes never reach it; they terminate with ERR when the "err"
+      feature is requested, and are acknowledged otherwise. Each one counts in 'errors'.
+    - A read can't be cancelled once it has started. If its bus cycle ends first, the read
+      still finishes, but without an acknowledgement that a later cycle could mistake for its
+      own. Each one counts in 'aborts'.
+
+    QSPIFlashStatusPeripheral exposes the counters as CSRs.
+    """
+
+    def __init__(self, *, chips=1, probe_sfdp=False, features=frozenset(), counter_width=16):
+        self.chips = chips
+        self.probe_sfdp = probe_sfdp
+
+        addr_width = 24 + log2_int(chips)
+
+        self.qspi = QSPIBus(chips)
+        self.bus = wishbone.Interface(addr_width=addr_width, data_width=8,
+                                      features={"stall"} | set(features))
 
-    def __init__(self):
-        self.qspi = QSPIBus()
-        self.bus = wishbone.Interface(addr_width=24, data_width=8, features={"stall"})
+        # Statistics
+        self.errors = Signal(counter_width)
+        self.aborts = Signal(counter_width)
+        self.clear  = Signal()
 
-        self.bus.memory_map = MemoryMap(addr_width=24, data_width=8)
-        self.bus.memory_map.add_resource(self, size=2**24)
+        self.bus.memory_map = MemoryMap(addr_width=addr_width, data_width=8)
+        self.bus.memory_map.add_resource(self, size=2**addr_width)
 
     def elaborate(self, platform):
         m = Module()
 
-        m.submodules.interface = interface = QSPIFlashInterface()
+        m.submodules.interface = interface = QSPIFlashInterface(chips=self.chips,
+                                                                probe_sfdp=self.probe_sfdp)
+
+        read        = Signal()
+        write       = Signal()
+        write_done  = Signal()
+        pending     = Signal()
+        aborted     = Signal()
+        response    = Signal()
 
         m.d.comb += [
             interface.qspi          .connect(self.qspi),
 
-            interface.start         .eq(self.bus.cyc & self.bus.stb),
+            interface.start         .eq(self.bus.cyc & self.bus.stb & ~self.bus.we),
             interface.address       .eq(self.bus.adr),
 
+            read                    .eq(interface.start & interface.idle),
+            write                   .eq(self.bus.cyc & self.bus.stb & self.bus.we & interface.idle),
+            response                .eq(interface.valid & self.bus.cyc & ~aborted),
+
             self.bus.stall          .eq(~interface.idle),
             self.bus.dat_r          .eq(interface.data),
-            self.bus.ack            .eq(interface.valid),
+        ]
+
+        m.d.sync += write_done.eq(write)
+
+        with m.If(read):
+            m.d.sync += [
+                pending             .eq(1),
+                aborted             .eq(0),
+            ]
+        with m.Elif(interface.valid):
+            m.d.sync += pending     .eq(0)
+
+        with m.If(pending & ~self.bus.cyc):
+            m.d.sync += aborted     .eq(1)
+
+        if hasattr(self.bus, "err"):
+            m.d.comb += [
+                self.bus.ack        .eq(response),
+                self.bus.err        .eq(write_done),
+            ]
+        else:
+            m.d.comb += self.bus.ack.eq(response | write_done)
+
+        # Statistics
+
+        with m.If(self.clear):
+            m.d.sync += [
+                self.errors         .eq(0),
+                self.aborts         .eq(0),
+            ]
+        with m.Else():
+            with m.If(write):
+                m.d.sync += self.errors.eq(self.errors + 1)
+            with m.If(interface.valid & ~response):
+                m.d.sync += self.aborts.eq(self.aborts + 1)
+
+        return m
+
+
+class QSPIFlashStatusPeripheral(Peripheral, Elaboratable):
+    """ Exposes the error and abort counters of a QSPIFlashWishboneInterface
+
+    Writing to 'clear' resets both counters.
+    """
+
+    def __init__(self, flash):
+        super().__init__()
+
+        self.flash = flash
+
+        bank            = self.csr_bank()
+        self._clear     = bank.csr(1, "w")
+        self._errors    = bank.csr(len(flash.errors), "r")
+        self._aborts    = bank.csr(len(flash.aborts), "r")
+
+        self._bridge  = self.bridge(data_width=32, granularity=8, alignment=2)
+        self.bus      = self._bridge.bus
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.bridge = self._bridge
+
+        m.d.comb += [
+            self.flash.clear        .eq(self._clear.w_stb & self._clear.w_data),
+
+            self._errors.r_data     .eq(self.flash.errors),
+            self._aborts.r_data     .eq(self.flash.aborts),
         ]
 
         return m
@@ -357,3 +680,200 @@ class QSPIFlashWishboneInterfaceTest(ModuleTestCase):
         yield
 
         yield from self.advance_cycles(20)
+
+
+class QSPIFlashSFDPTest(MultiProcessTestCase):
+
+    def test_probe(self):
+        dut = QSPIFlashInterface(probe_sfdp=True)
+
+        flash = QSPIFlashEmulator(dut.qspi, [0x12, 0x34, 0x56], dummy_cycles=6)
+
+        def flash_process():
+            yield Passive()
+            yield from flash.emulate()
+
+        def probe_process():
+            cycles = 0
+            while not (yield dut.idle):
+                yield
+                cycles += 1
+                self.assertLess(cycles, 1000)
+
+            self.assertEqual((yield dut.sfdp_valid),   1)
+            self.assertEqual((yield dut.read_command), 0xEB)
+            self.assertEqual((yield dut.dummy_cycles), 6)
+
+            yield dut.address.eq(0x000001)
+            yield dut.start.eq(1)
+            yield
+            yield dut.start.eq(0)
+
+            cycles = 0
+            while not (yield dut.valid):
+                yield
+                cycles += 1
+                self.assertLess(cycles, 100)
+
+            self.assertEqual((yield dut.data), 0x34)
+
+        with self.simulate(dut, traces=[dut.qspi]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(flash_process)
+            sim.add_sync_process(probe_process)
+
+
+class QSPIFlashStripedTest(MultiProcessTestCase):
+
+    def test_sequential(self):
+        dut = QSPIFlashWishboneInterface(chips=2)
+
+        data = list(range(0x10, 0x30))
+
+        flash = QSPIFlashEmulator(dut.qspi, data, chips=2)
+        initiator = WishboneInitiator(dut.bus)
+
+        def flash_process():
+            yield Passive()
+            yield from flash.emulate()
+
+        def initiator_process():
+            yield from initiator.begin()
+
+            result = yield from initiator.read_sequential(4, 0x000003, 1)
+            self.assertEqual(result, data[3:7])
+
+        with self.simulate(dut, traces=[dut.qspi, dut.bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(flash_process)
+            sim.add_sync_process(initiator_process)
+
+
+class QSPIFlashErrorTest(MultiProcessTestCase):
+
+    def _write(self, bus, address):
+        yield bus.cyc.eq(1)
+        yield bus.we.eq(1)
+        yield bus.stb.eq(1)
+        yield bus.adr.eq(address)
+        yield Settle()
+
+        while (yield bus.stall):
+            yield
+            yield Settle()
+
+        yield
+        yield bus.stb.eq(0)
+        yield Settle()
+
+        cycles = 0
+        while not ((yield bus.ack) or (yield bus.err)):
+            yield
+            yield Settle()
+            cycles += 1
+            self.assertLess(cycles, 10)
+
+        result = ((yield bus.ack), (yield bus.err))
+
+        yield bus.cyc.eq(0)
+        yield bus.we.eq(0)
+        yield
+
+        return result
+
+    def _test_write(self, features, expected):
+        dut = QSPIFlashWishboneInterface(features=features)
+
+        data = list(range(0x10, 0x30))
+
+        flash = QSPIFlashEmulator(dut.qspi, data)
+        initiator = WishboneInitiator(dut.bus)
+
+        def flash_process():
+            yield Passive()
+            yield from flash.emulate()
+
+        def initiator_process():
+            yield from initiator.begin()
+
+            self.assertEqual((yield from self._write(dut.bus, 0x000004)), expected)
+            self.assertEqual((yield dut.errors), 1)
+
+            # The write never reached the flash.
+            self.assertEqual((yield from initiator.read_once(0x000004)), data[4])
+
+            yield dut.clear.eq(1)
+            yield
+            yield dut.clear.eq(0)
+            yield
+            self.assertEqual((yield dut.errors), 0)
+
+        with self.simulate(dut, traces=[dut.qspi, dut.bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(flash_process)
+            sim.add_sync_process(initiator_process)
+
+    def test_write_error(self):
+        self._test_write({"err"}, (0, 1))
+
+    def test_write_ack(self):
+        self._test_write(set(), (1, 0))
+
+    def test_abort(self):
+        dut = QSPIFlashWishboneInterface()
+
+        data = list(range(0x10, 0x30))
+
+        flash = QSPIFlashEmulator(dut.qspi, data)
+        initiator = WishboneInitiator(dut.bus)
+
+        def flash_process():
+            yield Passive()
+            yield from flash.emulate()
+
+        def initiator_process():
+            yield from initiator.begin()
+
+            # Give up on a read shortly after it was accepted.
+            yield dut.bus.cyc.eq(1)
+            yield dut.bus.stb.eq(1)
+            yield dut.bus.adr.eq(0x000002)
+            yield Settle()
+            while (yield dut.bus.stall):
+                yield
+                yield Settle()
+            yield
+            yield dut.bus.stb.eq(0)
+            yield
+            yield dut.bus.cyc.eq(0)
+            yield
+
+            # Start another cycle straight away; it may only see its own response.
+            yield dut.bus.cyc.eq(1)
+            yield dut.bus.adr.eq(0x000008)
+            yield dut.bus.stb.eq(1)
+            yield Settle()
+            while (yield dut.bus.stall):
+                self.assertEqual((yield dut.bus.ack), 0)
+                yield
+                yield Settle()
+            self.assertEqual((yield dut.bus.ack), 0)
+            yield
+            yield dut.bus.stb.eq(0)
+
+            cycles = 0
+            while not (yield dut.bus.ack):
+                yield
+                cycles += 1
+                self.assertLess(cycles, 100)
+
+            self.assertEqual((yield dut.bus.dat_r), data[8])
+            yield dut.bus.cyc.eq(0)
+            yield
+
+            self.assertEqual((yield dut.aborts), 1)
+
+        with self.simulate(dut, traces=[dut.qspi, dut.bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(flash_process)
+            sim.add_sync_process(initiator_process)
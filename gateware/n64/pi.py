@@ -2,8 +2,10 @@ from nmigen import *
 from nmigen_soc import wishbone
 from lambdasoc.periph.sram  import SRAMPeripheral
 
+from soc.wishbone import PriorityArbiter
+
 from .ad16 import AD16, AD16Interface
-from .burst import BurstDecoder, DirectBurst2Wishbone, BufferedBurst2Wishbone
+from .burst import BurstBus, BurstDecoder, DirectBurst2Wishbone, BufferedBurst2Wishbone
 
 from test import *
 
@@ -16,6 +18,9 @@ class PIWishboneInitiator(Elaboratable):
         self.late_block = Signal()
         self.late_read = Signal()
 
+        # A copy of the burst bus, for observation only.
+        self.monitor = BurstBus()
+
     def elaborate(self, platform):
         m = Module()
 
@@ -23,8 +28,10 @@ class PIWishboneInitiator(Elaboratable):
         m.submodules.decoder   = decoder   = BurstDecoder()
         m.submodules.direct    = direct    = DirectBurst2Wishbone()
         m.submodules.buffered  = buffered  = BufferedBurst2Wishbone()
-        m.submodules.arbiter   = arbiter   = wishbone.Arbiter(addr_width=32, data_width=32, features={"stall"})
+        m.submodules.arbiter   = arbiter   = PriorityArbiter(addr_width=32, data_width=32, features={"stall"})
 
+        # BurstDecoder currently routes every burst to the buffered path, so only that initiator
+        # is ever active. The direct one is given priority for when direct reads are re-enabled.
         arbiter.add(direct.wbbus)
         arbiter.add(buffered.wbbus)
 
@@ -37,6 +44,7 @@ class PIWishboneInitiator(Elaboratable):
 
             self.late_block     .eq(interface.late_block),
             self.late_read      .eq(interface.late_read),
+            self.monitor        .eq(interface.bus),
         ]
 
         return m
@@ -0,0 +1,231 @@
+import zlib
+
+from nmigen import *
+from nmigen.sim import *
+from nmigen_soc import wishbone
+
+from lambdasoc.periph.base import Peripheral
+
+from test import *
+from test.emulator.wishbone import WishboneEmulator
+
+
+class CRC32(Elaboratable):
+    """ CRC-32 (IEEE 802.3, as computed by zlib.crc32)
+
+    Each cycle takes 'width' bits, least significant first; for wider inputs, the first
+    byte of the message is therefore in the lowest byte of 'data'.
+    """
+
+    POLYNOMIAL = 0xEDB88320
+
+    def __init__(self, width=8):
+        self.width = width
+
+        self.clear = Signal()
+        self.data  = Signal(width)
+        self.valid = Signal()
+
+        self.crc   = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        state = Signal(32, reset=0xFFFFFFFF)
+
+        # Unroll the bitwise (reflected) LFSR for a full word per cycle.
+        next_state = state
+        for i in range(self.width):
+            feedback   = next_state[0] ^ self.data[i]
+            next_state = Mux(feedback, (next_state >> 1) ^ self.POLYNOMIAL, next_state >> 1)
+
+        with m.If(self.clear):
+            m.d.sync += state.eq(state.reset)
+        with m.Elif(self.valid):
+            m.d.sync += state.eq(next_state)
+
+        m.d.comb += self.crc.eq(~state)
+
+        return m
+
+
+class WishboneCRCReader(Elaboratable):
+    """ Streams a region of an 8-bit Wishbone bus through a CRC-32
+
+    Strobes are issued back-to-back with incrementing addresses, so a slave that
+    supports sequential bursts (like QSPIFlashWishboneInterface) runs at full speed.
+    """
+
+    def __init__(self, *, addr_width=24, max_outstanding=4):
+        self.max_outstanding = max_outstanding
+
+        self.bus = wishbone.Interface(addr_width=addr_width, data_width=8, features={"stall"})
+
+        self.start   = Signal()
+        self.address = Signal(addr_width)
+        self.length  = Signal(addr_width + 1)
+
+        self.busy    = Signal()
+        self.crc     = Signal(32)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.crc = crc = CRC32()
+
+        address        = Signal.like(self.address)
+        stb_remaining  = Signal.like(self.length)
+        ack_remaining  = Signal.like(self.length)
+        outstanding    = Signal(range(self.max_outstanding + 1))
+
+        did_stb = Signal()
+        did_ack = Signal()
+
+        m.d.comb += [
+            self.bus.adr        .eq(address),
+            self.bus.we         .eq(0),
+
+            did_stb             .eq(self.bus.cyc & self.bus.stb & ~self.bus.stall),
+            did_ack             .eq(self.bus.cyc & self.bus.ack),
+
+            crc.data            .eq(self.bus.dat_r),
+            crc.valid           .eq(did_ack),
+            self.crc            .eq(crc.crc),
+        ]
+
+        with m.If(did_stb & ~did_ack):
+            m.d.sync += outstanding.eq(outstanding + 1)
+        with m.Elif(~did_stb & did_ack):
+            m.d.sync += outstanding.eq(outstanding - 1)
+
+        with m.If(did_stb):
+            m.d.sync += [
+                address         .eq(address + 1),
+                stb_remaining   .eq(stb_remaining - 1),
+            ]
+
+        with m.If(did_ack):
+            m.d.sync += ack_remaining.eq(ack_remaining - 1)
+
+        with m.FSM():
+
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.comb += crc.clear.eq(1)
+                    m.d.sync += [
+                        address         .eq(self.address),
+                        stb_remaining   .eq(self.length),
+                        ack_remaining   .eq(self.length),
+                    ]
+
+                    with m.If(self.length != 0):
+                        m.next = "READING"
+
+            with m.State("READING"):
+                m.d.comb += [
+                    self.busy           .eq(1),
+                    self.bus.cyc        .eq(1),
+                    self.bus.stb        .eq((stb_remaining != 0) &
+                                            (outstanding < self.max_outstanding)),
+                ]
+
+                with m.If(did_ack & (ack_remaining == 1)):
+                    m.next = "IDLE"
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.start,
+            self.address,
+            self.length,
+            self.busy,
+            self.crc,
+        ]
+
+
+class CRC32Peripheral(Peripheral, Elaboratable):
+    """ CSR front-end for a WishboneCRCReader
+
+    Writing the 'start' register begins a pass over 'length' bytes at 'address';
+    'crc' holds the result once 'busy' reads back as zero.
+    """
+
+    def __init__(self, *, addr_width=24):
+        super().__init__()
+
+        self.reader   = WishboneCRCReader(addr_width=addr_width)
+        self.mem_bus  = self.reader.bus
+
+        bank           = self.csr_bank()
+        self._address  = bank.csr(32, "rw")
+        self._length   = bank.csr(32, "rw")
+        self._start    = bank.csr(1,  "w")
+        self._busy     = bank.csr(1,  "r")
+        self._crc      = bank.csr(32, "r")
+
+        self._bridge  = self.bridge(data_width=32, granularity=8, alignment=2)
+        self.bus      = self._bridge.bus
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.bridge = self._bridge
+        m.submodules.reader = reader = self.reader
+
+        address = Signal(32)
+        length  = Signal(32)
+
+        with m.If(self._address.w_stb):
+            m.d.sync += address.eq(self._address.w_data)
+
+        with m.If(self._length.w_stb):
+            m.d.sync += length.eq(self._length.w_data)
+
+        m.d.comb += [
+            self._address.r_data    .eq(address),
+            self._length.r_data     .eq(length),
+            self._busy.r_data       .eq(reader.busy),
+            self._crc.r_data        .eq(reader.crc),
+
+            reader.address          .eq(address),
+            reader.length           .eq(length),
+            reader.start            .eq(self._start.w_stb & self._start.w_data),
+        ]
+
+        return m
+
+
+class WishboneCRCReaderTest(MultiProcessTestCase):
+
+    def test_region(self):
+        dut = WishboneCRCReader()
+
+        # The emulator returns a counter, so the region contains the bytes 0x20, 0x21, ...
+        sub_emulator = WishboneEmulator(dut.bus, initial=0x20, delay=2, max_outstanding=2)
+
+        def reader_process():
+            yield dut.address.eq(0x001000)
+            yield dut.length.eq(64)
+            yield dut.start.eq(1)
+            yield
+            yield dut.start.eq(0)
+            yield
+
+            cycles = 0
+            while (yield dut.busy):
+                yield
+                cycles += 1
+                self.assertLess(cycles, 500)
+
+            expected = zlib.crc32(bytes(range(0x20, 0x20 + 64)))
+            self.assertEqual((yield dut.crc), expected)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(reader_process)
+            sim.add_sync_process(sub_process)
@@ -0,0 +1,266 @@
+from nmigen import *
+from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
+from nmigen.lib.fifo import SyncFIFO
+from nmigen.sim import *
+from nmigen_soc import wishbone
+from nmigen_soc.wishbone import CycleType
+
+from soc.stream import BasicStream
+
+from test import *
+from test.driver.stream import StreamDriver
+from test.emulator.wishbone import RecordingWishboneEmulator, WishboneEmulator
+
+
+class DMADescriptor(Record):
+    """ A transfer of 'length' words starting at 'address', handed over with valid/ready """
+
+    def __init__(self, addr_width):
+        super().__init__([
+            ('address',     addr_width,     DIR_FANOUT),
+            ('length',      addr_width + 1, DIR_FANOUT),
+            ('valid',       1,              DIR_FANOUT),
+            ('ready',       1,              DIR_FANIN),
+        ])
+
+
+class _WishboneDMA(Elaboratable):
+    """ Bookkeeping shared by both directions of transfer
+
+    Strobes carry incrementing addresses and (when 'burst' is set) are tagged as an
+    incrementing burst, ending with END_OF_BURST on the final word of each descriptor.
+    No more than 'max_outstanding' strobes are ever waiting on acknowledgement.
+    """
+
+    def __init__(self, *, addr_width=24, data_width=8, max_outstanding=4, burst=True):
+        self.max_outstanding = max_outstanding
+        self.burst = burst
+
+        self.bus = wishbone.Interface(addr_width=addr_width, data_width=data_width,
+            features={"stall", "cti", "bte"})
+
+        self.descriptor = DMADescriptor(addr_width)
+        self.busy       = Signal()
+
+    def _elaborate_transfer(self, m, *, we, credit):
+        """ Adds the descriptor FSM; returns the (did_stb, did_ack) strobes of the bus """
+
+        address        = Signal.like(self.descriptor.address)
+        stb_remaining  = Signal.like(self.descriptor.length)
+        ack_remaining  = Signal.like(self.descriptor.length)
+        outstanding    = Signal(range(self.max_outstanding + 1))
+
+        did_stb = Signal()
+        did_ack = Signal()
+
+        m.d.comb += [
+            self.bus.adr        .eq(address),
+            self.bus.we         .eq(we),
+            self.bus.sel        .eq(Repl(1, len(self.bus.sel))),
+            self.bus.bte        .eq(0),
+
+            did_stb             .eq(self.bus.cyc & self.bus.stb & ~self.bus.stall),
+            did_ack             .eq(self.bus.cyc & self.bus.ack),
+        ]
+
+        if self.burst:
+            m.d.comb += self.bus.cti.eq(Mux(stb_remaining == 1,
+                CycleType.END_OF_BURST, CycleType.INCR_BURST))
+        else:
+            m.d.comb += self.bus.cti.eq(CycleType.CLASSIC)
+
+        with m.If(did_stb & ~did_ack):
+            m.d.sync += outstanding.eq(outstanding + 1)
+        with m.Elif(~did_stb & did_ack):
+            m.d.sync += outstanding.eq(outstanding - 1)
+
+        with m.If(did_stb):
+            m.d.sync += [
+                address         .eq(address + 1),
+                stb_remaining   .eq(stb_remaining - 1),
+            ]
+
+        with m.If(did_ack):
+            m.d.sync += ack_remaining.eq(ack_remaining - 1)
+
+        with m.FSM():
+
+            with m.State("IDLE"):
+                m.d.comb += self.descriptor.ready.eq(1)
+
+                with m.If(self.descriptor.valid):
+                    m.d.sync += [
+                        address         .eq(self.descriptor.address),
+                        stb_remaining   .eq(self.descriptor.length),
+                        ack_remaining   .eq(self.descriptor.length),
+                    ]
+
+                    with m.If(self.descriptor.length != 0):
+                        m.next = "TRANSFER"
+
+            with m.State("TRANSFER"):
+                m.d.comb += [
+                    self.busy           .eq(1),
+                    self.bus.cyc        .eq(1),
+                    self.bus.stb        .eq((stb_remaining != 0) &
+                                            (outstanding < self.max_outstanding) &
+                                            credit(outstanding)),
+                ]
+
+                with m.If(did_ack & (ack_remaining == 1)):
+                    m.next = "IDLE"
+
+        return did_stb, did_ack
+
+
+class WishboneDMAReader(_WishboneDMA):
+    """ Reads the region of each descriptor from Wishbone into a stream
+
+    Acknowledged words land in a FIFO deep enough for every outstanding strobe, so a
+    stalled consumer throttles the bus instead of losing data.
+    """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.sink = BasicStream(len(self.bus.dat_r))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.fifo = fifo = SyncFIFO(width=len(self.bus.dat_r), depth=self.max_outstanding)
+
+        # Only issue a strobe if its data is guaranteed a place in the FIFO.
+        def credit(outstanding):
+            return (outstanding + fifo.level) < self.max_outstanding
+
+        _, did_ack = self._elaborate_transfer(m, we=0, credit=credit)
+
+        m.d.comb += [
+            fifo.w_data         .eq(self.bus.dat_r),
+            fifo.w_en           .eq(did_ack),
+
+            self.sink.payload   .eq(fifo.r_data),
+            self.sink.valid     .eq(fifo.r_rdy),
+            fifo.r_en           .eq(self.sink.ready),
+        ]
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.descriptor,
+            self.sink,
+            self.busy,
+        ]
+
+
+class WishboneDMAWriter(_WishboneDMA):
+    """ Writes a stream into the region of each descriptor on Wishbone """
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+
+        self.source = BasicStream(len(self.bus.dat_w))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        did_stb, _ = self._elaborate_transfer(m, we=1, credit=lambda _: self.source.valid)
+
+        m.d.comb += [
+            self.bus.dat_w      .eq(self.source.payload),
+            self.source.ready   .eq(did_stb),
+        ]
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.descriptor,
+            self.source,
+            self.busy,
+        ]
+
+
+class WishboneDMAReaderTest(MultiProcessTestCase):
+
+    def test_region(self):
+        dut = WishboneDMAReader(max_outstanding=4)
+
+        sub_emulator = WishboneEmulator(dut.bus, initial=0x40, delay=2, max_outstanding=3)
+        stream_driver = StreamDriver(dut.sink)
+
+        def descriptor_process():
+            yield dut.descriptor.address.eq(0x001000)
+            yield dut.descriptor.length.eq(32)
+            yield dut.descriptor.valid.eq(1)
+            yield
+            yield dut.descriptor.valid.eq(0)
+
+        def stream_process():
+            yield from stream_driver.begin()
+
+            # Consume slowly at first, so that the FIFO fills and throttles the bus.
+            results = []
+            for _ in range(8):
+                results += (yield from stream_driver.consume(1))
+                yield
+                yield
+            results += (yield from stream_driver.consume(24))
+
+            self.assertEqual(results, list(range(0x40, 0x40 + 32)))
+
+            yield
+            self.assertEqual((yield dut.busy), 0)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(descriptor_process)
+            sim.add_sync_process(stream_process)
+            sim.add_sync_process(sub_process)
+
+
+class WishboneDMAWriterTest(MultiProcessTestCase):
+
+    def test_region(self):
+        dut = WishboneDMAWriter(max_outstanding=4)
+
+        sub_emulator = RecordingWishboneEmulator(dut.bus, delay=2, max_outstanding=3)
+        stream_driver = StreamDriver(dut.source)
+
+        def descriptor_process():
+            yield dut.descriptor.address.eq(0x002000)
+            yield dut.descriptor.length.eq(16)
+            yield dut.descriptor.valid.eq(1)
+            yield
+            yield dut.descriptor.valid.eq(0)
+
+        def stream_process():
+            yield from stream_driver.begin()
+            yield from stream_driver.produce(range(0x80, 0x80 + 16))
+
+            cycles = 0
+            while (yield dut.busy):
+                yield
+                cycles += 1
+                self.assertLess(cycles, 100)
+
+            self.assertEqual(sub_emulator.writes,
+                [(0x002000 + i, 0x80 + i) for i in range(16)])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(descriptor_process)
+            sim.add_sync_process(stream_process)
+            sim.add_sync_process(sub_process)
@@ -0,0 +1,266 @@
+from nmigen import *
+from nmigen.lib.fifo import SyncFIFO
+from nmigen.sim import *
+from nmigen_soc.wishbone import Interface
+
+from lambdasoc.periph.base import Peripheral
+
+from test import *
+from test.driver.wishbone import WishboneInitiator
+from test.emulator.wishbone import WishboneEmulator
+
+
+class WishboneMonitor(Peripheral, Elaboratable):
+    """ Passive bus monitor with performance counters
+
+    Counts the cycles in which CYC, STB, STALL and ACK are asserted on the observed bus,
+    the number of transfers, and a histogram of transfer latencies (from the accepted
+    strobe to its acknowledgement). Latency bucket 0 counts single-cycle transfers, and
+    bucket i counts latencies in [2**(i-1) + 1, 2**i]; the final bucket also takes
+    everything longer. Writing to 'clear' resets every counter.
+
+    On a pipelined bus, up to 'max_outstanding' transfers are timed at once. If more are
+    outstanding, 'overflow' is set (until cleared) and the rest of that bus cycle's
+    transfers are left out of the histogram rather than being mistimed.
+    """
+
+    def __init__(self, bus, *, buckets=8, max_outstanding=4, counter_width=32):
+        super().__init__()
+
+        self.observed        = bus
+        self.buckets         = buckets
+        self.max_outstanding = max_outstanding
+
+        self.cyc_cycles   = Signal(counter_width)
+        self.stb_cycles   = Signal(counter_width)
+        self.stall_cycles = Signal(counter_width)
+        self.ack_cycles   = Signal(counter_width)
+        self.transfers    = Signal(counter_width)
+        self.overflow     = Signal()
+        self.latency      = [Signal(counter_width, name="latency_{}".format(i)) for i in range(buckets)]
+
+        bank                = self.csr_bank()
+        self._clear         = bank.csr(1, "w")
+        self._cyc_cycles    = bank.csr(counter_width, "r")
+        self._stb_cycles    = bank.csr(counter_width, "r")
+        self._stall_cycles  = bank.csr(counter_width, "r")
+        self._ack_cycles    = bank.csr(counter_width, "r")
+        self._transfers     = bank.csr(counter_width, "r")
+        self._overflow      = bank.csr(1, "r")
+        self._latency       = [bank.csr(counter_width, "r", name="latency_{}".format(i))
+                               for i in range(buckets)]
+
+        self._bridge  = self.bridge(data_width=32, granularity=8, alignment=2)
+        self.bus      = self._bridge.bus
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.bridge = self._bridge
+
+        bus = self.observed
+
+        stall = bus.stall if hasattr(bus, "stall") else Const(0)
+
+        # Classic cycles are accepted when they're acknowledged.
+        accepted = Signal()
+        if hasattr(bus, "stall"):
+            m.d.comb += accepted.eq(bus.cyc & bus.stb & ~bus.stall)
+        else:
+            m.d.comb += accepted.eq(bus.cyc & bus.stb & bus.ack)
+
+        completed = Signal()
+        m.d.comb += completed.eq(bus.cyc & bus.ack)
+
+        # Latency
+
+        latency = Signal(len(self.cyc_cycles))
+        bucket  = Signal(range(self.buckets))
+        timed   = Signal()
+        dropped = Signal()
+
+        if hasattr(bus, "stall"):
+            # Timestamps of accepted strobes wait here until their acknowledgements arrive.
+            timestamp = Signal.like(latency)
+            m.d.sync += timestamp.eq(timestamp + 1)
+
+            m.submodules.timestamps = timestamps = \
+                ResetInserter(~bus.cyc)(SyncFIFO(width=len(timestamp), depth=self.max_outstanding))
+
+            # Once a timestamp has been dropped, acknowledgements can't be matched to
+            # strobes beyond those already queued, so timing stops until CYC falls.
+            untimed = Signal()
+
+            m.d.comb += [
+                timestamps.w_data   .eq(timestamp),
+                timestamps.w_en     .eq(accepted & ~untimed),
+                timestamps.r_en     .eq(completed),
+
+                dropped             .eq(accepted & ~untimed & ~timestamps.w_rdy),
+                timed               .eq(timestamps.r_rdy),
+                latency             .eq(timestamp - timestamps.r_data),
+            ]
+
+            with m.If(~bus.cyc):
+                m.d.sync += untimed.eq(0)
+            with m.Elif(dropped):
+                m.d.sync += untimed.eq(1)
+        else:
+            # Classic cycles are timed from the first cycle of their strobe.
+            waiting = Signal.like(latency)
+
+            with m.If(bus.cyc & bus.stb & ~bus.ack):
+                m.d.sync += waiting.eq(waiting + 1)
+            with m.Else():
+                m.d.sync += waiting.eq(0)
+
+            m.d.comb += [
+                timed               .eq(1),
+                latency             .eq(waiting + 1),
+            ]
+
+        # A latency of n cycles falls into the bucket of ceil(log2(n)).
+        with m.If(latency <= 1):
+            m.d.comb += bucket.eq(0)
+        for i in range(1, self.buckets - 1):
+            with m.Elif(latency <= (1 << i)):
+                m.d.comb += bucket.eq(i)
+        with m.Else():
+            m.d.comb += bucket.eq(self.buckets - 1)
+
+        # Counters
+
+        clear = Signal()
+        m.d.comb += clear.eq(self._clear.w_stb & self._clear.w_data)
+
+        def count(counter, condition):
+            with m.If(clear):
+                m.d.sync += counter.eq(0)
+            with m.Elif(condition):
+                m.d.sync += counter.eq(counter + 1)
+
+        count(self.cyc_cycles,   bus.cyc)
+        count(self.stb_cycles,   bus.cyc & bus.stb)
+        count(self.stall_cycles, bus.cyc & bus.stb & stall)
+        count(self.ack_cycles,   bus.cyc & bus.ack)
+        count(self.transfers,    accepted)
+
+        for i, counter in enumerate(self.latency):
+            count(counter, completed & timed & (bucket == i))
+
+        with m.If(clear):
+            m.d.sync += self.overflow.eq(0)
+        with m.Elif(dropped):
+            m.d.sync += self.overflow.eq(1)
+
+        m.d.comb += [
+            self._cyc_cycles.r_data     .eq(self.cyc_cycles),
+            self._stb_cycles.r_data     .eq(self.stb_cycles),
+            self._stall_cycles.r_data   .eq(self.stall_cycles),
+            self._ack_cycles.r_data     .eq(self.ack_cycles),
+            self._transfers.r_data      .eq(self.transfers),
+            self._overflow.r_data       .eq(self.overflow),
+        ]
+
+        for csr, counter in zip(self._latency, self.latency):
+            m.d.comb += csr.r_data.eq(counter)
+
+        return m
+
+
+class ArbiterMonitor(Peripheral, Elaboratable):
+    """ Exposes the grant-wait counters of a PriorityArbiter
+
+    'wait_cycles_<i>' reads the cycles that initiator i spent with CYC asserted but
+    without the grant. Writing to 'clear' resets every counter. Initiators must be
+    added to the arbiter before the monitor is created.
+    """
+
+    def __init__(self, arbiter):
+        super().__init__()
+
+        self.arbiter = arbiter
+
+        bank                = self.csr_bank()
+        self._clear         = bank.csr(1, "w")
+        self._wait_cycles   = [bank.csr(len(counter), "r", name="wait_cycles_{}".format(i))
+                               for i, counter in enumerate(arbiter.wait_cycles)]
+
+        self._bridge  = self.bridge(data_width=32, granularity=8, alignment=2)
+        self.bus      = self._bridge.bus
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.bridge = self._bridge
+
+        m.d.comb += self.arbiter.clear_wait.eq(self._clear.w_stb & self._clear.w_data)
+
+        for csr, counter in zip(self._wait_cycles, self.arbiter.wait_cycles):
+            m.d.comb += csr.r_data.eq(counter)
+
+        return m
+
+
+class WishboneMonitorTest(MultiProcessTestCase):
+
+    def test_counters(self):
+        observed = Interface(addr_width=24, data_width=8, features={"stall"})
+
+        dut = WishboneMonitor(observed)
+
+        intr_driver = WishboneInitiator(observed)
+        sub_emulator = WishboneEmulator(observed, delay=2, max_outstanding=1)
+
+        def intr_process():
+            yield from intr_driver.begin()
+            yield from intr_driver.read_sequential(4, 0x000000, 1)
+            yield
+
+            self.assertEqual((yield dut.transfers),  4)
+            self.assertEqual((yield dut.ack_cycles), 4)
+            self.assertGreater((yield dut.stall_cycles), 0)
+
+            histogram = []
+            for counter in dut.latency:
+                histogram.append((yield counter))
+            self.assertEqual(sum(histogram), 4)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[observed]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
+
+    def test_overflow(self):
+        observed = Interface(addr_width=24, data_width=8, features={"stall"})
+
+        dut = WishboneMonitor(observed, max_outstanding=1)
+
+        intr_driver = WishboneInitiator(observed)
+        sub_emulator = WishboneEmulator(observed, delay=2, max_outstanding=3)
+
+        def intr_process():
+            yield from intr_driver.begin()
+            yield from intr_driver.read_sequential(4, 0x000000, 1)
+            yield
+
+            self.assertEqual((yield dut.transfers), 4)
+            self.assertEqual((yield dut.overflow),  1)
+
+            # Only the transfers that could be timed reach the histogram.
+            histogram = []
+            for counter in dut.latency:
+                histogram.append((yield counter))
+            self.assertGreater(sum(histogram), 0)
+            self.assertLess(sum(histogram), 4)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[observed]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
@@ -1,18 +1,114 @@
 from nmigen import *
 from nmigen.hdl.rec import DIR_FANIN, DIR_FANOUT
+from nmigen.lib.fifo import SyncFIFO, SyncFIFOBuffered
+from nmigen.sim import *
 
 from test import *
+from test.driver.stream import StreamDriver
 
 
 class BasicStream(Record):
+    """ A valid/ready stream; 'first' and 'last' mark the words that begin and end a packet """
 
     def __init__(self, width):
         super().__init__([
             ('payload',     width,  DIR_FANOUT),
+            ('first',       1,      DIR_FANOUT),
+            ('last',        1,      DIR_FANOUT),
             ('valid',       1,      DIR_FANOUT),
             ('ready',       1,      DIR_FANIN)
         ])
 
+    def data(self):
+        """ Everything that travels with a transfer, packed for storage """
+        return Cat(self.payload, self.first, self.last)
+
+
+class StreamSkidBuffer(Elaboratable):
+    """ Registers every signal of a stream, including 'ready'
+
+    A second (skid) register catches the word that arrives in the cycle the sink
+    stalls, so the buffer runs at full throughput while breaking the combinational
+    path from 'sink.ready' back to 'source.ready'.
+    """
+
+    def __init__(self, width):
+        self.source = BasicStream(width)
+        self.sink   = BasicStream(width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        source_data = self.source.data()
+        sink_data   = self.sink.data()
+
+        skid_data  = Signal(len(source_data))
+        skid_valid = Signal()
+
+        m.d.comb += self.source.ready.eq(~skid_valid)
+
+        with m.If(self.sink.ready | ~self.sink.valid):
+            with m.If(skid_valid):
+                m.d.sync += [
+                    sink_data       .eq(skid_data),
+                    self.sink.valid .eq(1),
+                    skid_valid      .eq(0),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    sink_data       .eq(source_data),
+                    self.sink.valid .eq(self.source.valid),
+                ]
+
+        # The output register is full and stalled, so park the incoming word.
+        with m.Elif(self.source.valid & self.source.ready):
+            m.d.sync += [
+                skid_data           .eq(source_data),
+                skid_valid          .eq(1),
+            ]
+
+        return m
+
+
+class StreamFIFO(Elaboratable):
+    """ A stream wrapper around SyncFIFO that carries the packet framing
+
+    With 'buffered' set, the FIFO's read port is registered (SyncFIFOBuffered),
+    which costs one extra cycle of latency but keeps block RAM reads off the
+    critical path.
+    """
+
+    def __init__(self, width, depth, *, buffered=False):
+        self.width    = width
+        self.depth    = depth
+        self.buffered = buffered
+
+        self.source = BasicStream(width)
+        self.sink   = BasicStream(width)
+
+        self.level  = Signal(range(depth + 1))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        fifo_type = SyncFIFOBuffered if self.buffered else SyncFIFO
+        m.submodules.fifo = fifo = fifo_type(width=self.width + 2, depth=self.depth)
+
+        m.d.comb += [
+            fifo.w_data             .eq(self.source.data()),
+            fifo.w_en               .eq(self.source.valid),
+            self.source.ready       .eq(fifo.w_rdy),
+
+            self.sink.data()        .eq(fifo.r_data),
+            self.sink.valid         .eq(fifo.r_rdy),
+            fifo.r_en               .eq(self.sink.ready),
+
+            self.level              .eq(fifo.level),
+        ]
+
+        return m
+
+
 class ByteDownConverter(Elaboratable):
 
     def __init__(self, byte_width):
@@ -27,8 +123,15 @@ class ByteDownConverter(Elaboratable):
         data_shift = Signal.like(self.source.payload)
         bytes_to_send = Signal(range(0, self.byte_width + 1))
 
+        first = Signal()
+        last  = Signal()
+
         m.d.comb += [
-            self.sink.payload.eq(data_shift[0:8])
+            self.sink.payload.eq(data_shift[0:8]),
+
+            # A word's framing applies to its first and last bytes respectively.
+            self.sink.first.eq(first & (bytes_to_send == self.byte_width - 1)),
+            self.sink.last.eq(last & (bytes_to_send == 0)),
         ]
 
         with m.FSM():
@@ -41,6 +144,8 @@ class ByteDownConverter(Elaboratable):
                     m.d.sync += [
                         data_shift         .eq(self.source.payload),
                         bytes_to_send      .eq(self.byte_width - 1),
+                        first              .eq(self.source.first),
+                        last               .eq(self.source.last),
                     ]
                     m.next = "RUN"
 
@@ -66,6 +171,8 @@ class ByteDownConverter(Elaboratable):
                             m.d.sync += [
                                 bytes_to_send      .eq(self.byte_width - 1),
                                 data_shift         .eq(self.source.payload),
+                                first              .eq(self.source.first),
+                                last               .eq(self.source.last),
                             ]
 
                         # ... otherwise, move to our idle state.
@@ -74,6 +181,71 @@ class ByteDownConverter(Elaboratable):
 
         return m
 
+class ByteUpConverter(Elaboratable):
+    """ Gathers bytes into words, least significant byte first
+
+    The inverse of ByteDownConverter. A byte marked 'last' completes its word early;
+    the bytes it didn't fill read as zero.
+    """
+
+    def __init__(self, byte_width):
+        self.byte_width = byte_width
+
+        self.source = BasicStream(width=8)
+        self.sink   = BasicStream(width=8 * byte_width)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        data  = Signal.like(self.sink.payload)
+        index = Signal(range(self.byte_width))
+        full  = Signal()
+
+        first = Signal()
+        last  = Signal()
+
+        did_accept = Signal()
+        did_emit   = Signal()
+        completes  = Signal()
+
+        m.d.comb += [
+            self.sink.payload   .eq(data),
+            self.sink.first     .eq(first),
+            self.sink.last      .eq(last),
+            self.sink.valid     .eq(full),
+
+            # A full word can be replaced in the same cycle it's taken.
+            self.source.ready   .eq(~full | self.sink.ready),
+
+            did_accept          .eq(self.source.valid & self.source.ready),
+            did_emit            .eq(self.sink.valid & self.sink.ready),
+            completes           .eq((index == self.byte_width - 1) | self.source.last),
+        ]
+
+        with m.If(did_emit):
+            m.d.sync += full.eq(0)
+
+        with m.If(did_accept):
+            with m.If(index == 0):
+                m.d.sync += [
+                    data    .eq(self.source.payload),
+                    first   .eq(self.source.first),
+                ]
+            with m.Else():
+                m.d.sync += data.word_select(index, 8).eq(self.source.payload)
+
+            with m.If(completes):
+                m.d.sync += [
+                    index   .eq(0),
+                    last    .eq(self.source.last),
+                    full    .eq(1),
+                ]
+            with m.Else():
+                m.d.sync += index.eq(index + 1)
+
+        return m
+
+
 class ByteDownConverterTest(ModuleTestCase):
     FRAGMENT_UNDER_TEST = ByteDownConverter
     FRAGMENT_ARGUMENTS = dict(byte_width=4)
@@ -149,3 +321,108 @@ class ByteDownConverterTest(ModuleTestCase):
 
         self.assertEqual((yield self.dut.source.ready), 1)
         self.assertEqual((yield self.dut.sink.valid),   0)
+
+
+class ByteUpConverterTest(MultiProcessTestCase):
+
+    def test_packets(self):
+        dut = ByteUpConverter(byte_width=4)
+
+        source_driver = StreamDriver(dut.source)
+
+        def source_process():
+            yield from source_driver.begin()
+            yield from source_driver.produce([0xBE, 0xBA, 0xFE, 0xCA, 0xEF, 0xBE])
+
+            # The final byte of a packet completes its word early.
+            yield dut.source.last.eq(1)
+            yield from source_driver.produce([0xAD])
+            yield dut.source.last.eq(0)
+
+        def sink_process():
+            results = []
+            while len(results) < 2:
+                yield dut.sink.ready.eq(1)
+                yield Settle()
+                if (yield dut.sink.valid):
+                    results.append(((yield dut.sink.payload), (yield dut.sink.last)))
+                yield
+
+            self.assertEqual(results, [(0xCAFEBABE, 0), (0x00ADBEEF, 1)])
+
+        with self.simulate(dut) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(source_process)
+            sim.add_sync_process(sink_process)
+
+
+class StreamSkidBufferTest(MultiProcessTestCase):
+
+    def test_backpressure(self):
+        dut = StreamSkidBuffer(width=8)
+
+        source_driver = StreamDriver(dut.source)
+        sink_driver   = StreamDriver(dut.sink)
+
+        def source_process():
+            yield from source_driver.begin()
+            yield from source_driver.produce(range(16))
+
+        def sink_process():
+            yield from sink_driver.begin()
+
+            # Alternate between stalling and draining so that the skid register is used.
+            results = []
+            while len(results) < 16:
+                results += (yield from sink_driver.consume(min(3, 16 - len(results))))
+                yield
+                yield
+
+            self.assertEqual(results, list(range(16)))
+
+        with self.simulate(dut) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(source_process)
+            sim.add_sync_process(sink_process)
+
+
+class StreamFIFOTest(MultiProcessTestCase):
+
+    def _test_backpressure(self, buffered):
+        dut = StreamFIFO(width=8, depth=4, buffered=buffered)
+
+        source_driver = StreamDriver(dut.source)
+        sink_driver   = StreamDriver(dut.sink)
+
+        def source_process():
+            yield from source_driver.begin()
+            yield from source_driver.produce(range(16))
+
+        def sink_process():
+            yield from sink_driver.begin()
+
+            # Hold off until the FIFO has filled and is pushing back on the source.
+            for _ in range(12):
+                yield
+            yield Settle()
+            self.assertEqual((yield dut.level), 4)
+            self.assertEqual((yield dut.source.ready), 0)
+
+            results = []
+            while len(results) < 16:
+                results += (yield from sink_driver.consume(min(5, 16 - len(results))))
+                yield
+                yield
+
+            self.assertEqual(results, list(range(16)))
+
+        with self.simulate(dut) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(source_process)
+            sim.add_sync_process(sink_process)
+
+    def test_backpressure(self):
+        self._test_backpressure(buffered=False)
+
+    def test_backpressure_buffered(self):
+        self._test_backpressure(buffered=True)
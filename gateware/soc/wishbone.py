@@ -1,21 +1,46 @@
 from nmigen import *
+from nmigen.hdl.ast import Operator
+from nmigen.lib.fifo import AsyncFIFO, SyncFIFO
 from nmigen.sim import *
 from nmigen.utils import log2_int
 from nmigen_soc.memory import MemoryMap
-from nmigen_soc.wishbone import Interface
+from nmigen_soc.wishbone import CycleType, Decoder, Interface
 
 from test import *
 from test.driver.wishbone import WishboneInitiator
-from test.emulator.wishbone import WishboneEmulator
+from test.emulator.wishbone import RecordingWishboneEmulator, WishboneEmulator
 
 
 class DownConverter(Elaboratable):
+    """Bus Down-Converter
 
-    def __init__(self, *, sub_bus, addr_width, data_width, granularity=None, features=frozenset()):
+    Splits each transfer into several narrower transfers on a subordinate bus.
+
+    When pipelined, up to 'depth' words may be outstanding at once. The sub-transfers of
+    a word are issued as soon as the previous word's have been strobed, without waiting
+    for their acknowledgements, which keeps a pipelined subordinate bus saturated.
+
+    With a 'big' byte order, the sub-transfer at the lowest address carries the most
+    significant part of the word; with 'little', the least significant.
+
+    With 'registered' set, a RegisterSlice is inserted in front of the subordinate bus.
+    """
+
+    def __init__(self, *, sub_bus, addr_width, data_width, granularity=None, features=frozenset(),
+                 pipelined=False, depth=2, byteorder="big", registered=False):
         if granularity is None:
             granularity  = data_width
+        if byteorder not in ("big", "little"):
+            raise ValueError("Byte order must be 'big' or 'little', not {!r}".format(byteorder))
+
+        self._slice = RegisterSlice(sub_bus=sub_bus) if registered else None
+        if registered:
+            sub_bus = self._slice.bus
 
         self.sub_bus = sub_bus
+        self.pipelined = pipelined
+        self.depth = depth
+        self.byteorder = byteorder
 
         self.addr_width  = addr_width
         self.data_width  = data_width
@@ -34,13 +59,31 @@ class DownConverter(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
+        if self._slice is not None:
+            m.submodules.slice = self._slice
+
         dw_from = len(self.bus.dat_w)
         dw_to   = len(self.sub_bus.dat_w)
         ratio   = dw_from // dw_to
 
+        if self.pipelined:
+            return self._elaborate_pipelined(m, dw_from, dw_to, ratio)
+
         stb_counter = Signal(range(ratio))
         ack_counter = Signal(range(ratio))
 
+        # A sub-transfer that ends with ERR still counts towards completing the word,
+        # which is then terminated with ERR instead of ACK.
+        sub_ack     = Signal()
+        sub_err     = Signal()
+        error       = Signal()
+        done        = Signal()
+
+        if hasattr(self.sub_bus, "err"):
+            m.d.comb += sub_err.eq(self.sub_bus.err)
+
+        m.d.comb += sub_ack.eq(self.sub_bus.ack | sub_err)
+
         #
         # Control Path
         #
@@ -50,7 +93,7 @@ class DownConverter(Elaboratable):
         with m.FSM() as fsm:
 
             m.d.comb += [
-                self.bus.stall.eq(~fsm.ongoing("IDLE") & ~self.bus.ack),                
+                self.bus.stall.eq(~fsm.ongoing("IDLE") & ~done),
             ]
 
             with m.State("IDLE"):
@@ -69,9 +112,17 @@ class DownConverter(Elaboratable):
             with m.State("WAITING"):
                 m.d.comb += self.sub_bus.cyc.eq(1)
 
-                with m.If(self.sub_bus.ack):
+                with m.If(sub_ack):
                     with m.If(ack_counter == (ratio - 1)):
-                        m.d.comb += self.bus.ack.eq(1)
+                        m.d.comb += done.eq(1)
+
+                        if hasattr(self.bus, "err"):
+                            m.d.comb += [
+                                self.bus.ack.eq(~(error | sub_err)),
+                                self.bus.err.eq(  error | sub_err ),
+                            ]
+                        else:
+                            m.d.comb += self.bus.ack.eq(1)
 
                         m.next = "IDLE"
 
@@ -83,12 +134,16 @@ class DownConverter(Elaboratable):
         with m.If(self.sub_bus.cyc & self.sub_bus.stb & ~self.sub_bus.stall):
             m.d.sync += stb_counter.eq(stb_counter + 1)
 
-        with m.If(self.sub_bus.ack):
+        with m.If(sub_ack):
             m.d.sync += ack_counter.eq(ack_counter + 1)
 
+        with m.If(sub_err):
+            m.d.sync += error.eq(1)
+
         with m.If(self.bus.cyc & self.bus.stb & ~self.bus.stall):
             m.d.sync += stb_counter.eq(0)
             m.d.sync += ack_counter.eq(0)
+            m.d.sync += error.eq(0)
 
         #
         # Data Path
@@ -105,32 +160,407 @@ class DownConverter(Elaboratable):
 
         # Write
 
-        m.d.comb += self.sub_bus.dat_w.eq(self.bus.word_select(stb_counter, dw_to))
+        m.d.comb += self.sub_bus.dat_w.eq(self._word_select(self.bus.dat_w, stb_counter, dw_to, ratio))
 
         # Read
 
         dat_r = Signal(dw_from, reset_less=True)
 
-        # m.d.comb += self.bus.dat_r.eq(Cat(dat_r[dw_to:], self.sub_bus.dat_r))          # Little Endian
-        m.d.comb += self.bus.dat_r.eq(Cat(self.sub_bus.dat_r, dat_r[:dw_from - dw_to]))    # Big Endian
+        m.d.comb += self.bus.dat_r.eq(self._shift_in(dat_r, self.sub_bus.dat_r, dw_from, dw_to))
 
-        with m.If(self.sub_bus.ack):
+        with m.If(sub_ack):
             m.d.sync += dat_r.eq(self.bus.dat_r)
 
         return m
 
+    def _word_select(self, value, index, dw_to, ratio):
+        if self.byteorder == "big":
+            return value.word_select(ratio - 1 - index, dw_to)
+        else:
+            return value.word_select(index, dw_to)
+
+    def _shift_in(self, previous, sub_data, dw_from, dw_to):
+        if self.byteorder == "big":
+            return Cat(sub_data, previous[:dw_from - dw_to])
+        else:
+            return Cat(previous[dw_to:], sub_data)
+
+    def _elaborate_pipelined(self, m, dw_from, dw_to, ratio):
+        # Requests are queued until all of their sub-transfers have been strobed.
+        request = Record([
+            ('adr',     self.addr_width),
+            ('dat_w',   dw_from),
+            ('we',      1),
+        ])
+
+        queue = SyncFIFO(width=len(request), depth=self.depth)
+        m.submodules.queue = queue = ResetInserter(~self.bus.cyc)(queue)
+
+        head = Record.like(request)
+
+        stb_counter = Signal(range(ratio))
+        ack_counter = Signal(range(ratio))
+        outstanding = Signal(range(self.depth + 1))
+
+        sub_ack     = Signal()
+        sub_err     = Signal()
+        error       = Signal()
+
+        if hasattr(self.sub_bus, "err"):
+            m.d.comb += sub_err.eq(self.sub_bus.err)
+
+        m.d.comb += sub_ack.eq(self.sub_bus.ack | sub_err)
+
+        did_accept  = Signal()
+        did_issue   = Signal()
+        did_finish  = Signal()
+
+        #
+        # Upstream
+        #
+
+        m.d.comb += [
+            self.bus.stall          .eq(outstanding == self.depth),
+            did_accept              .eq(self.bus.cyc & self.bus.stb & ~self.bus.stall),
+
+            request.adr             .eq(self.bus.adr),
+            request.dat_w           .eq(self.bus.dat_w),
+            request.we              .eq(self.bus.we),
+
+            queue.w_data            .eq(request),
+            queue.w_en              .eq(did_accept),
+        ]
+
+        # Words stay outstanding from the upstream strobe until their final sub-ack.
+        with m.If(~self.bus.cyc):
+            m.d.sync += outstanding.eq(0)
+        with m.Elif(did_accept & ~did_finish):
+            m.d.sync += outstanding.eq(outstanding + 1)
+        with m.Elif(~did_accept & did_finish):
+            m.d.sync += outstanding.eq(outstanding - 1)
+
+        #
+        # Subordinate (strobes)
+        #
+
+        m.d.comb += [
+            head                    .eq(queue.r_data),
+
+            self.sub_bus.cyc        .eq(self.bus.cyc & (outstanding != 0)),
+            self.sub_bus.stb        .eq(self.bus.cyc & queue.r_rdy),
+            self.sub_bus.we         .eq(head.we),
+            self.sub_bus.adr        .eq(Cat(stb_counter, head.adr)),
+
+            self.sub_bus.dat_w      .eq(self._word_select(head.dat_w, stb_counter, dw_to, ratio)),
+
+            did_issue               .eq(self.sub_bus.stb & ~self.sub_bus.stall),
+        ]
+
+        with m.If(did_issue):
+            m.d.sync += stb_counter.eq(stb_counter + 1)
+
+            with m.If(stb_counter == (ratio - 1)):
+                m.d.comb += queue.r_en.eq(1)
+                m.d.sync += stb_counter.eq(0)
+
+        #
+        # Subordinate (acknowledgements)
+        #
+
+        # Acknowledgements arrive in order, so one counter tracks the oldest outstanding word.
+        dat_r = Signal(dw_from, reset_less=True)
+
+        m.d.comb += self.bus.dat_r.eq(self._shift_in(dat_r, self.sub_bus.dat_r, dw_from, dw_to))
+
+        with m.If(sub_ack):
+            m.d.sync += [
+                dat_r               .eq(self.bus.dat_r),
+                ack_counter         .eq(ack_counter + 1),
+                error               .eq(error | sub_err),
+            ]
+
+            with m.If(ack_counter == (ratio - 1)):
+                m.d.comb += did_finish.eq(1)
+                m.d.sync += [
+                    ack_counter     .eq(0),
+                    error           .eq(0),
+                ]
+
+        if hasattr(self.bus, "err"):
+            m.d.comb += [
+                self.bus.ack        .eq(did_finish & ~(error | sub_err)),
+                self.bus.err        .eq(did_finish &  (error | sub_err)),
+            ]
+        else:
+            m.d.comb += self.bus.ack.eq(did_finish)
+
+        with m.If(~self.bus.cyc):
+            m.d.sync += [
+                stb_counter         .eq(0),
+                ack_counter         .eq(0),
+                error               .eq(0),
+            ]
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.sub_bus
+        ]
+
+class UpConverter(Elaboratable):
+    """Bus Up-Converter
+
+    Maps each transfer of a narrow bus onto a lane of a wider subordinate bus. Writes
+    use the subordinate bus's byte selects, so its granularity must not exceed the
+    narrow data width.
+
+    With 'cache' enabled, the most recently read wide word is kept, and narrow reads
+    that fall within it are answered without a subordinate transfer. The cache is only
+    updated by transfers through this converter, so it should only be enabled when no
+    other initiator writes to the same memory.
+    """
+
+    def __init__(self, *, sub_bus, addr_width, data_width, granularity=None, features=frozenset(),
+                 cache=False, byteorder="big"):
+        if granularity is None:
+            granularity  = data_width
+        if byteorder not in ("big", "little"):
+            raise ValueError("Byte order must be 'big' or 'little', not {!r}".format(byteorder))
+        if sub_bus.granularity > data_width:
+            raise ValueError("Subordinate bus granularity {} exceeds the data width {}"
+                             .format(sub_bus.granularity, data_width))
+
+        self.sub_bus = sub_bus
+        self.cache = cache
+        self.byteorder = byteorder
+
+        self.addr_width  = addr_width
+        self.data_width  = data_width
+        self.granularity = granularity
+        self.features    = set(features)
+
+        self.bus = Interface(addr_width=addr_width, data_width=data_width,
+            granularity=granularity, features=features)
+
+        granularity_bits = log2_int(data_width // granularity)
+        memory_map = MemoryMap(addr_width=max(1, addr_width + granularity_bits),
+                               data_width=granularity)
+        memory_map.add_window(sub_bus.memory_map)
+        self.bus.memory_map = memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        dw_from = len(self.bus.dat_w)
+        dw_to   = len(self.sub_bus.dat_w)
+        ratio   = dw_to // dw_from
+
+        lane_bits    = log2_int(ratio)
+        sel_per_lane = len(self.sub_bus.sel) // ratio
+
+        address     = Signal(self.addr_width, reset_less=True)
+        write       = Signal()
+        write_data  = Signal(dw_from, reset_less=True)
+        write_sel   = Signal(sel_per_lane, reset_less=True)
+
+        cache_valid = Signal()
+        cache_adr   = Signal(self.addr_width - lane_bits, reset_less=True)
+        cache_data  = Signal(dw_to, reset_less=True)
+
+        lane = Signal(lane_bits)
+        if self.byteorder == "big":
+            m.d.comb += lane.eq(ratio - 1 - address[:lane_bits])
+        else:
+            m.d.comb += lane.eq(address[:lane_bits])
+
+        # Each narrow byte select covers one or more subordinate byte selects.
+        narrow_sel = self.bus.sel if hasattr(self.bus, "sel") else Const(1)
+        lane_sel   = Cat(*[Repl(bit, sel_per_lane // len(narrow_sel)) for bit in narrow_sel])
+
+        sub_err = Signal()
+        if hasattr(self.sub_bus, "err"):
+            m.d.comb += sub_err.eq(self.sub_bus.err)
+
+        done = Signal()
+
+        m.d.comb += [
+            self.sub_bus.adr    .eq(address[lane_bits:]),
+            self.sub_bus.we     .eq(write),
+            self.sub_bus.dat_w  .eq(Repl(write_data, ratio)),
+        ]
+
+        # The whole wide word is cached, so cached reads must select every lane.
+        if self.cache:
+            m.d.comb += self.sub_bus.sel.eq(Mux(write, write_sel << (lane * sel_per_lane),
+                                                Repl(1, len(self.sub_bus.sel))))
+        else:
+            m.d.comb += self.sub_bus.sel.eq(write_sel << (lane * sel_per_lane))
+
+        def accept():
+            # Latch the next narrow transfer, and decide whether the cache can answer it.
+            with m.If(self.bus.cyc & self.bus.stb):
+                m.d.sync += [
+                    address     .eq(self.bus.adr),
+                    write       .eq(self.bus.we),
+                    write_data  .eq(self.bus.dat_w),
+                    write_sel   .eq(Mux(self.bus.we, lane_sel, Repl(1, sel_per_lane))),
+                ]
+
+                # The word being returned right now is written to the cache on this same edge.
+                word      = self.bus.adr[lane_bits:]
+                returning = fsm.ongoing("WAITING") & self.sub_bus.ack & ~write
+                hit = ~self.bus.we & ((cache_valid & (word == cache_adr)) |
+                                      (returning & (word == address[lane_bits:])))
+
+                if self.cache:
+                    with m.If(hit):
+                        m.next = "HIT"
+                    with m.Else():
+                        m.next = "SENDING"
+                else:
+                    m.next = "SENDING"
+
+        with m.FSM() as fsm:
+
+            m.d.comb += self.bus.stall.eq(~fsm.ongoing("IDLE") & ~done)
+
+            with m.State("IDLE"):
+                accept()
+
+            with m.State("HIT"):
+                m.d.comb += [
+                    self.bus.ack        .eq(1),
+                    self.bus.dat_r      .eq(cache_data.word_select(lane, dw_from)),
+                    done                .eq(1),
+                ]
+
+                m.next = "IDLE"
+                accept()
+
+            with m.State("SENDING"):
+                m.d.comb += self.sub_bus.cyc.eq(1)
+                m.d.comb += self.sub_bus.stb.eq(1)
+
+                with m.If(~self.sub_bus.stall):
+                    m.next = "WAITING"
+
+            with m.State("WAITING"):
+                m.d.comb += self.sub_bus.cyc.eq(1)
+
+                with m.If(self.sub_bus.ack | sub_err):
+                    m.d.comb += [
+                        self.bus.dat_r  .eq(self.sub_bus.dat_r.word_select(lane, dw_from)),
+                        done            .eq(1),
+                    ]
+
+                    if hasattr(self.bus, "err"):
+                        m.d.comb += [
+                            self.bus.ack.eq(~sub_err),
+                            self.bus.err.eq( sub_err),
+                        ]
+                    else:
+                        m.d.comb += self.bus.ack.eq(1)
+
+                    m.next = "IDLE"
+                    accept()
+
+        # Cache
+
+        if self.cache:
+            with m.If(fsm.ongoing("WAITING") & self.sub_bus.ack):
+
+                with m.If(~write):
+                    m.d.sync += [
+                        cache_valid     .eq(1),
+                        cache_adr       .eq(address[lane_bits:]),
+                        cache_data      .eq(self.sub_bus.dat_r),
+                    ]
+
+                # Writes to the cached word would otherwise leave it stale.
+                with m.Elif(address[lane_bits:] == cache_adr):
+                    m.d.sync += cache_valid.eq(0)
+
+            with m.If(fsm.ongoing("WAITING") & sub_err):
+                m.d.sync += cache_valid.eq(0)
+
+        return m
+
     def ports(self):
         return [
             self.bus,
             self.sub_bus
         ]
 
+class WidthAdapter(Elaboratable):
+    """Bus Width Adapter
+
+    Connects a bus of any data width to a subordinate bus, using a DownConverter or an
+    UpConverter as needed. Extra keyword arguments are passed on to the converter, and
+    must be options that it accepts.
+    """
+
+    DOWN_OPTIONS = frozenset({"pipelined", "depth", "registered"})
+    UP_OPTIONS   = frozenset({"cache"})
+
+    def __init__(self, *, sub_bus, addr_width, data_width, granularity=None, features=frozenset(),
+                 byteorder="big", **kwargs):
+        if data_width > sub_bus.data_width:
+            options, converter = self.DOWN_OPTIONS, "DownConverter"
+        elif data_width < sub_bus.data_width:
+            options, converter = self.UP_OPTIONS, "UpConverter"
+        else:
+            options, converter = frozenset(), "no converter"
+
+        unknown = set(kwargs) - options
+        if unknown:
+            raise TypeError("Options {} don't apply to a {}-bit to {}-bit adapter ({})"
+                            .format(", ".join(sorted(unknown)), data_width, sub_bus.data_width,
+                                    converter))
+
+        if data_width > sub_bus.data_width:
+            self._converter = DownConverter(sub_bus=sub_bus, addr_width=addr_width,
+                data_width=data_width, granularity=granularity, features=features,
+                byteorder=byteorder, **kwargs)
+        elif data_width < sub_bus.data_width:
+            self._converter = UpConverter(sub_bus=sub_bus, addr_width=addr_width,
+                data_width=data_width, granularity=granularity, features=features,
+                byteorder=byteorder, **kwargs)
+        else:
+            self._converter = None
+
+        self.sub_bus = sub_bus
+
+        if self._converter is not None:
+            self.bus = self._converter.bus
+        else:
+            self.bus = Interface(addr_width=addr_width, data_width=data_width,
+                granularity=granularity, features=features)
+            self.bus.memory_map = sub_bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if self._converter is not None:
+            m.submodules.converter = self._converter
+        else:
+            m.d.comb += self.bus.connect(self.sub_bus)
+
+        return m
+
 class Translator(Elaboratable):
     """Bus Translator
 
     A resource for accessing a range of addresses on a subordinate bus.
+
+    With 'registered' set, a RegisterSlice is inserted in front of the subordinate bus.
     """
-    def __init__(self, *, sub_bus, base_addr, addr_width, features=frozenset()):
+    def __init__(self, *, sub_bus, base_addr, addr_width, features=frozenset(), registered=False):
+        self._slice = RegisterSlice(sub_bus=sub_bus) if registered else None
+        if registered:
+            sub_bus = self._slice.bus
+
         self.sub_bus = sub_bus
         self.base_addr = base_addr
 
@@ -150,6 +580,9 @@ class Translator(Elaboratable):
     def elaborate(self, platform):
         m = Module()
 
+        if self._slice is not None:
+            m.submodules.slice = self._slice
+
         # If the result of the addition is automatically extended to the width
         # of the subordinate bus, this auxiliary signal is unnecessary.
         adr_extended = Signal.like(self.sub_bus.adr)
@@ -163,27 +596,1125 @@ class Translator(Elaboratable):
 
         return m
 
-class DownConverterTest(MultiProcessTestCase):
+class RegisterSlice(Elaboratable):
+    """Bus Register Slice
 
-    def test_simple(self):
-        sub_bus = Interface(addr_width=24, data_width=8, features={"stall"})
-        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+    Registers every signal between a pipelined bus and its subordinate bus, so that no
+    combinational path crosses the slice. Requests pass through a skid buffer, which
+    registers STALL without losing throughput; responses are registered on their way
+    back. The slice adds a cycle of latency in each direction.
+    """
 
-        dut = DownConverter(sub_bus=sub_bus, addr_width=22, data_width=32,
-            granularity=8, features={"stall"})
+    REQUEST_FIELDS = ("adr", "dat_w", "sel", "we", "lock", "cti", "bte")
 
-        intr_driver = WishboneInitiator(dut.bus)
-        sub_emulator = WishboneEmulator(sub_bus, delay=1, max_outstanding=1)
+    def __init__(self, *, sub_bus):
+        if not hasattr(sub_bus, "stall"):
+            raise ValueError("A register slice requires a subordinate bus with the 'stall' feature")
 
-        def intr_process():
-            yield from intr_driver.begin()
-            yield from intr_driver.read_sequential(5, 0x00040000, 7)
+        self.sub_bus = sub_bus
 
-        def sub_process():
-            yield Passive()
-            yield from sub_emulator.emulate()
+        features = {name for name in ("err", "rty", "stall", "lock", "cti", "bte")
+                    if hasattr(sub_bus, name)}
 
-        with self.simulate(dut, traces=dut.ports()) as sim:
-            sim.add_clock(1.0 / 100e6, domain='sync')
-            sim.add_sync_process(intr_process)
-            sim.add_sync_process(sub_process)        
+        self.bus = Interface(addr_width=sub_bus.addr_width, data_width=sub_bus.data_width,
+            granularity=sub_bus.granularity, features=features)
+
+        try:
+            sub_map = sub_bus.memory_map
+        except NotImplementedError:
+            sub_map = None
+
+        if sub_map is not None:
+            memory_map = MemoryMap(addr_width=sub_map.addr_width, data_width=sub_map.data_width)
+            memory_map.add_window(sub_map)
+            self.bus.memory_map = memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        names = [name for name in self.REQUEST_FIELDS if hasattr(self.bus, name)]
+
+        request     = Cat(*[getattr(self.bus, name) for name in names])
+        sub_request = Cat(*[getattr(self.sub_bus, name) for name in names])
+
+        skid_request = Signal(len(request))
+        skid_valid   = Signal()
+
+        # Request
+
+        m.d.comb += [
+            self.sub_bus.cyc    .eq(self.bus.cyc),
+            self.bus.stall      .eq(skid_valid),
+        ]
+
+        with m.If(~self.bus.cyc):
+            m.d.sync += [
+                self.sub_bus.stb    .eq(0),
+                skid_valid          .eq(0),
+            ]
+
+        with m.Elif(~self.sub_bus.stb | ~self.sub_bus.stall):
+            with m.If(skid_valid):
+                m.d.sync += [
+                    sub_request         .eq(skid_request),
+                    self.sub_bus.stb    .eq(1),
+                    skid_valid          .eq(0),
+                ]
+            with m.Else():
+                m.d.sync += [
+                    sub_request         .eq(request),
+                    self.sub_bus.stb    .eq(self.bus.stb),
+                ]
+
+        # The subordinate bus stalled the registered request, so park the incoming one.
+        with m.Elif(self.bus.stb & ~skid_valid):
+            m.d.sync += [
+                skid_request    .eq(request),
+                skid_valid      .eq(1),
+            ]
+
+        # Response
+
+        m.d.sync += [
+            self.bus.ack        .eq(self.bus.cyc & self.sub_bus.ack),
+            self.bus.dat_r      .eq(self.sub_bus.dat_r),
+        ]
+
+        for name in ("err", "rty"):
+            if hasattr(self.bus, name):
+                m.d.sync += getattr(self.bus, name).eq(self.bus.cyc & getattr(self.sub_bus, name))
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.sub_bus
+        ]
+
+class FlatDecoder(Elaboratable):
+    """Fused Bus Decoder and Translator
+
+    Decodes a set of windows and translates each into its subordinate bus in a single
+    stage, replacing a Decoder followed by Translators.
+
+    Windows must be a power of two in size and aligned to it. The window map is
+    flattened at elaboration time: a window is matched by comparing only the address
+    bits above its size, and when 'base_addr' is aligned to the size too, the
+    translated address is wired up from constants without an adder. A window that
+    spans its whole subordinate bus and starts halfway through it (wrapping around the
+    end) only flips the top bit of the offset, so it needs no adder either. Otherwise
+    'base_addr' is added on, wrapping around the end of the subordinate bus.
+
+    With 'registered' set, the decoded and translated request is held in a register
+    before it reaches the subordinate buses, at the cost of a cycle of latency. This
+    requires a pipelined (stall) bus.
+    """
+
+    def __init__(self, *, addr_width, data_width, granularity=None, features=frozenset(),
+                 alignment=0, registered=False):
+        if granularity is None:
+            granularity  = data_width
+        if registered and "stall" not in features:
+            raise ValueError("A registered decoder requires the 'stall' feature")
+
+        self.registered = registered
+
+        self.bus = Interface(addr_width=addr_width, data_width=data_width,
+            granularity=granularity, features=features)
+        self.bus.memory_map = MemoryMap(addr_width=max(1, addr_width + log2_int(data_width // granularity)),
+                                        data_width=granularity, alignment=alignment)
+
+        self._subs = {}
+
+    def add(self, sub_bus, *, addr=None, size=None, base_addr=0):
+        """Maps 'size' units of the memory map (by default, the whole subordinate bus) at
+        'addr'. The window's first word is 'base_addr' on the subordinate bus."""
+        if sub_bus.data_width != self.bus.data_width:
+            raise ValueError("Subordinate bus has data width {}, which is not the same as "
+                             "decoder data width {}"
+                             .format(sub_bus.data_width, self.bus.data_width))
+        if sub_bus.granularity != self.bus.granularity:
+            raise ValueError("Subordinate bus has granularity {}, which is not the same as "
+                             "decoder granularity {}"
+                             .format(sub_bus.granularity, self.bus.granularity))
+
+        ratio_bits = log2_int(self.bus.data_width // self.bus.granularity)
+        if size is None:
+            size = 2 ** (sub_bus.addr_width + ratio_bits)
+
+        size_bits = log2_int(size)
+
+        window = MemoryMap(addr_width=size_bits, data_width=self.bus.granularity)
+        window.add_resource(sub_bus, size=size)
+
+        start, end, ratio = self.bus.memory_map.add_window(window, addr=addr)
+        if start % size != 0:
+            raise ValueError("Window at {:#x} is not aligned to its size {:#x}".format(start, size))
+
+        self._subs[window] = (sub_bus, base_addr)
+        return start, end, ratio
+
+    @staticmethod
+    def _translate(offset, base_addr, sub_width):
+        """Returns the subordinate address of 'offset' into a window starting at 'base_addr'"""
+        window_size = 1 << len(offset)
+
+        if base_addr % window_size == 0:
+            return Cat(offset, Const(base_addr >> len(offset), sub_width - len(offset)))
+        if base_addr % window_size == window_size >> 1 and sub_width == len(offset):
+            # The wrapping sum of the offset and half the bus flips its top bit.
+            return offset ^ (window_size >> 1)
+        return offset + base_addr
+
+    def elaborate(self, platform):
+        m = Module()
+
+        ratio_bits = log2_int(self.bus.data_width // self.bus.granularity)
+
+        # Flatten the windows into (sub_bus, offset_bits, match, translated address).
+        windows = []
+        for window, (start, end, ratio) in self.bus.memory_map.windows():
+            sub_bus, base_addr = self._subs[window]
+            offset_bits = log2_int(end - start) - ratio_bits
+
+            offset = self.bus.adr[:offset_bits]
+            sub_adr = self._translate(offset, base_addr, len(sub_bus.adr))
+
+            windows.append((sub_bus, self.bus.adr[offset_bits:] == (start >> ratio_bits) >> offset_bits, sub_adr))
+
+        # Request
+
+        select    = Signal(len(windows))
+        registers = {}
+
+        if self.registered:
+            valid = Signal()
+
+            stalled = Signal()
+            for i, (sub_bus, _, _) in enumerate(windows):
+                with m.If(select[i]):
+                    m.d.comb += stalled.eq(sub_bus.stall if hasattr(sub_bus, "stall") else ~sub_bus.ack)
+
+            m.d.comb += self.bus.stall.eq(valid & stalled)
+
+            for name in ("dat_w", "sel", "we", "cti", "bte"):
+                if hasattr(self.bus, name):
+                    registers[name] = Signal.like(getattr(self.bus, name))
+
+            sub_adrs = [Signal.like(sub_bus.adr) for sub_bus, _, _ in windows]
+
+            with m.If(~self.bus.cyc):
+                m.d.sync += valid.eq(0)
+            with m.Elif(~self.bus.stall):
+                m.d.sync += valid.eq(self.bus.stb)
+
+                with m.If(self.bus.stb):
+                    m.d.sync += select.eq(Cat(*[match for _, match, _ in windows]))
+                    m.d.sync += [register.eq(getattr(self.bus, name)) for name, register in registers.items()]
+                    m.d.sync += [sub_adr.eq(adr) for sub_adr, (_, _, adr) in zip(sub_adrs, windows)]
+
+            stb = valid
+        else:
+            m.d.comb += select.eq(Cat(*[match for _, match, _ in windows]))
+
+            for name in ("dat_w", "sel", "we", "cti", "bte"):
+                if hasattr(self.bus, name):
+                    registers[name] = getattr(self.bus, name)
+
+            sub_adrs = [adr for _, _, adr in windows]
+            stb = self.bus.stb
+
+        for i, ((sub_bus, _, _), sub_adr) in enumerate(zip(windows, sub_adrs)):
+            m.d.comb += [
+                sub_bus.adr     .eq(sub_adr),
+                sub_bus.cyc     .eq(self.bus.cyc & select[i]),
+                sub_bus.stb     .eq(stb),
+            ]
+            m.d.comb += [getattr(sub_bus, name).eq(register) for name, register in registers.items()
+                         if hasattr(sub_bus, name)]
+
+        # Response
+
+        for i, (sub_bus, _, _) in enumerate(windows):
+            with m.If(select[i]):
+                m.d.comb += [
+                    self.bus.ack    .eq(sub_bus.ack),
+                    self.bus.dat_r  .eq(sub_bus.dat_r),
+                ]
+                for name in ("err", "rty"):
+                    if hasattr(self.bus, name) and hasattr(sub_bus, name):
+                        m.d.comb += getattr(self.bus, name).eq(getattr(sub_bus, name))
+                if not self.registered and hasattr(self.bus, "stall"):
+                    m.d.comb += self.bus.stall.eq(sub_bus.stall if hasattr(sub_bus, "stall") else ~sub_bus.ack)
+
+        return m
+
+    def ports(self):
+        return [self.bus]
+
+class PriorityArbiter(Elaboratable):
+    """Fixed-Priority Bus Arbiter
+
+    Initiators are prioritized in the order they are added (the first has the highest
+    priority). The grant normally changes only once the granted initiator drops CYC.
+
+    With 'preempt' enabled, a higher-priority initiator also takes the bus at the next
+    burst boundary of the granted one, i.e. after a classic cycle or the end of a burst.
+    On a pipelined bus, the granted initiator is stalled at the boundary until its
+    outstanding transfers have been acknowledged. Initiators without CTI are treated as
+    issuing classic cycles.
+
+    'wait_cycles' holds a counter for each initiator of the cycles that it spent with
+    CYC asserted but without the grant, which shows what lower-priority traffic costs.
+    Asserting 'clear_wait' resets them; ArbiterMonitor exposes them as CSRs.
+    """
+
+    MAX_OUTSTANDING = 15
+
+    def __init__(self, *, addr_width, data_width, granularity=None, features=frozenset(),
+                 preempt=False, counter_width=32):
+        self.bus = Interface(addr_width=addr_width, data_width=data_width,
+            granularity=granularity, features=features)
+
+        self.preempt       = preempt
+        self.counter_width = counter_width
+
+        self._intrs = []
+        self.wait_cycles = []
+        self.clear_wait  = Signal()
+
+    def add(self, intr_bus):
+        if intr_bus.addr_width != self.bus.addr_width:
+            raise ValueError("Initiator bus has address width {}, which is not the same as "
+                             "arbiter address width {}"
+                             .format(intr_bus.addr_width, self.bus.addr_width))
+        if intr_bus.data_width != self.bus.data_width:
+            raise ValueError("Initiator bus has data width {}, which is not the same as "
+                             "arbiter data width {}"
+                             .format(intr_bus.data_width, self.bus.data_width))
+        if intr_bus.granularity < self.bus.granularity:
+            raise ValueError("Initiator bus has granularity {}, which is lesser than "
+                             "arbiter granularity {}"
+                             .format(intr_bus.granularity, self.bus.granularity))
+
+        self._intrs.append(intr_bus)
+        self.wait_cycles.append(Signal(self.counter_width,
+                                       name="wait_cycles_{}".format(len(self._intrs) - 1)))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        requests = Signal(len(self._intrs))
+        highest  = Signal(range(len(self._intrs)))
+        grant    = Signal(range(len(self._intrs)))
+
+        m.d.comb += requests.eq(Cat(intr_bus.cyc for intr_bus in self._intrs))
+
+        # The lowest-numbered requesting initiator has the highest priority.
+        for i in reversed(range(len(self._intrs))):
+            with m.If(requests[i]):
+                m.d.comb += highest.eq(i)
+
+        # Grant
+
+        pipelined   = hasattr(self.bus, "stall")
+
+        accepted    = Signal()
+        outstanding = Signal(range(self.MAX_OUTSTANDING + 1))
+        at_boundary = Signal(reset=1)
+        preempting  = Signal()
+        handover    = Signal()
+
+        if hasattr(self.bus, "cti"):
+            end_of_burst = ((self.bus.cti == CycleType.CLASSIC) |
+                            (self.bus.cti == CycleType.END_OF_BURST))
+        else:
+            end_of_burst = C(1)
+
+        if pipelined:
+            m.d.comb += accepted.eq(self.bus.cyc & self.bus.stb & ~self.bus.stall)
+        else:
+            m.d.comb += accepted.eq(self.bus.cyc & self.bus.stb & self.bus.ack)
+
+        with m.If(~self.bus.cyc):
+            m.d.sync += outstanding.eq(0)
+        with m.Elif(accepted & ~self.bus.ack):
+            m.d.sync += outstanding.eq(outstanding + 1)
+        with m.Elif(~accepted & self.bus.ack):
+            m.d.sync += outstanding.eq(outstanding - 1)
+
+        with m.If(~self.bus.cyc):
+            m.d.sync += at_boundary.eq(1)
+        with m.Elif(accepted):
+            m.d.sync += at_boundary.eq(end_of_burst)
+
+        if self.preempt:
+            m.d.comb += preempting.eq(self.bus.cyc & requests.any() & (highest < grant))
+
+            if pipelined:
+                # Hold back new strobes at a boundary, and hand over once the rest are acknowledged.
+                m.d.comb += handover.eq(preempting & at_boundary &
+                                        ((outstanding == 0) | ((outstanding == 1) & self.bus.ack)))
+            else:
+                m.d.comb += handover.eq(preempting & self.bus.ack & end_of_burst)
+
+        with m.If(~self.bus.cyc | handover):
+            m.d.sync += grant.eq(highest)
+
+        # Pipelined initiators are stalled while the bus is being handed over.
+        hold = Signal()
+        if pipelined:
+            m.d.comb += hold.eq(preempting & at_boundary)
+
+        # Statistics
+
+        for i, intr_bus in enumerate(self._intrs):
+            with m.If(self.clear_wait):
+                m.d.sync += self.wait_cycles[i].eq(0)
+            with m.Elif(intr_bus.cyc & (grant != i)):
+                m.d.sync += self.wait_cycles[i].eq(self.wait_cycles[i] + 1)
+
+        # Multiplexer
+
+        for i, intr_bus in enumerate(self._intrs):
+            m.d.comb += intr_bus.dat_r.eq(self.bus.dat_r)
+
+            # Initiators that don't hold the grant are stalled (or simply never acknowledged).
+            if hasattr(intr_bus, "stall"):
+                m.d.comb += intr_bus.stall.eq(1)
+
+        with m.Switch(grant):
+            for i, intr_bus in enumerate(self._intrs):
+                with m.Case(i):
+                    ratio = intr_bus.granularity // self.bus.granularity
+
+                    m.d.comb += [
+                        self.bus.adr    .eq(intr_bus.adr),
+                        self.bus.dat_w  .eq(intr_bus.dat_w),
+                        self.bus.we     .eq(intr_bus.we),
+                        self.bus.stb    .eq(intr_bus.stb & ~hold),
+                        self.bus.cyc    .eq(intr_bus.cyc),
+
+                        intr_bus.ack    .eq(self.bus.ack),
+                    ]
+
+                    if hasattr(self.bus, "sel"):
+                        intr_sel = intr_bus.sel if hasattr(intr_bus, "sel") else Const(1)
+                        m.d.comb += self.bus.sel.eq(Cat(Repl(sel, ratio) for sel in intr_sel))
+
+                    if hasattr(self.bus, "cti"):
+                        if hasattr(intr_bus, "cti"):
+                            m.d.comb += [
+                                self.bus.cti.eq(intr_bus.cti),
+                                self.bus.bte.eq(intr_bus.bte),
+                            ]
+                        else:
+                            m.d.comb += self.bus.cti.eq(CycleType.CLASSIC)
+
+                    if hasattr(self.bus, "lock") and hasattr(intr_bus, "lock"):
+                        m.d.comb += self.bus.lock.eq(intr_bus.lock)
+
+                    if hasattr(intr_bus, "stall"):
+                        m.d.comb += intr_bus.stall.eq(self.bus.stall | hold
+                                                      if pipelined else
+                                                      ~self.bus.ack)
+
+                    if hasattr(intr_bus, "err") and hasattr(self.bus, "err"):
+                        m.d.comb += intr_bus.err.eq(self.bus.err)
+
+                    if hasattr(intr_bus, "rty") and hasattr(self.bus, "rty"):
+                        m.d.comb += intr_bus.rty.eq(self.bus.rty)
+
+        return m
+
+class Crossbar(Elaboratable):
+    """Bus Crossbar
+
+    Connects several initiators to several targets, so that transfers to different
+    targets proceed concurrently. Each initiator has its own decoder, and each target
+    its own PriorityArbiter; initiators are prioritized in the order they are added.
+
+    All buses must share the crossbar's data width, granularity and features.
+    """
+
+    def __init__(self, *, addr_width, data_width, granularity=None, features=frozenset(),
+                 alignment=0, preempt=False):
+        if granularity is None:
+            granularity  = data_width
+
+        self.addr_width  = addr_width
+        self.data_width  = data_width
+        self.granularity = granularity
+        self.features    = set(features)
+        self.alignment   = alignment
+        self.preempt     = preempt
+
+        # Target addresses are allocated once, and shared by every initiator's decoder.
+        self.memory_map  = MemoryMap(addr_width=max(1, addr_width + log2_int(data_width // granularity)),
+                                     data_width=granularity, alignment=alignment)
+
+        self._intrs   = []
+        self._targets = []
+
+    def add_initiator(self, intr_bus):
+        self._intrs.append(intr_bus)
+        self.wait_cycles.append(Signal(self.counter_width,
+                                       name="wait_cycles_{}".format(len(self._intrs) - 1)))
+
+    def add_target(self, sub_bus, *, addr=None):
+        start, end, ratio = self.memory_map.add_window(sub_bus.memory_map, addr=addr)
+        self._targets.append((sub_bus, start))
+        return start, end, ratio
+
+    def elaborate(self, platform):
+        m = Module()
+
+        arbiters = []
+
+        for i, (sub_bus, _) in enumerate(self._targets):
+            arbiter = PriorityArbiter(addr_width=sub_bus.addr_width, data_width=self.data_width,
+                granularity=self.granularity, features=self.features, preempt=self.preempt)
+            m.submodules["arbiter_{}".format(i)] = arbiter
+            m.d.comb += arbiter.bus.connect(sub_bus)
+            arbiters.append(arbiter)
+
+        for i, intr_bus in enumerate(self._intrs):
+            decoder = Decoder(addr_width=self.addr_width, data_width=self.data_width,
+                granularity=self.granularity, features=self.features, alignment=self.alignment)
+            m.submodules["decoder_{}".format(i)] = decoder
+            m.d.comb += intr_bus.connect(decoder.bus)
+
+            for (sub_bus, start), arbiter in zip(self._targets, arbiters):
+                path = Interface(addr_width=sub_bus.addr_width, data_width=self.data_width,
+                    granularity=self.granularity, features=self.features)
+                path.memory_map = sub_bus.memory_map
+
+                decoder.add(path, addr=start)
+                arbiter.add(path)
+
+        return m
+
+class ClockDomainBridge(Elaboratable):
+    """Clock Domain Crossing Bus Bridge
+
+    Carries transfers from a bus in one clock domain to a subordinate bus in another,
+    through a pair of asynchronous FIFOs. Up to 'depth' transfers may be in flight, and
+    both buses are pipelined.
+
+    The number of outstanding transfers is capped at the depth of the response FIFO, so
+    the subordinate side never has to hold back an acknowledgement. Initiators must not
+    drop CYC while transfers are outstanding.
+    """
+
+    def __init__(self, *, sub_bus, i_domain="sync", t_domain="sync", depth=4):
+        self.sub_bus  = sub_bus
+        self.i_domain = i_domain
+        self.t_domain = t_domain
+        self.depth    = depth
+
+        features = {"stall"}
+        if hasattr(sub_bus, "err"):
+            features.add("err")
+
+        self.bus = Interface(addr_width=sub_bus.addr_width, data_width=sub_bus.data_width,
+            granularity=sub_bus.granularity, features=features)
+        self.bus.memory_map = sub_bus.memory_map
+
+    def elaborate(self, platform):
+        m = Module()
+
+        has_err = hasattr(self.sub_bus, "err")
+        has_sel = hasattr(self.sub_bus, "sel")
+
+        request = Record([
+            ('adr',     len(self.bus.adr)),
+            ('dat_w',   len(self.bus.dat_w)),
+            ('sel',     len(self.bus.sel) if has_sel else 1),
+            ('we',      1),
+        ])
+
+        response = Record([
+            ('dat_r',   len(self.bus.dat_r)),
+            ('err',     1),
+        ])
+
+        m.submodules.requests  = requests  = AsyncFIFO(width=len(request), depth=self.depth,
+            w_domain=self.i_domain, r_domain=self.t_domain)
+        m.submodules.responses = responses = AsyncFIFO(width=len(response), depth=self.depth,
+            w_domain=self.t_domain, r_domain=self.i_domain)
+
+        #
+        # Initiator domain
+        #
+
+        outstanding = Signal(range(self.depth + 1))
+        accepted    = Signal()
+        completed   = Signal()
+
+        m.d.comb += [
+            request.adr             .eq(self.bus.adr),
+            request.dat_w           .eq(self.bus.dat_w),
+            request.we              .eq(self.bus.we),
+
+            self.bus.stall          .eq(~requests.w_rdy | (outstanding == self.depth)),
+            accepted                .eq(self.bus.cyc & self.bus.stb & ~self.bus.stall),
+
+            requests.w_data         .eq(request),
+            requests.w_en           .eq(accepted),
+
+            response                .eq(responses.r_data),
+            responses.r_en          .eq(1),
+            completed               .eq(responses.r_rdy),
+
+            self.bus.dat_r          .eq(response.dat_r),
+        ]
+
+        if has_sel:
+            m.d.comb += request.sel.eq(self.bus.sel)
+
+        if has_err:
+            m.d.comb += [
+                self.bus.ack        .eq(completed & ~response.err),
+                self.bus.err        .eq(completed &  response.err),
+            ]
+        else:
+            m.d.comb += self.bus.ack.eq(completed)
+
+        with m.If(accepted & ~completed):
+            m.d[self.i_domain] += outstanding.eq(outstanding + 1)
+        with m.Elif(~accepted & completed):
+            m.d[self.i_domain] += outstanding.eq(outstanding - 1)
+
+        #
+        # Target domain
+        #
+
+        head    = Record.like(request)
+        pending = Signal(range(self.depth + 1))
+        issued  = Signal()
+        sub_ack = Signal()
+        sub_err = Signal()
+
+        if has_err:
+            m.d.comb += sub_err.eq(self.sub_bus.err)
+
+        m.d.comb += [
+            head                    .eq(requests.r_data),
+
+            self.sub_bus.cyc        .eq(requests.r_rdy | (pending != 0)),
+            self.sub_bus.stb        .eq(requests.r_rdy),
+            self.sub_bus.adr        .eq(head.adr),
+            self.sub_bus.dat_w      .eq(head.dat_w),
+            self.sub_bus.we         .eq(head.we),
+
+            issued                  .eq(self.sub_bus.stb & ~self.sub_bus.stall),
+            requests.r_en           .eq(issued),
+
+            sub_ack                 .eq(self.sub_bus.ack | sub_err),
+            responses.w_data        .eq(Cat(self.sub_bus.dat_r, sub_err)),
+            responses.w_en          .eq(sub_ack),
+        ]
+
+        if has_sel:
+            m.d.comb += self.sub_bus.sel.eq(head.sel)
+
+        with m.If(issued & ~sub_ack):
+            m.d[self.t_domain] += pending.eq(pending + 1)
+        with m.Elif(~issued & sub_ack):
+            m.d[self.t_domain] += pending.eq(pending - 1)
+
+        return m
+
+    def ports(self):
+        return [
+            self.bus,
+            self.sub_bus
+        ]
+
+class DownConverterTest(MultiProcessTestCase):
+
+    def test_simple(self):
+        sub_bus = Interface(addr_width=24, data_width=8, features={"stall"})
+        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+
+        dut = DownConverter(sub_bus=sub_bus, addr_width=22, data_width=32,
+            granularity=8, features={"stall"})
+
+        intr_driver = WishboneInitiator(dut.bus)
+        sub_emulator = WishboneEmulator(sub_bus, delay=1, max_outstanding=1)
+
+        def intr_process():
+            yield from intr_driver.begin()
+            yield from intr_driver.read_sequential(5, 0x00040000, 7)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)        
+
+    def test_pipelined(self):
+        sub_bus = Interface(addr_width=24, data_width=8, features={"stall"})
+        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+
+        dut = DownConverter(sub_bus=sub_bus, addr_width=22, data_width=32,
+            granularity=8, features={"stall"}, pipelined=True, depth=2)
+
+        intr_driver = WishboneInitiator(dut.bus)
+        sub_emulator = WishboneEmulator(sub_bus, delay=2, max_outstanding=3)
+
+        def intr_process():
+            yield from intr_driver.begin()
+            result = yield from intr_driver.read_sequential(5, 0x00040000, 1)
+
+            # The emulator answers each sub-transfer with an incrementing counter.
+            self.assertEqual(result, [
+                0x00010203,
+                0x04050607,
+                0x08090A0B,
+                0x0C0D0E0F,
+                0x10111213,
+            ])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
+
+    def _test_error(self, **kwargs):
+        sub_bus = Interface(addr_width=24, data_width=8, features={"stall", "err"})
+        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+
+        dut = DownConverter(sub_bus=sub_bus, addr_width=22, data_width=32,
+            granularity=8, features={"stall", "err"}, **kwargs)
+
+        # The second byte of word 1 fails.
+        sub_emulator = _ErrorEmulator(sub_bus, delay=1, max_outstanding=1, errors={0x000005})
+
+        def intr_process():
+            bus = dut.bus
+            results = []
+
+            for address in (0, 1, 2):
+                yield bus.cyc.eq(1)
+                yield bus.stb.eq(1)
+                yield bus.adr.eq(address)
+                yield Settle()
+                while (yield bus.stall):
+                    yield
+                    yield Settle()
+                yield
+                yield bus.stb.eq(0)
+
+                cycles = 0
+                while not ((yield bus.ack) or (yield bus.err)):
+                    yield
+                    cycles += 1
+                    self.assertLess(cycles, 50)
+
+                results.append(((yield bus.ack), (yield bus.err)))
+                yield bus.cyc.eq(0)
+                yield
+
+            # Only the word with the failing sub-transfer ends with ERR.
+            self.assertEqual(results, [(1, 0), (0, 1), (1, 0)])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
+
+    def test_error(self):
+        self._test_error()
+
+    def test_error_pipelined(self):
+        self._test_error(pipelined=True, depth=2)
+
+
+class _ErrorEmulator(WishboneEmulator):
+    """ Terminates transfers to any of 'errors' with ERR instead of ACK """
+
+    def __init__(self, *args, errors, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.errors = errors
+
+    def _finalize_next_task(self):
+        task, self.pipeline = self.pipeline[0], self.pipeline[1:]
+
+        failed = task is not None and task.address in self.errors
+
+        yield self.bus.ack.eq(task is not None and not failed)
+        yield self.bus.err.eq(failed)
+        yield self.bus.dat_r.eq(self._dispatch_task(task) if task is not None else 0)
+
+
+class UpConverterTest(MultiProcessTestCase):
+
+    def test_cached(self):
+        sub_bus = Interface(addr_width=22, data_width=32, granularity=8, features={"stall"})
+        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+
+        dut = UpConverter(sub_bus=sub_bus, addr_width=24, data_width=8,
+            features={"stall"}, cache=True)
+
+        intr_driver = WishboneInitiator(dut.bus)
+        sub_emulator = WishboneEmulator(sub_bus, initial=0x11223344, delay=1, max_outstanding=1)
+
+        sels = []
+
+        def intr_process():
+            yield from intr_driver.begin()
+            result = yield from intr_driver.read_sequential(5, 0x000000, 1)
+
+            # The first four bytes are served by a single wide read.
+            self.assertEqual(result, [0x11, 0x22, 0x33, 0x44, 0x11])
+            self.assertEqual(sub_emulator.counter, 0x11223346)
+
+            # Cached reads fetch every byte of the wide word.
+            self.assertEqual(sels, [0b1111, 0b1111])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        def sel_process():
+            yield Passive()
+            while True:
+                yield Settle()
+                if (yield sub_bus.cyc & sub_bus.stb & ~sub_bus.stall):
+                    sels.append((yield sub_bus.sel))
+                yield
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
+            sim.add_sync_process(sel_process)
+
+    def test_width_adapter_options(self):
+        sub_bus = Interface(addr_width=22, data_width=32, granularity=8, features={"stall"})
+        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+
+        WidthAdapter(sub_bus=sub_bus, addr_width=24, data_width=8, cache=True)
+
+        with self.assertRaises(TypeError):
+            WidthAdapter(sub_bus=sub_bus, addr_width=24, data_width=8, pipelined=True)
+        with self.assertRaises(TypeError):
+            WidthAdapter(sub_bus=sub_bus, addr_width=22, data_width=32, granularity=8, cache=True)
+
+class PriorityArbiterTest(MultiProcessTestCase):
+
+    def test_preempt(self):
+        dut = PriorityArbiter(addr_width=24, data_width=8, features={"stall"}, preempt=True)
+
+        high_bus = Interface(addr_width=24, data_width=8, features={"stall"})
+        low_bus  = Interface(addr_width=24, data_width=8, features={"stall"})
+
+        dut.add(high_bus)
+        dut.add(low_bus)
+
+        high_driver = WishboneInitiator(high_bus)
+        low_driver  = WishboneInitiator(low_bus)
+        sub_emulator = WishboneEmulator(dut.bus, delay=1, max_outstanding=1)
+
+        cycles = [0]
+        finished = {}
+
+        def high_process():
+            yield from high_driver.begin()
+            yield from ModuleTestCase.advance_cycles(8)
+
+            # The low priority initiator is still in its cycle, but yields at the next boundary.
+            start = cycles[0]
+            result = yield from high_driver.read_once(0x000100)
+            self.assertIsNotNone(result)
+            self.assertLess(cycles[0] - start, 12)
+            finished['high'] = cycles[0]
+
+        def low_process():
+            yield from low_driver.begin()
+            result = yield from low_driver.read_sequential(16, 0x000000, 1)
+            self.assertEqual(len(result), 16)
+            finished['low'] = cycles[0]
+
+            self.assertLess(finished['high'], finished['low'])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        def cycle_process():
+            yield Passive()
+            while True:
+                yield
+                cycles[0] += 1
+
+        with self.simulate(dut, traces=[dut.bus, high_bus, low_bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(high_process)
+            sim.add_sync_process(low_process)
+            sim.add_sync_process(sub_process)
+            sim.add_sync_process(cycle_process)
+
+    def test_wait_cycles(self):
+        dut = PriorityArbiter(addr_width=24, data_width=8, features={"stall"})
+
+        high_bus = Interface(addr_width=24, data_width=8, features={"stall"})
+        low_bus  = Interface(addr_width=24, data_width=8, features={"stall"})
+
+        dut.add(high_bus)
+        dut.add(low_bus)
+
+        high_driver = WishboneInitiator(high_bus)
+        low_driver  = WishboneInitiator(low_bus)
+        sub_emulator = WishboneEmulator(dut.bus, delay=1, max_outstanding=1)
+
+        def high_process():
+            yield from high_driver.begin()
+            result = yield from high_driver.read_sequential(16, 0x000000, 1)
+            self.assertEqual(len(result), 16)
+
+        def low_process():
+            yield from low_driver.begin()
+            yield from ModuleTestCase.advance_cycles(4)
+
+            # The low priority initiator waits while the high priority one holds the bus.
+            yield low_bus.cyc.eq(1)
+            yield low_bus.stb.eq(1)
+            yield low_bus.adr.eq(0x000100)
+            waited = 0
+            while (yield low_bus.stall):
+                waited += 1
+                yield
+            yield
+            yield low_bus.stb.eq(0)
+            while not (yield low_bus.ack):
+                yield
+            yield low_bus.cyc.eq(0)
+            yield
+
+            self.assertGreater(waited, 16)
+            self.assertGreater((yield dut.wait_cycles[1]), 16)
+            self.assertEqual((yield dut.wait_cycles[0]), 0)
+
+            # The counters can be cleared.
+            yield dut.clear_wait.eq(1)
+            yield
+            yield dut.clear_wait.eq(0)
+            yield
+            self.assertEqual((yield dut.wait_cycles[1]), 0)
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[dut.bus, high_bus, low_bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(high_process)
+            sim.add_sync_process(low_process)
+            sim.add_sync_process(sub_process)
+
+class CrossbarTest(MultiProcessTestCase):
+
+    def test_concurrent(self):
+        dut = Crossbar(addr_width=24, data_width=8, features={"stall"})
+
+        intr_buses = [Interface(addr_width=24, data_width=8, features={"stall"}) for _ in range(2)]
+        sub_buses  = [Interface(addr_width=16, data_width=8, features={"stall"}) for _ in range(2)]
+
+        for intr_bus in intr_buses:
+            dut.add_initiator(intr_bus)
+
+        for i, sub_bus in enumerate(sub_buses):
+            sub_bus.memory_map = MemoryMap(addr_width=16, data_width=8)
+            dut.add_target(sub_bus, addr=0x10000 * (i + 1))
+
+        intr_drivers  = [WishboneInitiator(intr_bus) for intr_bus in intr_buses]
+        sub_emulators = [WishboneEmulator(sub_bus, initial=0x10 * (i + 1), delay=1, max_outstanding=1)
+                         for i, sub_bus in enumerate(sub_buses)]
+
+        results = {}
+
+        def intr_process(index, address):
+            def process():
+                yield from intr_drivers[index].begin()
+                results[index] = yield from intr_drivers[index].read_sequential(4, address, 1)
+            return process
+
+        def sub_process(index):
+            def process():
+                yield Passive()
+                yield from sub_emulators[index].emulate()
+            return process
+
+        with self.simulate(dut, traces=[*intr_buses, *sub_buses]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            # Each initiator reads from a different target at the same time.
+            sim.add_sync_process(intr_process(0, 0x020000))
+            sim.add_sync_process(intr_process(1, 0x010000))
+            sim.add_sync_process(sub_process(0))
+            sim.add_sync_process(sub_process(1))
+
+        self.assertEqual(results[0], [0x20, 0x21, 0x22, 0x23])
+        self.assertEqual(results[1], [0x10, 0x11, 0x12, 0x13])
+
+class RegisterSliceTest(MultiProcessTestCase):
+
+    def test_sequential(self):
+        sub_bus = Interface(addr_width=16, data_width=8, features={"stall"})
+
+        dut = RegisterSlice(sub_bus=sub_bus)
+
+        intr_driver = WishboneInitiator(dut.bus)
+        sub_emulator = WishboneEmulator(sub_bus, initial=0x30, delay=1, max_outstanding=2)
+
+        def intr_process():
+            yield from intr_driver.begin()
+            results = yield from intr_driver.read_sequential(16, 0x0000, 1)
+            self.assertEqual(results, list(range(0x30, 0x30 + 16)))
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
+
+class FlatDecoderTest(MultiProcessTestCase):
+
+    def test_registered(self):
+        dut = FlatDecoder(addr_width=24, data_width=8, features={"stall"}, registered=True)
+
+        sub_buses = [Interface(addr_width=16, data_width=8, features={"stall"}) for _ in range(2)]
+
+        # The second window maps onto the upper half of its subordinate bus.
+        dut.add(sub_buses[0], addr=0x010000)
+        dut.add(sub_buses[1], addr=0x028000, size=0x8000, base_addr=0x8000)
+
+        intr_driver   = WishboneInitiator(dut.bus)
+        sub_emulators = [RecordingWishboneEmulator(sub_bus, initial=0x10 * (i + 1), delay=1, max_outstanding=2)
+                         for i, sub_bus in enumerate(sub_buses)]
+
+        def intr_process():
+            yield from intr_driver.begin()
+
+            results = yield from intr_driver.read_sequential(4, 0x010100, 1)
+            self.assertEqual(results, [0x10, 0x11, 0x12, 0x13])
+
+            results = yield from intr_driver.read_sequential(4, 0x028010, 1)
+            self.assertEqual(results, [0x20, 0x21, 0x22, 0x23])
+
+            self.assertEqual(sub_emulators[0].addresses, [0x0100, 0x0101, 0x0102, 0x0103])
+            self.assertEqual(sub_emulators[1].addresses, [0x8010, 0x8011, 0x8012, 0x8013])
+
+        def sub_process(index):
+            def process():
+                yield Passive()
+                yield from sub_emulators[index].emulate()
+            return process
+
+        with self.simulate(dut, traces=[dut.bus, *sub_buses]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process(0))
+            sim.add_sync_process(sub_process(1))
+
+    def test_wrapping(self):
+        dut = FlatDecoder(addr_width=30, data_width=32, granularity=8, features={"stall"})
+
+        # A 16 MiB window onto a 16 MiB bus, starting halfway through it (as for the cart ROM).
+        sub_bus = Interface(addr_width=22, data_width=32, granularity=8, features={"stall"})
+        dut.add(sub_bus, addr=0x10000000, size=0x1000000, base_addr=0x200000)
+
+        sub_emulator = RecordingWishboneEmulator(sub_bus, delay=1, max_outstanding=2)
+        intr_driver  = WishboneInitiator(dut.bus)
+
+        def intr_process():
+            yield from intr_driver.begin()
+
+            # Words above 8 MiB into the window wrap around to the start of the bus.
+            for address in (0x04000004, 0x041FFFFF, 0x04200000, 0x043FFFFF):
+                result = yield from intr_driver.read_once(address)
+                self.assertIsNotNone(result)
+
+            self.assertEqual(sub_emulator.addresses, [0x200004, 0x3FFFFF, 0x000000, 0x1FFFFF])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(dut, traces=[dut.bus, sub_bus]) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process)
+
+    def test_cart_translation(self):
+        # The cart maps the upper 8 MiB of the flash (22-bit word addresses) at 0x10000000, in a
+        # 16 MiB window that wraps around into the lower half.
+        dut = FlatDecoder(addr_width=30, data_width=32, granularity=8, features={"stall"})
+        sub_bus = Interface(addr_width=22, data_width=32, granularity=8, features={"stall"})
+        dut.add(sub_bus, addr=0x10000000, size=0x1000000, base_addr=0x200000)
+
+        offset = dut.bus.adr[:22]
+
+        def operators(value):
+            if isinstance(value, Operator):
+                yield value.operator
+                for operand in value.operands:
+                    yield from operators(operand)
+
+        # No carry chain is built on the cart's address path...
+        sub_adr = FlatDecoder._translate(offset, 0x200000, len(sub_bus.adr))
+        self.assertNotIn("+", list(operators(sub_adr)))
+        self.assertIn("^", list(operators(sub_adr)))
+
+        # ... while other unaligned bases still need the adder.
+        sub_adr = FlatDecoder._translate(offset, 0x000001, len(sub_bus.adr))
+        self.assertIn("+", list(operators(sub_adr)))
+
+        Fragment.get(dut, platform=None)
+
+
+class ClockDomainBridgeTest(MultiProcessTestCase):
+
+    def test_slow_target(self):
+        sub_bus = Interface(addr_width=24, data_width=8, features={"stall"})
+        sub_bus.memory_map = MemoryMap(addr_width=24, data_width=8)
+
+        dut = ClockDomainBridge(sub_bus=sub_bus, i_domain="sync", t_domain="slow", depth=4)
+
+        m = Module()
+        m.domains.slow = ClockDomain()
+        m.submodules.dut = dut
+
+        intr_driver = WishboneInitiator(dut.bus)
+        sub_emulator = WishboneEmulator(sub_bus, initial=0x40, delay=1, max_outstanding=2)
+
+        def intr_process():
+            yield from intr_driver.begin()
+            result = yield from intr_driver.read_sequential(4, 0x000000, 1)
+            self.assertEqual(result, [0x40, 0x41, 0x42, 0x43])
+
+        def sub_process():
+            yield Passive()
+            yield from sub_emulator.emulate()
+
+        with self.simulate(m, traces=dut.ports()) as sim:
+            sim.add_clock(1.0 / 100e6, domain='sync')
+            sim.add_clock(1.0 / 40e6,  domain='slow')
+            sim.add_sync_process(intr_process)
+            sim.add_sync_process(sub_process, domain='slow')
@@ -1,12 +1,37 @@
+import mmap
+
 from nmigen import *
 from nmigen.sim import *
 
 
 class QSPIFlashEmulator:
 
-    def __init__(self, qspi, data):
+    SFDP_COMMAND        = 0x5A
+    SFDP_DUMMY_CYCLES   = 8
+
+    def __init__(self, qspi, data, *, offset=0, chips=1, read_command=0xEB, dummy_cycles=4, mode_cycles=2):
+        # Any indexable sequence of bytes (list, bytes, memoryview, mmap) placed at 'offset'.
+        # Addresses outside of it read as erased flash (0xFF), so nothing needs to be padded.
         self.qspi = qspi
         self.data = data
+        self.offset = offset
+
+        # With two chips, 'data' is the logical (unstriped) image and both devices are
+        # modelled in lockstep: chip 0 returns high nibbles and chip 1 low nibbles.
+        self.chips = chips
+
+        self.read_command = read_command
+        self.dummy_cycles = dummy_cycles
+        self.mode_cycles  = mode_cycles
+
+        self.sfdp = self._build_sfdp()
+
+    @classmethod
+    def from_file(cls, qspi, path, **kwargs):
+        """ Creates an emulator backed by a memory-mapped image, so large ROMs are never copied. """
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(qspi, memoryview(data), **kwargs)
 
     def emulate(self):    
         while True:
@@ -18,7 +43,11 @@ class QSPIFlashEmulator:
             if command is None:
                 continue
 
-            assert command == 0xEB
+            if command == self.SFDP_COMMAND:
+                yield from self._emulate_sfdp()
+                continue
+
+            assert command == self.read_command
 
             address = yield from self._read_qspi(6)
             if address is None:
@@ -30,10 +59,16 @@ class QSPIFlashEmulator:
 
             assert mode == 0xF0  
 
-            dummy = yield from self._read_qspi(3)
+            # The emulator observes the bus one cycle late, so the last dummy
+            # cycle overlaps with the first nibble of data.
+            dummy = yield from self._read_qspi(self.dummy_cycles - 1)
             if dummy is None:
                 continue
 
+            if self.chips > 1:
+                yield from self._emulate_striped(address)
+                continue
+
             while True:
                 data = self._load_data(address)
                 bursting = yield from self._write_qspi(2, data)
@@ -41,9 +76,62 @@ class QSPIFlashEmulator:
                     break
                 address += 1
 
+    def _emulate_striped(self, address):
+        # Each device byte holds one nibble of two consecutive logical bytes
+        address *= 2
+
+        while True:
+            data = self._load_data(address)
+            bursting = yield from self._write_lanes((data >> 4) | ((data & 0xF) << 4))
+            if not bursting:
+                break
+            address += 1
+
+    def _emulate_sfdp(self):
+        address = yield from self._read_spi(24)
+        if address is None:
+            return
+
+        dummy = yield from self._read_spi(self.SFDP_DUMMY_CYCLES - 1)
+        if dummy is None:
+            return
+
+        while True:
+            data = self.sfdp[address] if address < len(self.sfdp) else 0xFF
+            bursting = yield from self._write_spi(8, data)
+            if not bursting:
+                break
+            address += 1
+
+    def _build_sfdp(self):
+        """ Builds a minimal JESD216 SFDP table describing this part's 1-4-4 fast read. """
+        table_pointer = 0x30
+
+        # SFDP header and the Basic Flash Parameter Table's parameter header
+        header = [
+            *b'SFDP', 0x06, 0x01, 0x00, 0xFF,
+            0x00, 0x06, 0x01, 0x09, table_pointer, 0x00, 0x00, 0xFF,
+        ]
+
+        density = 8 * max(self.offset + len(self.data), 2**24) - 1
+        wait_states = self.dummy_cycles + self.mode_cycles - 2
+
+        bfpt = [
+            # DWORD 1: Supports 1-4-4 fast read (bit 21)
+            0xE5, 0x20, 0xF9, 0xFF,
+            # DWORD 2: Density (in bits, minus one)
+            *density.to_bytes(4, byteorder='little'),
+            # DWORD 3: 1-4-4 wait states, mode clocks and instruction; 1-1-4 fast read
+            wait_states | (self.mode_cycles << 5), self.read_command, 0x08, 0x6B,
+        ]
+
+        table = header + [0xFF] * (table_pointer - len(header)) + bfpt
+        return table
+
     def _load_data(self, address):
-        if address < len(self.data):
-            return self.data[address]
+        index = address - self.offset
+        if 0 <= index < len(self.data):
+            return self.data[index]
         else:
             return 0xFF
 
@@ -73,7 +161,7 @@ class QSPIFlashEmulator:
             if aborted:
                 return None
 
-            nibble = (yield self.qspi.d.o)
+            nibble = (yield self.qspi.d.o[0:4])
             result = (result << 4) | nibble
             yield
 
@@ -95,6 +183,28 @@ class QSPIFlashEmulator:
 
         return True
 
+    def _write_lanes(self, value):
+        aborted = yield from self._wait_for_next_clock()
+        if aborted:
+            return False
+
+        yield self.qspi.d.i.eq(value)
+        yield
+
+        return True
+
+    def _write_spi(self, bit_count, data):
+        for i in reversed(range(bit_count)):
+            aborted = yield from self._wait_for_next_clock()
+            if aborted:
+                return False
+
+            # Single-line data is returned on DQ1 (MISO)
+            yield self.qspi.d.i.eq(((data >> i) & 1) << 1)
+            yield
+
+        return True
+
     def _wait_for_next_clock(self):        
         while True:
             if (yield self.qspi.cs_n):
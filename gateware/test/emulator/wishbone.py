@@ -75,3 +75,33 @@ class WishboneEmulator:
         result = self.counter
         self.counter += 1
         return result
+
+
+class RecordingWishboneEmulator(WishboneEmulator):
+    """ A WishboneEmulator that records every transfer it completes
+
+    'addresses' lists the address of each transfer, and 'writes' the (address, data)
+    of each write, in order. With 'memory' set, writes are stored and reads return the
+    stored data (or 0), instead of counting up.
+    """
+
+    def __init__(self, *args, memory=False, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.memory = {} if memory else None
+
+        self.addresses = []
+        self.writes = []
+
+    def _dispatch_task(self, task):
+        self.addresses.append(task.address)
+        if task.is_write:
+            self.writes.append((task.address, task.write_data))
+
+        if self.memory is None:
+            return super()._dispatch_task(task)
+
+        if task.is_write:
+            self.memory[task.address] = task.write_data
+            return 0
+        return self.memory.get(task.address, 0)